@@ -1,8 +1,14 @@
 # app/api/__init__.py
 from fastapi import APIRouter
+
+from ..services import audit_log
+from ..services.single_flight import single_flight_stats
 from .patients import router as patients_router
 from .treatments import router as treatments_router
 from .insurance import router as insurance_router
+from .events import router as events_router
+from .analytics import router as analytics_router
+from .archive import router as archive_router
 
 router = APIRouter()
 
@@ -10,8 +16,23 @@ router = APIRouter()
 router.include_router(patients_router)
 router.include_router(treatments_router)
 router.include_router(insurance_router)
+router.include_router(events_router)
+router.include_router(analytics_router)
+router.include_router(archive_router)
 
 # Health check endpoint
 @router.get("/health")
 async def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+
+@router.get("/metrics/single-flight")
+async def single_flight_metrics():
+    """Coalesced-read counters; coalesced is the number of duplicate loads avoided"""
+    return single_flight_stats()
+
+
+@router.get("/metrics/audit")
+async def audit_metrics():
+    """Audit pipeline counters for this process; dropped should stay at zero"""
+    return audit_log.stats()
\ No newline at end of file
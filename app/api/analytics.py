@@ -0,0 +1,43 @@
+# app/api/analytics.py
+from fastapi import APIRouter, HTTPException
+from typing import Optional
+from datetime import date, timedelta
+
+from ..services import treatment_analytics
+
+router = APIRouter(prefix="/analytics", tags=["analytics"])
+
+
+def _resolve_range(start: Optional[date], end: Optional[date], default_days: int):
+    end = end or date.today()
+    start = start or end - timedelta(days=default_days - 1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+
+@router.get("/revenue/daily")
+async def daily_revenue(start: Optional[date] = None, end: Optional[date] = None):
+    """Daily revenue, insurance/patient split and treatment count"""
+    start, end = _resolve_range(start, end, 30)
+    return treatment_analytics.daily(start, end)
+
+
+@router.get("/revenue/weekly")
+async def weekly_revenue(start: Optional[date] = None, end: Optional[date] = None):
+    """Weekly revenue, insurance/patient split and treatment count"""
+    start, end = _resolve_range(start, end, 84)
+    return treatment_analytics.weekly(start, end)
+
+
+@router.get("/revenue/share")
+async def revenue_share(start: Optional[date] = None, end: Optional[date] = None):
+    """Insurance versus patient share of revenue"""
+    start, end = _resolve_range(start, end, 30)
+    return treatment_analytics.share(start, end)
+
+
+@router.get("/diagnoses")
+async def diagnosis_counts(limit: int = 20):
+    """Treatment counts and revenue by diagnosis"""
+    return treatment_analytics.diagnoses(limit=limit)
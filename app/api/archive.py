@@ -0,0 +1,45 @@
+# app/api/archive.py
+from fastapi import APIRouter, HTTPException, Query, Request
+from typing import Optional
+from datetime import date
+import asyncio
+
+from ..services import treatment_archive
+from ..services.archive import TREATMENT_SCHEMA
+from ..services.audit import audit_patients
+from .serialization import FastJSONResponse
+
+router = APIRouter(prefix="/archive", tags=["archive"])
+
+
+@router.get("/treatments")
+async def query_archived_treatments(
+        request: Request,
+        patient_id: Optional[int] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        fields: Optional[str] = None,
+        include_images: bool = False,
+        limit: int = Query(1000, ge=1, le=10000)
+):
+    """Read archived treatments back from Parquet; filters are pushed down to the files"""
+    if patient_id is None and start is None and end is None:
+        raise HTTPException(status_code=400, detail="Filter by patient_id or a date range")
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    columns = None
+    if fields:
+        columns = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in columns if name not in TREATMENT_SCHEMA.names]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    loop = asyncio.get_running_loop()
+    rows = await loop.run_in_executor(
+        None,
+        lambda: treatment_archive.query(patient_id, start, end, columns, include_images, limit)
+    )
+    if patient_id is None:
+        audit_patients(request, (row["patient_id"] for row in rows if row.get("patient_id") is not None))
+    return FastJSONResponse(rows)
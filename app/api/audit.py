@@ -0,0 +1,45 @@
+# app/api/audit.py
+import time
+
+from ..services.audit import AuditLog
+
+
+class AuditMiddleware:
+    """Record an access entry for every request to a PHI route.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses pass
+    through untouched. The entry is built after the response is sent, when
+    routing has filled in the route and path parameters, and handed to the
+    audit log's in-memory buffer; nothing is written on the request path.
+    WebSocket sessions are recorded when they end, with status 101 if they
+    were accepted and 403 if closed before that.
+    """
+
+    def __init__(self, app, audit_log: AuditLog):
+        self.app = app
+        self.audit_log = audit_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket") or not self.audit_log.audits(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        # Endpoints attribute requests to patients through request.state
+        scope.setdefault("state", {})
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "websocket.accept":
+                status = 101
+            elif message["type"] == "websocket.close" and status != 101:
+                status = 403
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.audit_log.record(self.audit_log.build_record(scope, status, time.perf_counter() - started))
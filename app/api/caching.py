@@ -0,0 +1,137 @@
+# app/api/caching.py
+from fastapi import Request, Response
+from sqlalchemy import Table, func, select
+from sqlalchemy.orm import Session
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Optional, Tuple
+import hashlib
+
+
+def _version_column(table: Table):
+    return func.coalesce(table.c.updated_at, table.c.created_at)
+
+
+def entity_version(db: Session, table: Table, key: str, entity_id: Any) -> Optional[datetime]:
+    """Last change time of one row by primary key, or None if it does not exist"""
+    return db.execute(
+        select(_version_column(table)).where(table.c[key] == entity_id)
+    ).scalar()
+
+
+def collection_version(db: Session, table: Table, *criteria) -> Tuple[int, Optional[datetime]]:
+    """Row count and last change time of the rows matching criteria.
+
+    The count catches deletes, which leave no timestamp behind.
+    """
+    row = db.execute(
+        select(func.count(), func.max(_version_column(table))).select_from(table).where(*criteria)
+    ).one()
+    return row[0], row[1]
+
+
+def collection_version_columns(table: Table) -> Tuple[Any, Any]:
+    """collection_version as window columns to add to a page query.
+
+    Windows are evaluated before OFFSET/LIMIT, so every row of any page
+    carries the count and last change time of the whole filtered collection.
+    """
+    return (
+        func.count().over().label("_collection_count"),
+        func.max(_version_column(table)).over().label("_collection_version"),
+    )
+
+
+def pop_collection_version(rows) -> Optional[Tuple[int, Optional[datetime]]]:
+    """Strip collection_version_columns from fetched rows and return their value.
+
+    None when the page is empty; the caller falls back to collection_version.
+    """
+    if not rows:
+        return None
+    version = rows[0]["_collection_count"], rows[0]["_collection_version"]
+    for row in rows:
+        del row["_collection_count"], row["_collection_version"]
+    return version
+
+
+def is_conditional(request: Request) -> bool:
+    """Whether the client sent validators, i.e. whether a 304 is possible at all"""
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def latest(*versions: Optional[datetime]) -> Optional[datetime]:
+    """Most recent of several change times, ignoring missing ones"""
+    present = [version for version in versions if version is not None]
+    return max(present) if present else None
+
+
+def _microseconds(version: Optional[datetime]) -> int:
+    return int(version.timestamp() * 1_000_000) if version else 0
+
+
+def entity_etag(entity_id: Any, version: datetime) -> str:
+    return f'W/"{entity_id}-{_microseconds(version)}"'
+
+
+def collection_etag(*parts: Any) -> str:
+    """ETag over the collection version and every parameter shaping the body"""
+    normalized = [
+        _microseconds(part) if isinstance(part, datetime) else part
+        for part in parts
+    ]
+    digest = hashlib.sha1(repr(normalized).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _http_date(version: datetime) -> str:
+    if version.tzinfo is None:
+        version = version.replace(tzinfo=timezone.utc)
+    return format_datetime(version.astimezone(timezone.utc), usegmt=True)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Weak comparison: W/"x" and "x" match
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def not_modified(request: Request, etag: str, version: Optional[datetime]) -> Optional[Response]:
+    """Return a 304 response when the client's copy is current, else None"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        matched = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if not if_modified_since or version is None:
+            return None
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if version.tzinfo is None:
+            version = version.replace(tzinfo=timezone.utc)
+        matched = version.replace(microsecond=0) <= since
+
+    if not matched:
+        return None
+    response = Response(status_code=304)
+    set_validators(response, etag, version)
+    return response
+
+
+def set_validators(response: Response, etag: str, version: Optional[datetime]):
+    """Attach ETag and Last-Modified to a response"""
+    response.headers["ETag"] = etag
+    if version is not None:
+        response.headers["Last-Modified"] = _http_date(version)
+    # Clients must revalidate, but may keep the body
+    response.headers["Cache-Control"] = "private, no-cache"
@@ -0,0 +1,78 @@
+# app/api/events.py
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+import json
+import logging
+
+from ..services import event_broadcaster
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+KEEPALIVE_SECONDS = 15
+
+
+@router.websocket("/ws")
+async def event_websocket(
+        websocket: WebSocket,
+        patient_id: int
+):
+    """Push one patient's treatment and insurance events to a client over WebSocket.
+
+    patient_id is required: events carry PHI such as diagnoses, and each
+    session must be attributable to the patient it streamed in the audit log.
+    """
+    await websocket.accept()
+    subscriber = event_broadcaster.subscribe(patient_id=patient_id)
+    try:
+        while not subscriber.dropped:
+            event = await event_broadcaster.next_event(subscriber, timeout=KEEPALIVE_SECONDS)
+            if event is None:
+                if subscriber.dropped:
+                    break
+                await websocket.send_json({"type": "keepalive"})
+                continue
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_broadcaster.unsubscribe(subscriber)
+
+    if subscriber.dropped:
+        # 1013: try again later; the client fell too far behind
+        await websocket.close(code=1013)
+
+
+@router.get("/stream")
+async def event_stream(
+        request: Request,
+        patient_id: int
+):
+    """Push one patient's treatment and insurance events to a client over Server-Sent Events"""
+    subscriber = event_broadcaster.subscribe(patient_id=patient_id)
+
+    async def generate():
+        try:
+            while not subscriber.dropped:
+                if await request.is_disconnected():
+                    break
+                event = await event_broadcaster.next_event(subscriber, timeout=KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event.get('event_type', 'message')}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            event_broadcaster.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/stats")
+async def event_stats():
+    """Realtime fan-out statistics for this process"""
+    return event_broadcaster.stats()
@@ -1,104 +1,238 @@
 # app/api/insurance.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from datetime import date
 
-from ..models.insurance import Insurance, InsuranceCreate, InsuranceUpdate
-from ..services.database import get_db
-from ..services import kafka_producer
+from ..models.insurance import (
+    Insurance, InsuranceCreate, InsuranceUpdate, InsuranceRecord, EligibilityRequest, check_coverage_dates,
+    insurance_table
+)
+from ..services.database import get_db, get_read_db, sibling_session
+from ..services import kafka_producer, eligibility_service, billing_engine
+from .serialization import FastJSONResponse, partial_model, rows_to_dicts, select_columns
+from ..services.single_flight import run_blocking, single_flight
+from ..services.audit import audit_patient, audit_patients
+from .treatments import publish_billing_changes
+from .caching import (
+    collection_etag, collection_version, collection_version_columns, entity_etag, entity_version,
+    is_conditional, not_modified, pop_collection_version, set_validators
+)
 
 router = APIRouter(prefix="/insurance", tags=["insurance"])
+patient_insurance_reads = single_flight("insurance.list_patient")
+# List responses honour fields=, so only insurance_id is guaranteed
+InsuranceFields = partial_model(Insurance, "insurance_id", "InsuranceFields")
+
+
+def _coverage_dates(insurance: InsuranceRecord) -> List[date]:
+    """Bounds of the plan years a policy can affect, for billing recomputes.
+
+    An open-ended policy covers every later treatment, including ones
+    already booked for future years, so its range has no upper bound.
+    """
+    return [insurance.coverage_start_date, insurance.coverage_end_date or date.max]
 
 
 @router.post("/", response_model=Insurance)
 async def create_insurance(
         insurance: InsuranceCreate,
+        request: Request,
         db: Session = Depends(get_db)
 ):
     """Create a new insurance record"""
-    db_insurance = Insurance(**insurance.dict())
+    audit_patient(request, insurance.patient_id)
+    db_insurance = InsuranceRecord(**insurance.dict())
     db.add(db_insurance)
+    db.flush()
+    changed = billing_engine.recompute_patient_years(db, db_insurance.patient_id, _coverage_dates(db_insurance))
     db.commit()
     db.refresh(db_insurance)
+    eligibility_service.invalidate(db_insurance.patient_id)
 
     # Send insurance event to Kafka
     await kafka_producer.send_insurance_event(
         "insurance-updates",
-        {"type": "new_insurance", "insurance_id": db_insurance.insurance_id}
+        {
+            "type": "new_insurance",
+            "insurance_id": db_insurance.insurance_id,
+            "patient_id": db_insurance.patient_id
+        }
     )
+    await publish_billing_changes(db, changed)
 
     return db_insurance
 
 
+@router.post("/eligibility")
+async def check_eligibility(
+        eligibility: EligibilityRequest,
+        request: Request,
+        db: Session = Depends(get_db)
+):
+    """Policies covering each (patient_id, date) pair, most recently started first"""
+    # Cache misses read the primary: a lagging replica would be cached for the full TTL
+    checks = [(check.patient_id, check.date) for check in eligibility.checks]
+    audit_patients(request, (patient_id for patient_id, _ in checks))
+    return FastJSONResponse(eligibility_service.check(db, checks))
+
+
+@router.get("/eligibility/stats")
+async def eligibility_stats():
+    """Eligibility cache counters for this process"""
+    return eligibility_service.stats()
+
+
 @router.get("/{insurance_id}", response_model=Insurance)
-async def get_insurance(insurance_id: int, db: Session = Depends(get_db)):
-    """Get insurance details by ID"""
-    insurance = db.query(Insurance).filter(Insurance.insurance_id == insurance_id).first()
+async def get_insurance(
+        insurance_id: int,
+        request: Request,
+        response: Response,
+        db: Session = Depends(get_read_db)
+):
+    """Get insurance details by ID; answers 304 when the client's ETag is current"""
+    version = entity_version(db, insurance_table, "insurance_id", insurance_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Insurance not found")
+    etag = entity_etag(insurance_id, version)
+    cached = not_modified(request, etag, version)
+    if cached:
+        return cached
+
+    insurance = db.query(InsuranceRecord).filter(InsuranceRecord.insurance_id == insurance_id).first()
     if not insurance:
         raise HTTPException(status_code=404, detail="Insurance not found")
+    audit_patient(request, insurance.patient_id)
+    set_validators(response, etag, version)
     return insurance
 
 
-@router.get("/patient/{patient_id}", response_model=List[Insurance])
+@router.get("/patient/{patient_id}", response_model=List[InsuranceFields])
 async def list_patient_insurance(
         patient_id: int,
+        request: Request,
         active_only: bool = False,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
-    """List all insurance records for a specific patient"""
-    query = db.query(Insurance).filter(Insurance.patient_id == patient_id)
+    """List all insurance records for a specific patient; fields= narrows the returned columns"""
+    i = insurance_table
+    criteria = [i.c.patient_id == patient_id]
 
     if active_only:
-        current_date = date.today()
-        query = query.filter(
-            Insurance.coverage_start_date <= current_date,
-            Insurance.coverage_end_date >= current_date
-        )
-
-    return query.all()
+        # Open-ended policies (no end date) count as active
+        criteria.append(i.c.coverage_period.contains(date.today()))
+
+    def etag_for(count, version):
+        # Which policies are active depends on the day, so the date is part of the ETag
+        return collection_etag(patient_id, count, version, active_only and date.today(), fields)
+
+    columns = select_columns(i, fields, "insurance_id")
+    conditional = is_conditional(request)
+    if conditional:
+        count, version = collection_version(db, i, *criteria)
+        etag = etag_for(count, version)
+        cached = not_modified(request, etag, version)
+        if cached:
+            return cached
+    else:
+        # Nothing to revalidate: read the validators off the rows themselves
+        columns += collection_version_columns(i)
+
+    query = select(*columns).where(*criteria).order_by(i.c.insurance_id)
+
+    def load():
+        # Own session: the load is shared and may outlive the leader's request
+        with sibling_session(db) as session:
+            policies = rows_to_dicts(session.execute(query))
+            if conditional:
+                return policies, None
+            return policies, pop_collection_version(policies) or (0, None)
+
+    # A conditional request's ETag covers the version and every parameter, so
+    # it is the coalescing key; otherwise share loads per parameters and
+    # connection (a client routed to the primary after a write never joins a
+    # replica load)
+    key = etag if conditional else (patient_id, active_only, fields, db.get_bind())
+    policies, validators = await patient_insurance_reads.do(key, lambda: run_blocking(load))
+    if not conditional:
+        count, version = validators
+        etag = etag_for(count, version)
+    response = FastJSONResponse(policies)
+    set_validators(response, etag, version)
+    return response
 
 
 @router.put("/{insurance_id}", response_model=Insurance)
 async def update_insurance(
         insurance_id: int,
         insurance_update: InsuranceUpdate,
+        request: Request,
         db: Session = Depends(get_db)
 ):
     """Update insurance information"""
-    db_insurance = db.query(Insurance).filter(Insurance.insurance_id == insurance_id).first()
+    db_insurance = db.query(InsuranceRecord).filter(InsuranceRecord.insurance_id == insurance_id).first()
     if not db_insurance:
         raise HTTPException(status_code=404, detail="Insurance not found")
+    audit_patient(request, db_insurance.patient_id)
+
+    changes = insurance_update.dict(exclude_unset=True)
+    try:
+        check_coverage_dates(
+            changes.get("coverage_start_date", db_insurance.coverage_start_date),
+            changes.get("coverage_end_date", db_insurance.coverage_end_date)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-    for field, value in insurance_update.dict(exclude_unset=True).items():
+    previous_dates = _coverage_dates(db_insurance)
+    for field, value in changes.items():
         setattr(db_insurance, field, value)
 
+    db.flush()
+    changed = billing_engine.recompute_patient_years(
+        db, db_insurance.patient_id, previous_dates + _coverage_dates(db_insurance)
+    )
     db.commit()
     db.refresh(db_insurance)
+    eligibility_service.invalidate(db_insurance.patient_id)
 
     # Send insurance update event to Kafka
     await kafka_producer.send_insurance_event(
         "insurance-updates",
-        {"type": "insurance_updated", "insurance_id": insurance_id}
+        {
+            "type": "insurance_updated",
+            "insurance_id": insurance_id,
+            "patient_id": db_insurance.patient_id
+        }
     )
+    await publish_billing_changes(db, changed)
 
     return db_insurance
 
 
 @router.delete("/{insurance_id}")
-async def delete_insurance(insurance_id: int, db: Session = Depends(get_db)):
+async def delete_insurance(insurance_id: int, request: Request, db: Session = Depends(get_db)):
     """Delete an insurance record"""
-    insurance = db.query(Insurance).filter(Insurance.insurance_id == insurance_id).first()
+    insurance = db.query(InsuranceRecord).filter(InsuranceRecord.insurance_id == insurance_id).first()
     if not insurance:
         raise HTTPException(status_code=404, detail="Insurance not found")
+    audit_patient(request, insurance.patient_id)
 
+    patient_id = insurance.patient_id
+    coverage_dates = _coverage_dates(insurance)
     db.delete(insurance)
+    db.flush()
+    changed = billing_engine.recompute_patient_years(db, patient_id, coverage_dates)
     db.commit()
+    eligibility_service.invalidate(patient_id)
 
     # Send insurance deletion event to Kafka
     await kafka_producer.send_insurance_event(
         "insurance-updates",
-        {"type": "insurance_deleted", "insurance_id": insurance_id}
+        {"type": "insurance_deleted", "insurance_id": insurance_id, "patient_id": patient_id}
     )
+    await publish_billing_changes(db, changed)
 
     return {"message": "Insurance record deleted successfully"}
\ No newline at end of file
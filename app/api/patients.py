@@ -1,51 +1,124 @@
 # app/api/patients.py
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request, Response
+from sqlalchemy import or_, select
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import date
 
 from ..models.patient import Patient, PatientCreate, PatientUpdate, PatientInDB
-from ..services.database import get_db
-from ..services.s3_service import S3Service
+from ..models.document import PatientDocumentInDB
+from ..models.patient_activity import PatientActivityInDB, patient_activity_table
+from ..services.database import get_db, get_read_db, sibling_session
+from ..services import document_store
+from ..services.encryption import get_field_encryptor
+from ..services.single_flight import run_blocking, single_flight
+from ..services.audit import audit_patient, audit_patients
+from .serialization import FastJSONResponse, partial_model, rows_to_dicts, select_columns
+from .caching import (
+    collection_etag, collection_version, collection_version_columns, entity_etag, entity_version,
+    is_conditional, not_modified, pop_collection_version, set_validators
+)
 
 router = APIRouter(prefix="/patients", tags=["patients"])
-s3_service = S3Service()
+patient_reads = single_flight("patients.get")
+# List responses honour fields=, so only patient_id is guaranteed
+PatientFields = partial_model(PatientInDB, "patient_id", "PatientFields")
 
 
 @router.post("/", response_model=PatientInDB)
-async def create_patient(patient: PatientCreate, db: Session = Depends(get_db)):
+async def create_patient(patient: PatientCreate, request: Request, db: Session = Depends(get_db)):
     """Create a new patient record"""
     db_patient = Patient(**patient.dict())
     db.add(db_patient)
     db.commit()
     db.refresh(db_patient)
+    audit_patient(request, db_patient.patient_id)
     return db_patient
 
 
 @router.get("/{patient_id}", response_model=PatientInDB)
-async def get_patient(patient_id: int, db: Session = Depends(get_db)):
-    """Get patient details by ID"""
-    patient = db.query(Patient).filter(Patient.patient_id == patient_id).first()
+async def get_patient(
+        patient_id: int,
+        request: Request,
+        response: Response,
+        db: Session = Depends(get_read_db)
+):
+    """Get patient details by ID; answers 304 when the client's ETag is current"""
+    version = entity_version(db, Patient.__table__, "patient_id", patient_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    etag = entity_etag(patient_id, version)
+    cached = not_modified(request, etag, version)
+    if cached:
+        return cached
+
+    def load():
+        # Own session: the load is shared and may outlive the leader's request
+        with sibling_session(db) as session:
+            patient = session.query(Patient).filter(Patient.patient_id == patient_id).first()
+            # Detached from the session before other requests share it
+            return PatientInDB.model_validate(patient) if patient else None
+
+    # Concurrent check-ins of the same patient share one query; the ETag in
+    # the key keeps requests that saw different versions apart
+    patient = await patient_reads.do((patient_id, etag), lambda: run_blocking(load))
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
+    set_validators(response, etag, version)
     return patient
 
 
-@router.get("/", response_model=List[PatientInDB])
+@router.get("/", response_model=List[PatientFields])
 async def list_patients(
+        request: Request,
         skip: int = 0,
         limit: int = 100,
         search: Optional[str] = None,
-        db: Session = Depends(get_db)
+        email: Optional[str] = None,
+        phone: Optional[str] = None,
+        fields: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
-    """List all patients with optional search"""
-    query = db.query(Patient)
+    """List all patients with optional search; fields= narrows the returned columns"""
+    patients = Patient.__table__
+    encryptor = get_field_encryptor()
+    criteria = []
+    # Encrypted fields are matched exactly through their blind indexes
+    if email:
+        criteria.append(patients.c.email_bidx == encryptor.blind_index(email, "email"))
+    if phone:
+        criteria.append(patients.c.phone_bidx == encryptor.blind_index(phone, "phone"))
     if search:
-        query = query.filter(
-            Patient.first_name.ilike(f"%{search}%") |
-            Patient.last_name.ilike(f"%{search}%")
-        )
-    return query.offset(skip).limit(limit).all()
+        criteria.append(or_(
+            patients.c.first_name.ilike(f"%{search}%"),
+            patients.c.last_name.ilike(f"%{search}%")
+        ))
+
+    def etag_for(count, version):
+        return collection_etag(count, version, search, email, phone, skip, limit, fields)
+
+    columns = select_columns(patients, fields, "patient_id")
+    conditional = is_conditional(request)
+    if conditional:
+        count, version = collection_version(db, patients, *criteria)
+        etag = etag_for(count, version)
+        cached = not_modified(request, etag, version)
+        if cached:
+            return cached
+    else:
+        # Nothing to revalidate: read the validators off the page itself
+        columns += collection_version_columns(patients)
+
+    query = select(*columns).where(*criteria)
+    query = query.order_by(patients.c.patient_id).offset(skip).limit(limit)
+    rows = rows_to_dicts(db.execute(query), patients)
+    if not conditional:
+        count, version = pop_collection_version(rows) or collection_version(db, patients, *criteria)
+        etag = etag_for(count, version)
+    audit_patients(request, (row["patient_id"] for row in rows))
+    response = FastJSONResponse(rows)
+    set_validators(response, etag, version)
+    return response
 
 
 @router.put("/{patient_id}", response_model=PatientInDB)
@@ -82,13 +155,77 @@ async def upload_patient_image(
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
-    image_key = await s3_service.store_patient_image(
-        patient_id=patient_id,
-        image_file=file.file,
-        image_type=image_type
-    )
+    # Content-addressed: an identical image is referenced, not uploaded again.
+    # Only the S3 work runs on a thread; the session stays on this one.
+    staged = await run_blocking(document_store.stage, file.file, 'image/jpeg')
+    try:
+        image = document_store.add_reference(db, patient_id, staged, "image", image_type, file.filename)
+        db.commit()
+    except Exception:
+        document_store.discard(staged)
+        raise
+    await run_blocking(document_store.settle, staged)
+
+    return {
+        "message": "Image uploaded successfully",
+        "image_key": image["s3_key"],
+        "document_id": image["document_id"],
+        "deduplicated": image["deduplicated"]
+    }
+
+
+@router.post("/{patient_id}/documents", response_model=PatientDocumentInDB)
+async def upload_patient_document(
+        patient_id: int,
+        document_type: str,
+        file: UploadFile = File(...),
+        db: Session = Depends(get_db)
+):
+    """Upload a patient document (insurance card, consent form, ...)"""
+    patient = db.query(Patient).filter(Patient.patient_id == patient_id).first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    staged = await run_blocking(document_store.stage, file.file, file.content_type)
+    try:
+        document = document_store.add_reference(db, patient_id, staged, "document", document_type, file.filename)
+        db.commit()
+    except Exception:
+        document_store.discard(staged)
+        raise
+    await run_blocking(document_store.settle, staged)
+    return document
+
+
+@router.get("/{patient_id}/documents", response_model=List[PatientDocumentInDB])
+async def list_patient_documents(
+        patient_id: int,
+        category: Optional[str] = None,
+        db: Session = Depends(get_read_db)
+):
+    """List a patient's documents and images"""
+    return document_store.list_documents(db, patient_id, category)
+
+
+@router.delete("/{patient_id}/documents/{document_id}")
+async def delete_patient_document(patient_id: int, document_id: int, db: Session = Depends(get_db)):
+    """Remove a document from the patient; the stored file goes once nothing references it"""
+    if not document_store.release(db, patient_id, document_id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    db.commit()
+    return {"message": "Document deleted successfully"}
+
 
-    return {"message": "Image uploaded successfully", "image_key": image_key}
+@router.get("/{patient_id}/activity", response_model=PatientActivityInDB)
+async def get_patient_activity(patient_id: int, request: Request, db: Session = Depends(get_read_db)):
+    """Treatment event counters for a patient"""
+    audit_patient(request, patient_id)
+    row = db.execute(
+        select(patient_activity_table).where(patient_activity_table.c.patient_id == patient_id)
+    ).first()
+    if row is None:
+        return PatientActivityInDB(patient_id=patient_id)
+    return row
 
 
 @router.delete("/{patient_id}")
@@ -98,6 +235,7 @@ async def delete_patient(patient_id: int, db: Session = Depends(get_db)):
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
+    document_store.release_patient(db, patient_id)
     db.delete(patient)
     db.commit()
     return {"message": "Patient deleted successfully"}
\ No newline at end of file
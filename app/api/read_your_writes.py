@@ -0,0 +1,37 @@
+# app/api/read_your_writes.py
+import math
+
+from ..services.database import READ_YOUR_WRITES_COOKIE, READ_YOUR_WRITES_SECONDS
+
+
+class ReadYourWritesMiddleware:
+    """Hand a client that just wrote a short-lived cookie pinning its reads to the primary.
+
+    The in-process writer map only covers the worker that took the write;
+    the cookie comes back on the next request whichever worker or host
+    serves it. Plain ASGI, like AuditMiddleware.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_age = math.ceil(READ_YOUR_WRITES_SECONDS)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or READ_YOUR_WRITES_SECONDS <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        # Commit hooks record the deadline on request.state, which lives here
+        state = scope.setdefault("state", {})
+
+        async def send_with_cookie(message):
+            until = state.get("read_your_writes_until")
+            if message["type"] == "http.response.start" and until:
+                cookie = (
+                    f"{READ_YOUR_WRITES_COOKIE}={until:.3f}; Max-Age={self.max_age}; "
+                    f"Path=/; HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = [*message.get("headers", []), (b"set-cookie", cookie.encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
@@ -0,0 +1,170 @@
+# app/api/serialization.py
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, create_model
+from sqlalchemy import Column, Table, Text, type_coerce
+from typing import Any, Dict, Iterable, List, Optional, Type
+from decimal import Decimal
+import orjson
+
+from ..services.encryption import EncryptedString, get_field_encryptor
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson; handles dates, enums and Decimals"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def partial_model(model: Type[BaseModel], key: str, name: str) -> Type[BaseModel]:
+    """Response schema for endpoints that honour fields=.
+
+    The key is always present; every other field may be left out. Those
+    endpoints return FastJSONResponse directly, which FastAPI passes through
+    without validating, so this model only documents the response in the
+    OpenAPI schema and has to describe what fields= can actually produce.
+    """
+    fields = {
+        field: (info.annotation, ...) if field == key else (Optional[info.annotation], None)
+        for field, info in model.model_fields.items()
+    }
+    return create_model(name, **fields)
+
+
+def _is_encrypted(column: Column) -> bool:
+    return isinstance(column.type, EncryptedString)
+
+
+def _selectable(column: Column):
+    # Encrypted columns come back as stored so rows_to_dicts can decrypt them in bulk
+    if _is_encrypted(column):
+        return type_coerce(column, Text).label(column.name)
+    return column
+
+
+def select_columns(
+        table: Table,
+        fields: Optional[str],
+        key: str,
+        extra: Iterable[str] = ()
+) -> List[Column]:
+    """Resolve a comma-separated fields= parameter to table columns.
+
+    The key column is always included. Names listed in extra are accepted
+    but are not table columns (the caller loads them separately). Columns
+    marked info={"hidden": True} are never exposed.
+    """
+    visible = {column.name: column for column in table.columns if not column.info.get("hidden")}
+    if not fields:
+        return [_selectable(column) for column in visible.values()]
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in visible and name not in extra]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    names = [key] + [name for name in requested if name != key and name in visible]
+    return [_selectable(visible[name]) for name in dict.fromkeys(names)]
+
+
+def wants_field(fields: Optional[str], name: str) -> bool:
+    """Whether a fields= parameter asks for name (everything when unset)"""
+    if not fields:
+        return True
+    return name in {field.strip() for field in fields.split(",")}
+
+
+def rows_to_dicts(result, table: Optional[Table] = None) -> List[Dict[str, Any]]:
+    """Map Core result rows straight to dicts without ORM or Pydantic.
+
+    Pass the table when the rows came from select_columns so that
+    encrypted columns are decrypted, one batch per column.
+    """
+    keys = list(result.keys())
+    rows = [dict(zip(keys, row)) for row in result]
+    if table is None or not rows:
+        return rows
+    encryptor = get_field_encryptor()
+    for name in keys:
+        column = table.columns.get(name)
+        if column is None or not _is_encrypted(column):
+            continue
+        values = encryptor.decrypt_many([row[name] for row in rows], column.type.field)
+        for row, value in zip(rows, values):
+            row[name] = value
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import time
+    from datetime import date, datetime, timedelta
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import TypeAdapter
+
+    from ..models.treatment import Treatment, TreatmentRecord, treatments_table
+
+    parser = argparse.ArgumentParser(
+        description="Compare ORM + Pydantic + JSONResponse with Core rows + orjson for one list page"
+    )
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    class _Result:
+        """Stand-in for a Core result over plain column values"""
+
+        def __init__(self, keys, rows):
+            self._keys = keys
+            self._rows = rows
+
+        def keys(self):
+            return self._keys
+
+        def __iter__(self):
+            return iter(self._rows)
+
+    now = datetime.now()
+    values = [
+        {
+            "treatment_id": i,
+            "patient_id": i // 10,
+            "treatment_date": date(2024, 1, 1) + timedelta(days=i % 365),
+            "diagnosis": "Hypertension",
+            "treatment_description": "Blood pressure check and medication review",
+            "provider_notes": "Patient reports improved adherence",
+            "cost": Decimal("125.50"),
+            "insurance_coverage": Decimal("100.40"),
+            "patient_responsibility": Decimal("25.10"),
+            "follow_up_date": date(2024, 3, 1),
+            "created_at": now,
+            "updated_at": None
+        }
+        for i in range(args.rows)
+    ]
+    keys = [column.name for column in treatments_table.columns]
+    records = [TreatmentRecord(**row) for row in values]
+    tuples = [tuple(row[key] for key in keys) for row in values]
+    adapter = TypeAdapter(List[Treatment])
+
+    def before() -> bytes:
+        # What FastAPI does with response_model: validate, encode, json.dumps
+        content = jsonable_encoder(adapter.validate_python(records, from_attributes=True))
+        return JSONResponse(content).body
+
+    def after() -> bytes:
+        return FastJSONResponse(rows_to_dicts(_Result(keys, tuples))).body
+
+    assert len(json.loads(before())) == len(json.loads(after())) == args.rows
+    for label, render in (("orm+pydantic+json", before), ("core+orjson", after)):
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            size = len(render())
+        elapsed = (time.perf_counter() - started) / args.repeat
+        print(f"{label:>18}: {elapsed * 1000:8.2f} ms per {args.rows}-row page, {size} bytes")
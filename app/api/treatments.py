@@ -1,101 +1,257 @@
 # app/api/treatments.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from datetime import date
 
-from ..models.treatment import Treatment, TreatmentCreate, TreatmentUpdate
-from ..services.database import get_db
-from ..services import kafka_producer
+from ..models.treatment import (
+    Treatment, TreatmentCreate, TreatmentUpdate, TreatmentRecord, treatments_table, patient_images_table
+)
+from ..services.database import get_db, get_read_db, sibling_session
+from ..services import kafka_producer, billing_engine
+from ..services.kafka_producer import treatment_event_payload
+from ..services.single_flight import run_blocking, single_flight
+from ..services.audit import audit_patient
+from .serialization import FastJSONResponse, partial_model, rows_to_dicts, select_columns, wants_field
+from .caching import (
+    collection_etag, collection_version, collection_version_columns, entity_version, is_conditional, latest,
+    not_modified, pop_collection_version, set_validators
+)
 
 router = APIRouter(prefix="/treatments", tags=["treatments"])
+patient_treatment_reads = single_flight("treatments.list_patient")
+# List responses honour fields=, so only treatment_id is guaranteed
+TreatmentFields = partial_model(Treatment, "treatment_id", "TreatmentFields")
+
+
+async def publish_billing_changes(db: Session, treatment_ids: List[int]):
+    """Send treatment_updated for rows whose amounts the billing engine changed"""
+    if not treatment_ids:
+        return
+    changed = db.query(TreatmentRecord).filter(TreatmentRecord.treatment_id.in_(treatment_ids)).all()
+    for treatment in changed:
+        await kafka_producer.send_treatment_event(
+            "treatment-events",
+            treatment_event_payload("treatment_updated", treatment)
+        )
+
+
+def _images_version_query(*aggregates, criteria):
+    i = patient_images_table
+    return select(*aggregates) \
+        .select_from(i.join(treatments_table, i.c.treatment_id == treatments_table.c.treatment_id)) \
+        .where(*criteria)
+
+
+def _images_version(db: Session, *criteria):
+    """Count and latest upload time of the images attached to matching treatments"""
+    i = patient_images_table
+    return db.execute(_images_version_query(func.count(), func.max(i.c.uploaded_at), criteria=criteria)).one()
+
+
+def _images_version_columns(*criteria):
+    """_images_version as scalar subqueries to add to a page query"""
+    i = patient_images_table
+    # Uncorrelated: the page query also selects from treatments
+    count = _images_version_query(func.count(), criteria=criteria).correlate(None)
+    uploaded = _images_version_query(func.max(i.c.uploaded_at), criteria=criteria).correlate(None)
+    return count.scalar_subquery().label("_images_count"), uploaded.scalar_subquery().label("_images_uploaded")
 
 
 @router.post("/", response_model=Treatment)
 async def create_treatment(
         treatment: TreatmentCreate,
+        request: Request,
         db: Session = Depends(get_db)
 ):
     """Create a new treatment record"""
-    db_treatment = Treatment(**treatment.dict())
+    audit_patient(request, treatment.patient_id)
+    db_treatment = TreatmentRecord(**treatment.dict())
     db.add(db_treatment)
+    db.flush()
+    # Coverage is derived from the patient's policies; a backdated visit can
+    # also shift the deductible for later visits in the same year
+    changed = billing_engine.recompute_patient_years(db, db_treatment.patient_id, [db_treatment.treatment_date])
     db.commit()
     db.refresh(db_treatment)
 
     # Send treatment event to Kafka
     await kafka_producer.send_treatment_event(
         "treatment-events",
-        {"type": "new_treatment", "treatment_id": db_treatment.treatment_id}
+        treatment_event_payload("new_treatment", db_treatment)
     )
+    await publish_billing_changes(db, [t for t in changed if t != db_treatment.treatment_id])
 
     return db_treatment
 
 
 @router.get("/{treatment_id}", response_model=Treatment)
-async def get_treatment(treatment_id: int, db: Session = Depends(get_db)):
-    """Get treatment details by ID"""
-    treatment = db.query(Treatment).filter(Treatment.treatment_id == treatment_id).first()
+async def get_treatment(
+        treatment_id: int,
+        request: Request,
+        response: Response,
+        db: Session = Depends(get_read_db)
+):
+    """Get treatment details by ID; answers 304 when the client's ETag is current"""
+    version = entity_version(db, treatments_table, "treatment_id", treatment_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Treatment not found")
+    images_count, images_uploaded = _images_version(db, treatments_table.c.treatment_id == treatment_id)
+    version = latest(version, images_uploaded)
+    etag = collection_etag(treatment_id, version, images_count)
+    cached = not_modified(request, etag, version)
+    if cached:
+        return cached
+
+    treatment = db.query(TreatmentRecord).filter(TreatmentRecord.treatment_id == treatment_id).first()
     if not treatment:
         raise HTTPException(status_code=404, detail="Treatment not found")
+    audit_patient(request, treatment.patient_id)
+    set_validators(response, etag, version)
     return treatment
 
 
-@router.get("/patient/{patient_id}", response_model=List[Treatment])
+@router.get("/patient/{patient_id}", response_model=List[TreatmentFields])
 async def list_patient_treatments(
         patient_id: int,
+        request: Request,
         skip: int = 0,
         limit: int = 100,
-        db: Session = Depends(get_db)
+        fields: Optional[str] = None,
+        db: Session = Depends(get_read_db)
 ):
-    """List all treatments for a specific patient"""
-    treatments = db.query(Treatment) \
-        .filter(Treatment.patient_id == patient_id) \
+    """List all treatments for a specific patient; fields= narrows the returned columns"""
+    t = treatments_table
+    criteria = (t.c.patient_id == patient_id,)
+    with_images = wants_field(fields, "images")
+
+    def versions(db: Session):
+        count, version = collection_version(db, t, *criteria)
+        images_count, images_uploaded = _images_version(db, *criteria) if with_images else (0, None)
+        return count, images_count, latest(version, images_uploaded)
+
+    def etag_for(count, images_count, version):
+        return collection_etag(patient_id, count, images_count, version, skip, limit, fields)
+
+    columns = select_columns(t, fields, "treatment_id", extra=("images",))
+    conditional = is_conditional(request)
+    if conditional:
+        count, images_count, version = versions(db)
+        etag = etag_for(count, images_count, version)
+        cached = not_modified(request, etag, version)
+        if cached:
+            return cached
+    else:
+        # Nothing to revalidate: read the validators off the page itself
+        columns += collection_version_columns(t)
+        if with_images:
+            columns += _images_version_columns(*criteria)
+
+    query = select(*columns) \
+        .where(*criteria) \
+        .order_by(t.c.treatment_id) \
         .offset(skip) \
-        .limit(limit) \
-        .all()
-    return treatments
+        .limit(limit)
+
+    def page_versions(session: Session, treatments):
+        images = (0, None)
+        if with_images and treatments:
+            images = treatments[0]["_images_count"], treatments[0]["_images_uploaded"]
+            for treatment in treatments:
+                del treatment["_images_count"], treatment["_images_uploaded"]
+        collection = pop_collection_version(treatments)
+        if collection is None:
+            return versions(session)
+        return collection[0], images[0], latest(collection[1], images[1])
+
+    def load():
+        # Own session: the load is shared and may outlive the leader's request
+        with sibling_session(db) as session:
+            treatments = rows_to_dicts(session.execute(query), t)
+            validators = None if conditional else page_versions(session, treatments)
+            if with_images and treatments:
+                # One query for the whole page instead of one lazy load per treatment
+                images_by_treatment = {treatment["treatment_id"]: [] for treatment in treatments}
+                images = session.execute(
+                    select(patient_images_table)
+                    .where(patient_images_table.c.treatment_id.in_(list(images_by_treatment)))
+                    .order_by(patient_images_table.c.image_id)
+                )
+                for image in rows_to_dicts(images):
+                    images_by_treatment[image["treatment_id"]].append(image)
+                for treatment in treatments:
+                    treatment["images"] = images_by_treatment[treatment["treatment_id"]]
+        return treatments, validators
+
+    # A conditional request's ETag covers the version and every parameter, so
+    # it is the coalescing key; otherwise share loads per parameters and
+    # connection (a client routed to the primary after a write never joins a
+    # replica load)
+    key = etag if conditional else (patient_id, skip, limit, fields, db.get_bind())
+    treatments, validators = await patient_treatment_reads.do(key, lambda: run_blocking(load))
+    if not conditional:
+        count, images_count, version = validators
+        etag = etag_for(count, images_count, version)
+    response = FastJSONResponse(treatments)
+    set_validators(response, etag, version)
+    return response
 
 
 @router.put("/{treatment_id}", response_model=Treatment)
 async def update_treatment(
         treatment_id: int,
         treatment_update: TreatmentUpdate,
+        request: Request,
         db: Session = Depends(get_db)
 ):
     """Update treatment information"""
-    db_treatment = db.query(Treatment).filter(Treatment.treatment_id == treatment_id).first()
+    db_treatment = db.query(TreatmentRecord).filter(TreatmentRecord.treatment_id == treatment_id).first()
     if not db_treatment:
         raise HTTPException(status_code=404, detail="Treatment not found")
+    audit_patient(request, db_treatment.patient_id)
 
+    previous_date = db_treatment.treatment_date
     for field, value in treatment_update.dict(exclude_unset=True).items():
         setattr(db_treatment, field, value)
 
+    db.flush()
+    changed = billing_engine.recompute_patient_years(
+        db, db_treatment.patient_id, [previous_date, db_treatment.treatment_date]
+    )
     db.commit()
     db.refresh(db_treatment)
 
     # Send treatment update event to Kafka
     await kafka_producer.send_treatment_event(
         "treatment-events",
-        {"type": "treatment_updated", "treatment_id": treatment_id}
+        treatment_event_payload("treatment_updated", db_treatment)
     )
+    await publish_billing_changes(db, [t for t in changed if t != treatment_id])
 
     return db_treatment
 
 
 @router.delete("/{treatment_id}")
-async def delete_treatment(treatment_id: int, db: Session = Depends(get_db)):
+async def delete_treatment(treatment_id: int, request: Request, db: Session = Depends(get_db)):
     """Delete a treatment record"""
-    treatment = db.query(Treatment).filter(Treatment.treatment_id == treatment_id).first()
+    treatment = db.query(TreatmentRecord).filter(TreatmentRecord.treatment_id == treatment_id).first()
     if not treatment:
         raise HTTPException(status_code=404, detail="Treatment not found")
+    audit_patient(request, treatment.patient_id)
 
+    patient_id = treatment.patient_id
+    treatment_date = treatment.treatment_date
     db.delete(treatment)
+    db.flush()
+    changed = billing_engine.recompute_patient_years(db, patient_id, [treatment_date])
     db.commit()
 
     # Send treatment deletion event to Kafka
     await kafka_producer.send_treatment_event(
         "treatment-events",
-        {"type": "treatment_deleted", "treatment_id": treatment_id}
+        {"type": "treatment_deleted", "treatment_id": treatment_id, "patient_id": patient_id}
     )
+    await publish_billing_changes(db, changed)
 
     return {"message": "Treatment deleted successfully"}
\ No newline at end of file
@@ -1,8 +1,15 @@
 # app/main.py
+import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .api import router as api_router
 from .services.database import init_db
+from .api.audit import AuditMiddleware
+from .api.read_your_writes import ReadYourWritesMiddleware
+from .services import (
+    event_broadcaster, treatment_analytics, follow_up_scheduler, eligibility_service, audit_log,
+    patient_activity
+)
 
 app = FastAPI(
     title="Healthcare POS API",
@@ -19,12 +26,85 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Every request to a PHI route is recorded in the audit log
+app.add_middleware(AuditMiddleware, audit_log=audit_log)
+
+# Clients that just wrote read from the primary on every worker, not only this one
+app.add_middleware(ReadYourWritesMiddleware)
+
 # Initialize database tables
 init_db()
 
 # Include routers
 app.include_router(api_router, prefix="/api/v1")
 
+
+@app.on_event("startup")
+async def start_realtime_events():
+    await event_broadcaster.start()
+
+
+@app.on_event("shutdown")
+def stop_realtime_events():
+    event_broadcaster.stop()
+
+
+@app.on_event("startup")
+def start_audit_log():
+    audit_log.start()
+
+
+@app.on_event("shutdown")
+def stop_audit_log():
+    audit_log.stop()
+
+
+@app.on_event("startup")
+async def start_eligibility_cache():
+    await eligibility_service.start()
+
+
+@app.on_event("shutdown")
+def stop_eligibility_cache():
+    eligibility_service.stop()
+
+
+@app.on_event("startup")
+async def start_analytics():
+    treatment_analytics.load_checkpoint()
+    await treatment_analytics.start()
+
+
+@app.on_event("shutdown")
+def stop_analytics():
+    treatment_analytics.stop()
+
+
+@app.on_event("startup")
+async def start_patient_activity():
+    await patient_activity.start()
+
+
+@app.on_event("shutdown")
+def stop_patient_activity():
+    patient_activity.stop()
+
+
+# Several instances may run the scheduler; they split the work by treatment_id
+FOLLOW_UP_SCHEDULER_ENABLED = os.getenv("FOLLOW_UP_SCHEDULER_ENABLED", "true").lower() == "true"
+
+
+@app.on_event("startup")
+async def start_follow_up_scheduler():
+    if FOLLOW_UP_SCHEDULER_ENABLED:
+        await follow_up_scheduler.start()
+
+
+@app.on_event("shutdown")
+def stop_follow_up_scheduler():
+    follow_up_scheduler.stop()
+
+
 @app.get("/")
 async def root():
     return {"message": "Healthcare POS API is running"}
@@ -1,7 +1,13 @@
 # app/models/__init__.py
 from .patient import Patient, PatientCreate, PatientUpdate
-from .treatment import Treatment, TreatmentCreate, TreatmentUpdate, PatientImage
-from .insurance import Insurance, InsuranceCreate, InsuranceUpdate
+from .treatment import (
+    Treatment, TreatmentCreate, TreatmentUpdate, PatientImage, TreatmentRecord, PatientImageRecord
+)
+from .insurance import Insurance, InsuranceCreate, InsuranceUpdate, InsuranceRecord
+from .reminder import FollowUpNotification
+from .consumer_offset import ConsumerOffset
+from .document import DocumentBlob, PatientDocument, PatientDocumentInDB
+from .patient_activity import PatientActivity, PatientActivityInDB
 
 # Import all models for database creation
 __all__ = [
@@ -12,7 +18,17 @@ __all__ = [
     "TreatmentCreate",
     "TreatmentUpdate",
     "PatientImage",
+    "TreatmentRecord",
+    "PatientImageRecord",
     "Insurance",
     "InsuranceCreate",
-    "InsuranceUpdate"
+    "InsuranceUpdate",
+    "InsuranceRecord",
+    "FollowUpNotification",
+    "ConsumerOffset",
+    "DocumentBlob",
+    "PatientDocument",
+    "PatientDocumentInDB",
+    "PatientActivity",
+    "PatientActivityInDB"
 ]
\ No newline at end of file
@@ -0,0 +1,19 @@
+# app/models/consumer_offset.py
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+from sqlalchemy.sql import func
+
+from ..services.database import Base
+
+# SQLAlchemy Model
+class ConsumerOffset(Base):
+    """Next Kafka offset to consume, committed with the handler's writes"""
+    __tablename__ = "kafka_consumer_offsets"
+
+    group_id = Column(String(200), primary_key=True)
+    topic = Column(String(200), primary_key=True)
+    partition = Column(Integer, primary_key=True)
+    next_offset = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<ConsumerOffset {self.group_id} {self.topic}[{self.partition}]={self.next_offset}>"
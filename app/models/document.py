@@ -0,0 +1,70 @@
+# app/models/document.py
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.sql import func
+from pydantic import BaseModel, ConfigDict
+from typing import Optional
+from datetime import datetime
+
+from ..services.database import Base
+
+# SQLAlchemy Models
+class DocumentBlob(Base):
+    """One stored object per distinct content, keyed by its SHA-256"""
+    __tablename__ = "document_blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    s3_key = Column(String(200), nullable=False)
+    size_bytes = Column(BigInteger, nullable=False)
+    content_type = Column(String(100))
+    # Number of patient_documents rows pointing here
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Set when ref_count drops to zero; reclaimed after a grace period
+    orphaned_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index("ix_document_blobs_orphaned_at", "orphaned_at", postgresql_where=ref_count == 0),
+    )
+
+    def __repr__(self):
+        return f"<DocumentBlob {self.sha256[:12]} refs={self.ref_count}>"
+
+
+class PatientDocument(Base):
+    """A patient's reference to a stored blob"""
+    __tablename__ = "patient_documents"
+
+    document_id = Column(Integer, primary_key=True, index=True)
+    patient_id = Column(Integer, ForeignKey("patients.patient_id"), nullable=False)
+    category = Column(String(20), nullable=False)  # 'document' or 'image'
+    document_type = Column(String(50), nullable=False)
+    sha256 = Column(String(64), ForeignKey("document_blobs.sha256"), nullable=False, index=True)
+    filename = Column(String(200))
+    uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Uploading the same content again for the same slot is a no-op
+        UniqueConstraint("patient_id", "category", "document_type", "sha256", name="uq_patient_documents_content"),
+    )
+
+    def __repr__(self):
+        return f"<PatientDocument {self.document_id} for Patient {self.patient_id}>"
+
+document_blobs_table = DocumentBlob.__table__
+patient_documents_table = PatientDocument.__table__
+
+# Pydantic Models for API
+class PatientDocumentInDB(BaseModel):
+    document_id: int
+    patient_id: int
+    category: str
+    document_type: str
+    sha256: str
+    s3_key: str
+    size_bytes: int
+    content_type: Optional[str] = None
+    filename: Optional[str] = None
+    uploaded_at: Optional[datetime] = None
+    deduplicated: bool = False
+
+    model_config = ConfigDict(from_attributes=True)
@@ -1,9 +1,10 @@
 # app/models/insurance.py
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey
+from sqlalchemy import CheckConstraint, Column, Computed, Integer, String, Date, DateTime, ForeignKey, Index, Numeric
+from sqlalchemy.dialects.postgresql import DATERANGE
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
 from datetime import date, datetime
 
 from ..services.database import Base
@@ -21,15 +22,50 @@ class Insurance(Base):
     subscriber_relationship = Column(String(50))
     coverage_start_date = Column(Date, nullable=False)
     coverage_end_date = Column(Date)
+    # Billing rules, per plan (calendar) year; NULL caps mean unlimited
+    deductible = Column(Numeric(10, 2), nullable=False, default=0, server_default="0")
+    copay = Column(Numeric(10, 2), nullable=False, default=0, server_default="0")
+    coinsurance_rate = Column(Numeric(5, 4), nullable=False, default=0, server_default="0")
+    out_of_pocket_max = Column(Numeric(10, 2))
+    annual_benefit_max = Column(Numeric(10, 2))
+    # Inclusive coverage interval; a NULL end date leaves it open-ended
+    coverage_period = Column(
+        DATERANGE,
+        Computed("daterange(coverage_start_date, coverage_end_date, '[]')", persisted=True),
+        info={"hidden": True}
+    )
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # Relationships
     patient = relationship("Patient", back_populates="insurance_records")
 
+    __table_args__ = (
+        # "Which policy covers this patient on this date"; needs btree_gist for patient_id
+        Index("ix_insurance_patient_coverage", "patient_id", "coverage_period", postgresql_using="gist"),
+        # coverage_period's daterange() already fails on reversed dates; state
+        # the rule in the schema too, independent of the generated column
+        CheckConstraint(
+            "coverage_end_date IS NULL OR coverage_end_date >= coverage_start_date",
+            name="ck_insurance_coverage_dates"
+        ),
+    )
+
     def __repr__(self):
         return f"<Insurance {self.provider_name} for Patient {self.patient_id}>"
 
+# The Pydantic schema below reuses the name Insurance. Keep a strong reference
+# to the mapped class (the declarative registry only holds it weakly) and a
+# Core table handle.
+InsuranceRecord = Insurance
+insurance_table = Insurance.__table__
+
+def check_coverage_dates(start: Optional[date], end: Optional[date]):
+    """Reject a coverage period that ends before it starts"""
+    if start is not None and end is not None and end < start:
+        raise ValueError("coverage_end_date must not be before coverage_start_date")
+
+
 # Pydantic Models for API
 class InsuranceBase(BaseModel):
     patient_id: int
@@ -40,6 +76,16 @@ class InsuranceBase(BaseModel):
     subscriber_relationship: Optional[str] = None
     coverage_start_date: date
     coverage_end_date: Optional[date] = None
+    deductible: float = Field(0, ge=0)
+    copay: float = Field(0, ge=0)
+    coinsurance_rate: float = Field(0, ge=0, le=1)  # patient share after the deductible
+    out_of_pocket_max: Optional[float] = Field(None, ge=0)
+    annual_benefit_max: Optional[float] = Field(None, ge=0)
+
+    @model_validator(mode="after")
+    def coverage_dates_in_order(self):
+        check_coverage_dates(self.coverage_start_date, self.coverage_end_date)
+        return self
 
 class InsuranceCreate(InsuranceBase):
     pass
@@ -52,6 +98,17 @@ class InsuranceUpdate(BaseModel):
     subscriber_relationship: Optional[str] = None
     coverage_start_date: Optional[date] = None
     coverage_end_date: Optional[date] = None
+    deductible: Optional[float] = Field(None, ge=0)
+    copay: Optional[float] = Field(None, ge=0)
+    coinsurance_rate: Optional[float] = Field(None, ge=0, le=1)
+    out_of_pocket_max: Optional[float] = Field(None, ge=0)
+    annual_benefit_max: Optional[float] = Field(None, ge=0)
+
+    @model_validator(mode="after")
+    def coverage_dates_in_order(self):
+        # Only when both change; update_insurance checks against the stored dates
+        check_coverage_dates(self.coverage_start_date, self.coverage_end_date)
+        return self
 
 class Insurance(InsuranceBase):
     insurance_id: int
@@ -59,4 +116,13 @@ class Insurance(InsuranceBase):
     updated_at: Optional[datetime] = None
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class EligibilityCheck(BaseModel):
+    patient_id: int
+    date: date
+
+
+class EligibilityRequest(BaseModel):
+    checks: List[EligibilityCheck] = Field(..., max_length=10000)
@@ -1,5 +1,5 @@
 # app/models/patient.py
-from sqlalchemy import Column, Integer, String, Date, Enum, DateTime
+from sqlalchemy import Column, Integer, String, Date, Enum, DateTime, event
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from pydantic import BaseModel, EmailStr, ConfigDict
@@ -8,6 +8,7 @@ from datetime import date, datetime
 from enum import Enum as PyEnum
 
 from ..services.database import Base
+from ..services.encryption import EncryptedString, get_field_encryptor
 
 
 class Gender(str, PyEnum):
@@ -35,9 +36,12 @@ class Patient(Base):
     marital_status = Column(Enum(MaritalStatus))
     race = Column(String(50))
     occupation = Column(String(100))
-    email = Column(String(100), unique=True)
-    phone = Column(String(20))
-    address = Column(String(200))
+    # PHI is encrypted at rest; the *_bidx blind indexes serve equality lookups
+    email = Column(EncryptedString("email"))
+    phone = Column(EncryptedString("phone"))
+    address = Column(EncryptedString("address"))
+    email_bidx = Column(String(32), unique=True, info={"hidden": True})
+    phone_bidx = Column(String(32), index=True, info={"hidden": True})
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -49,6 +53,14 @@ class Patient(Base):
         return f"<Patient {self.first_name} {self.last_name}>"
 
 
+@event.listens_for(Patient, "before_insert")
+@event.listens_for(Patient, "before_update")
+def _set_blind_indexes(mapper, connection, target):
+    encryptor = get_field_encryptor()
+    target.email_bidx = encryptor.blind_index(target.email, "email")
+    target.phone_bidx = encryptor.blind_index(target.phone, "phone")
+
+
 # Pydantic Models for API
 class PatientBase(BaseModel):
     first_name: str
@@ -0,0 +1,34 @@
+# app/models/patient_activity.py
+from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy.sql import func
+from pydantic import BaseModel, ConfigDict
+from typing import Optional
+from datetime import datetime
+
+from ..services.database import Base
+
+# SQLAlchemy Model
+class PatientActivity(Base):
+    """Per-patient treatment counters projected from treatment-events"""
+    __tablename__ = "patient_activity"
+
+    patient_id = Column(Integer, primary_key=True)
+    treatments_created = Column(Integer, nullable=False, default=0, server_default="0")
+    treatments_updated = Column(Integer, nullable=False, default=0, server_default="0")
+    treatments_deleted = Column(Integer, nullable=False, default=0, server_default="0")
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PatientActivity {self.patient_id}>"
+
+patient_activity_table = PatientActivity.__table__
+
+# Pydantic Models for API
+class PatientActivityInDB(BaseModel):
+    patient_id: int
+    treatments_created: int = 0
+    treatments_updated: int = 0
+    treatments_deleted: int = 0
+    updated_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,20 @@
+# app/models/reminder.py
+from sqlalchemy import Column, Integer, String, Date, DateTime
+from sqlalchemy.sql import func
+
+from ..services.database import Base
+
+# SQLAlchemy Model
+class FollowUpNotification(Base):
+    """One row per follow-up reminder claimed by a scheduler instance"""
+    __tablename__ = "follow_up_notifications"
+
+    treatment_id = Column(Integer, primary_key=True)
+    follow_up_date = Column(Date, primary_key=True)
+    patient_id = Column(Integer, nullable=False)
+    claimed_by = Column(String(100), nullable=False)
+    claimed_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return f"<FollowUpNotification {self.treatment_id} on {self.follow_up_date}>"
@@ -1,5 +1,5 @@
 # app/models/treatment.py
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Numeric, Text
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Numeric, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from pydantic import BaseModel
@@ -7,6 +7,7 @@ from typing import Optional, List
 from datetime import date, datetime
 
 from ..services.database import Base
+from ..services.encryption import EncryptedString
 
 # SQLAlchemy Model
 class Treatment(Base):
@@ -17,7 +18,7 @@ class Treatment(Base):
     treatment_date = Column(Date, nullable=False)
     diagnosis = Column(Text, nullable=False)
     treatment_description = Column(Text, nullable=False)
-    provider_notes = Column(Text)
+    provider_notes = Column(EncryptedString("provider_notes"))
     cost = Column(Numeric(10, 2), nullable=False)
     insurance_coverage = Column(Numeric(10, 2))
     patient_responsibility = Column(Numeric(10, 2))
@@ -29,15 +30,26 @@ class Treatment(Base):
     patient = relationship("Patient", back_populates="treatments")
     images = relationship("PatientImage", back_populates="treatment")
 
+    __table_args__ = (
+        # Range scans over upcoming follow-ups, keyset-paginated by id
+        Index("ix_treatments_follow_up_date", "follow_up_date", "treatment_id"),
+    )
+
     def __repr__(self):
         return f"<Treatment {self.treatment_id} for Patient {self.patient_id}>"
 
+# The Pydantic schema below reuses the name Treatment. Keep a strong reference
+# to the mapped class (the declarative registry only holds it weakly) and a
+# Core table handle.
+TreatmentRecord = Treatment
+treatments_table = Treatment.__table__
+
 # SQLAlchemy Model for Patient Images
 class PatientImage(Base):
     __tablename__ = "patient_images"
 
     image_id = Column(Integer, primary_key=True, index=True)
-    treatment_id = Column(Integer, ForeignKey("treatments.treatment_id"), nullable=False)
+    treatment_id = Column(Integer, ForeignKey("treatments.treatment_id"), nullable=False, index=True)
     image_type = Column(String(20), nullable=False)  # 'before' or 'after'
     s3_key = Column(String(200), nullable=False)
     uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -45,6 +57,10 @@ class PatientImage(Base):
     # Relationship
     treatment = relationship("Treatment", back_populates="images")
 
+# The Pydantic schema below reuses the name PatientImage
+PatientImageRecord = PatientImage
+patient_images_table = PatientImage.__table__
+
 # Pydantic Models for API
 class TreatmentBase(BaseModel):
     patient_id: int
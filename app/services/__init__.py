@@ -1,19 +1,47 @@
 # app/services/__init__.py
-from .database import get_db, init_db, drop_db
+from .database import get_db, get_read_db, init_db, drop_db
 from .s3_service import S3Service
 from .kafka_producer import KafkaProducerService
 from .kafka_consumer import KafkaConsumerService
+from .event_broadcaster import EventBroadcaster
+from .analytics import TreatmentAnalytics
+from .reminder_scheduler import FollowUpScheduler
+from .eligibility import EligibilityService
+from .billing import BillingEngine
+from .archive import TreatmentArchive
+from .audit import AuditLog
+from .document_store import DocumentStore
+from .patient_activity import PatientActivityProjection
 
 # Initialize services
 s3_service = S3Service()
 kafka_producer = KafkaProducerService()
 kafka_consumer = KafkaConsumerService()
+event_broadcaster = EventBroadcaster(kafka_consumer)
+treatment_analytics = TreatmentAnalytics()
+follow_up_scheduler = FollowUpScheduler()
+eligibility_service = EligibilityService()
+billing_engine = BillingEngine()
+treatment_archive = TreatmentArchive(s3_service, kafka_producer)
+audit_log = AuditLog(s3_service)
+document_store = DocumentStore(s3_service)
+patient_activity = PatientActivityProjection()
 
 __all__ = [
     'get_db',
+    'get_read_db',
     'init_db',
     'drop_db',
     's3_service',
     'kafka_producer',
-    'kafka_consumer'
+    'kafka_consumer',
+    'event_broadcaster',
+    'treatment_analytics',
+    'follow_up_scheduler',
+    'eligibility_service',
+    'billing_engine',
+    'treatment_archive',
+    'audit_log',
+    'document_store',
+    'patient_activity'
 ]
\ No newline at end of file
@@ -0,0 +1,474 @@
+# app/services/analytics.py
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+from .database import SessionLocal
+from .kafka_consumer import KafkaConsumerService
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Day arrays are indexed by days since this date; treatments dated earlier
+# are rejected, counted and logged
+ORIGIN = date.fromisoformat(os.getenv("ANALYTICS_ORIGIN", "1900-01-01"))
+ORIGIN_ORDINAL = ORIGIN.toordinal()
+# Origin of checkpoints written before it was stored with them
+LEGACY_ORIGIN_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Money aggregates are kept in integer cents so long sums stay exact
+MONEY_ARRAYS = (
+    "daily_revenue", "daily_insurance", "daily_patient",
+    "diagnosis_revenue", "t_cost", "t_insurance", "t_patient"
+)
+
+
+def _grow(array: np.ndarray, size: int, fill=0) -> np.ndarray:
+    """Return array extended to at least size elements, doubling capacity"""
+    if size <= len(array):
+        return array
+    capacity = max(size, 2 * len(array), 1024)
+    grown = np.full(capacity, fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def _to_cents(amounts: np.ndarray) -> np.ndarray:
+    return np.rint(amounts * 100).astype(np.int64)
+
+
+def _dollars(cents) -> float:
+    return round(int(cents) / 100, 2)
+
+
+def _normalize_diagnosis(diagnosis: Optional[str]) -> str:
+    return " ".join((diagnosis or "").lower().split())
+
+
+class TreatmentAnalytics:
+    """Rolling treatment revenue and volume aggregates fed by treatment-events"""
+
+    def __init__(self, checkpoint_path: Optional[str] = None):
+        self.checkpoint_path = checkpoint_path or os.getenv(
+            "ANALYTICS_CHECKPOINT_PATH",
+            "data/analytics_checkpoint.npz"
+        )
+        self.checkpoint_interval = float(os.getenv("ANALYTICS_CHECKPOINT_SECONDS", "60"))
+        # Each worker process keeps its own full copy of the aggregates, so it
+        # needs its own consumer group; with no committed offsets it replays the
+        # topic from the start, which the per-treatment upsert makes idempotent.
+        # Retry and dead-letter topics are named per group, so this consumer
+        # does not use them: a new group each start would orphan them. Failed
+        # events are retried in process and the next replay reapplies them.
+        self.group_id = os.getenv(
+            "ANALYTICS_GROUP_ID",
+            f"analytics-{socket.gethostname()}-{os.getpid()}"
+        )
+        # Lanes for the key-ordered consumer; one patient's events stay in order
+        self.consumer_workers = int(os.getenv("ANALYTICS_CONSUMER_WORKERS", "4"))
+        self.consumer_service = KafkaConsumerService()
+        self.lock = threading.Lock()
+        self.last_checkpoint = time.monotonic()
+        self.task = None
+        # Treatments dated before ORIGIN, which the day arrays cannot hold
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        """Drop all aggregates"""
+        with self.lock:
+            # Per-day aggregates
+            self.daily_revenue = np.zeros(0, dtype=np.int64)
+            self.daily_insurance = np.zeros(0, dtype=np.int64)
+            self.daily_patient = np.zeros(0, dtype=np.int64)
+            self.daily_count = np.zeros(0, dtype=np.int64)
+            # Per-diagnosis aggregates
+            self.diagnosis_names: List[str] = []
+            self.diagnosis_index: Dict[str, int] = {}
+            self.diagnosis_count = np.zeros(0, dtype=np.int64)
+            self.diagnosis_revenue = np.zeros(0, dtype=np.int64)
+            # Last applied contribution of each treatment, indexed by treatment_id,
+            # so that updates and replays replace instead of double counting
+            self.t_day = np.full(0, -1, dtype=np.int32)
+            self.t_cost = np.zeros(0, dtype=np.int64)
+            self.t_insurance = np.zeros(0, dtype=np.int64)
+            self.t_patient = np.zeros(0, dtype=np.int64)
+            self.t_diagnosis = np.zeros(0, dtype=np.int32)
+
+    def _rebase(self, origin: int):
+        """Re-index checkpointed day arrays from origin to ORIGIN (lock held)"""
+        shift = origin - ORIGIN_ORDINAL
+        if shift == 0:
+            return
+        if shift < 0:
+            raise ValueError(f"checkpoint starts at {date.fromordinal(origin)}, before ANALYTICS_ORIGIN {ORIGIN}")
+        for name in ("daily_revenue", "daily_insurance", "daily_patient", "daily_count"):
+            values = getattr(self, name)
+            setattr(self, name, np.concatenate([np.zeros(shift, dtype=values.dtype), values]))
+        self.t_day = np.where(self.t_day >= 0, self.t_day + shift, -1).astype(np.int32)
+
+    def _diagnosis_ids(self, diagnoses) -> np.ndarray:
+        ids = np.empty(len(diagnoses), dtype=np.int32)
+        for i, diagnosis in enumerate(diagnoses):
+            name = _normalize_diagnosis(diagnosis)
+            index = self.diagnosis_index.get(name)
+            if index is None:
+                index = len(self.diagnosis_names)
+                self.diagnosis_index[name] = index
+                self.diagnosis_names.append(name)
+            ids[i] = index
+        self.diagnosis_count = _grow(self.diagnosis_count, len(self.diagnosis_names))
+        self.diagnosis_revenue = _grow(self.diagnosis_revenue, len(self.diagnosis_names))
+        return ids
+
+    def _retract(self, ids: np.ndarray):
+        """Subtract the stored contributions of the given treatments (lock held)"""
+        ids = np.unique(ids[(ids >= 0) & (ids < len(self.t_day))])
+        ids = ids[self.t_day[ids] >= 0]
+        if not len(ids):
+            return
+        days = self.t_day[ids]
+        diagnoses = self.t_diagnosis[ids]
+        np.subtract.at(self.daily_revenue, days, self.t_cost[ids])
+        np.subtract.at(self.daily_insurance, days, self.t_insurance[ids])
+        np.subtract.at(self.daily_patient, days, self.t_patient[ids])
+        np.subtract.at(self.daily_count, days, 1)
+        np.subtract.at(self.diagnosis_revenue, diagnoses, self.t_cost[ids])
+        np.subtract.at(self.diagnosis_count, diagnoses, 1)
+        self.t_day[ids] = -1
+
+    def apply_batch(
+            self,
+            treatment_ids,
+            treatment_dates,
+            costs,
+            insurance_coverage,
+            patient_responsibility,
+            diagnoses
+    ):
+        """Upsert a batch of treatments into the aggregates"""
+        ids = np.asarray(treatment_ids, dtype=np.int64)
+        if not len(ids):
+            return
+        days = np.asarray(
+            [d.toordinal() - ORIGIN_ORDINAL for d in treatment_dates],
+            dtype=np.int32
+        )
+        cost = np.nan_to_num(np.asarray(costs, dtype=np.float64))
+        insurance = np.nan_to_num(np.asarray(insurance_coverage, dtype=np.float64))
+        patient = np.asarray(patient_responsibility, dtype=np.float64)
+        # Without an explicit split, whatever insurance does not cover is the patient's
+        patient = np.where(np.isnan(patient), cost - insurance, patient)
+        cost, insurance, patient = _to_cents(cost), _to_cents(insurance), _to_cents(patient)
+
+        # Keep only the last occurrence of each treatment and valid days
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - last
+        too_old = keep[days[keep] < 0]
+        if len(too_old):
+            self.rejected += len(too_old)
+            logger.warning(
+                f"Rejected {len(too_old)} treatments dated before {ORIGIN} (set ANALYTICS_ORIGIN earlier), "
+                f"e.g. treatment_id {ids[too_old[0]]}; {self.rejected} so far"
+            )
+        keep = keep[days[keep] >= 0]
+        ids, days, cost, insurance, patient = ids[keep], days[keep], cost[keep], insurance[keep], patient[keep]
+        diagnoses = [diagnoses[i] for i in keep]
+
+        with self.lock:
+            diagnosis_ids = self._diagnosis_ids(diagnoses)
+            self._retract(ids)
+
+            size = int(ids.max()) + 1 if len(ids) else 0
+            self.t_day = _grow(self.t_day, size, fill=-1)
+            self.t_cost = _grow(self.t_cost, size)
+            self.t_insurance = _grow(self.t_insurance, size)
+            self.t_patient = _grow(self.t_patient, size)
+            self.t_diagnosis = _grow(self.t_diagnosis, size)
+
+            span = int(days.max()) + 1 if len(days) else 0
+            self.daily_revenue = _grow(self.daily_revenue, span)
+            self.daily_insurance = _grow(self.daily_insurance, span)
+            self.daily_patient = _grow(self.daily_patient, span)
+            self.daily_count = _grow(self.daily_count, span)
+
+            np.add.at(self.daily_revenue, days, cost)
+            np.add.at(self.daily_insurance, days, insurance)
+            np.add.at(self.daily_patient, days, patient)
+            np.add.at(self.daily_count, days, 1)
+            np.add.at(self.diagnosis_revenue, diagnosis_ids, cost)
+            np.add.at(self.diagnosis_count, diagnosis_ids, 1)
+
+            self.t_day[ids] = days
+            self.t_cost[ids] = cost
+            self.t_insurance[ids] = insurance
+            self.t_patient[ids] = patient
+            self.t_diagnosis[ids] = diagnosis_ids
+
+    def remove(self, treatment_ids):
+        """Remove treatments from the aggregates"""
+        with self.lock:
+            self._retract(np.asarray(treatment_ids, dtype=np.int64))
+
+    def handle_event(self, event: Dict[str, Any]):
+        """Apply one treatment-events message"""
+        event_type = event.get("type")
+        treatment_id = event.get("treatment_id")
+        if treatment_id is None:
+            return
+        if event_type == "treatment_deleted":
+            self.remove([treatment_id])
+        elif event_type in ("new_treatment", "treatment_updated"):
+            if event.get("treatment_date") is None or event.get("cost") is None:
+                logger.debug(f"Skipping treatment event without amounts: {event}")
+                return
+            self.apply_batch(
+                [treatment_id],
+                [date.fromisoformat(event["treatment_date"])],
+                [event["cost"]],
+                [event.get("insurance_coverage") if event.get("insurance_coverage") is not None else np.nan],
+                [event.get("patient_responsibility") if event.get("patient_responsibility") is not None else np.nan],
+                [event.get("diagnosis")]
+            )
+        if time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.save_checkpoint()
+
+    # Queries
+
+    def _day_range(self, start: date, end: date):
+        # Not clamped at the origin: days before it are simply empty
+        lo = start.toordinal() - ORIGIN_ORDINAL
+        hi = max(end.toordinal() - ORIGIN_ORDINAL + 1, lo)
+        return lo, hi
+
+    def _window(self, array: np.ndarray, lo: int, hi: int) -> np.ndarray:
+        window = np.zeros(hi - lo, dtype=array.dtype)
+        first = max(lo, 0)
+        available = array[first:max(hi, first)]
+        window[first - lo:first - lo + len(available)] = available
+        return window
+
+    def daily(self, start: date, end: date) -> List[Dict[str, Any]]:
+        """Revenue, split and volume per day in [start, end]"""
+        lo, hi = self._day_range(start, end)
+        with self.lock:
+            revenue = self._window(self.daily_revenue, lo, hi)
+            insurance = self._window(self.daily_insurance, lo, hi)
+            patient = self._window(self.daily_patient, lo, hi)
+            count = self._window(self.daily_count, lo, hi)
+        return [
+            {
+                "date": date.fromordinal(ORIGIN_ORDINAL + lo + i).isoformat(),
+                "revenue": _dollars(revenue[i]),
+                "insurance": _dollars(insurance[i]),
+                "patient": _dollars(patient[i]),
+                "treatments": int(count[i])
+            }
+            for i in range(hi - lo)
+        ]
+
+    def weekly(self, start: date, end: date) -> List[Dict[str, Any]]:
+        """Revenue, split and volume per ISO week (Monday start) overlapping [start, end]"""
+        start = start - timedelta(days=start.weekday())
+        end = end + timedelta(days=6 - end.weekday())
+        lo, hi = self._day_range(start, end)
+        with self.lock:
+            revenue = self._window(self.daily_revenue, lo, hi)
+            insurance = self._window(self.daily_insurance, lo, hi)
+            patient = self._window(self.daily_patient, lo, hi)
+            count = self._window(self.daily_count, lo, hi)
+        weeks = (hi - lo) // 7
+        revenue = revenue.reshape(weeks, 7).sum(axis=1)
+        insurance = insurance.reshape(weeks, 7).sum(axis=1)
+        patient = patient.reshape(weeks, 7).sum(axis=1)
+        count = count.reshape(weeks, 7).sum(axis=1)
+        return [
+            {
+                "week_start": (start + timedelta(weeks=i)).isoformat(),
+                "revenue": _dollars(revenue[i]),
+                "insurance": _dollars(insurance[i]),
+                "patient": _dollars(patient[i]),
+                "treatments": int(count[i])
+            }
+            for i in range(weeks)
+        ]
+
+    def share(self, start: date, end: date) -> Dict[str, Any]:
+        """Insurance versus patient share of revenue in [start, end]"""
+        lo, hi = self._day_range(start, end)
+        with self.lock:
+            revenue = int(self._window(self.daily_revenue, lo, hi).sum())
+            insurance = int(self._window(self.daily_insurance, lo, hi).sum())
+            patient = int(self._window(self.daily_patient, lo, hi).sum())
+            count = int(self._window(self.daily_count, lo, hi).sum())
+        return {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "revenue": _dollars(revenue),
+            "insurance": _dollars(insurance),
+            "patient": _dollars(patient),
+            "insurance_share": round(insurance / revenue, 4) if revenue else 0.0,
+            "patient_share": round(patient / revenue, 4) if revenue else 0.0,
+            "treatments": count
+        }
+
+    def diagnoses(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Treatment counts and revenue for the most frequent diagnoses"""
+        with self.lock:
+            count = self.diagnosis_count[:len(self.diagnosis_names)].copy()
+            revenue = self.diagnosis_revenue[:len(self.diagnosis_names)].copy()
+            names = list(self.diagnosis_names)
+        order = np.argsort(-count, kind="stable")[:limit]
+        return [
+            {"diagnosis": names[i], "treatments": int(count[i]), "revenue": _dollars(revenue[i])}
+            for i in order
+            if count[i] > 0
+        ]
+
+    # Checkpointing
+
+    def save_checkpoint(self):
+        """Atomically write the aggregates to disk"""
+        directory = os.path.dirname(self.checkpoint_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Every worker holds the full aggregates and checkpoints to the same
+        # path; a per-process temp file keeps concurrent writers from
+        # clobbering each other before the atomic replace
+        tmp_path = f"{self.checkpoint_path}.{os.getpid()}.tmp.npz"
+        with self.lock:
+            np.savez_compressed(
+                tmp_path,
+                daily_revenue=self.daily_revenue,
+                daily_insurance=self.daily_insurance,
+                daily_patient=self.daily_patient,
+                daily_count=self.daily_count,
+                diagnosis_names=np.array(self.diagnosis_names, dtype=str),
+                diagnosis_count=self.diagnosis_count,
+                diagnosis_revenue=self.diagnosis_revenue,
+                t_day=self.t_day,
+                t_cost=self.t_cost,
+                t_insurance=self.t_insurance,
+                t_patient=self.t_patient,
+                t_diagnosis=self.t_diagnosis,
+                origin=np.array(ORIGIN_ORDINAL)
+            )
+            os.replace(tmp_path, self.checkpoint_path)
+            self.last_checkpoint = time.monotonic()
+        logger.info(f"Analytics checkpoint written to {self.checkpoint_path}")
+
+    def load_checkpoint(self) -> bool:
+        """Restore the aggregates from disk if a checkpoint exists"""
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        try:
+            with np.load(self.checkpoint_path) as data:
+                with self.lock:
+                    self.daily_revenue = data["daily_revenue"]
+                    self.daily_insurance = data["daily_insurance"]
+                    self.daily_patient = data["daily_patient"]
+                    self.daily_count = data["daily_count"]
+                    self.diagnosis_names = [str(name) for name in data["diagnosis_names"]]
+                    self.diagnosis_index = {name: i for i, name in enumerate(self.diagnosis_names)}
+                    self.diagnosis_count = data["diagnosis_count"]
+                    self.diagnosis_revenue = data["diagnosis_revenue"]
+                    self.t_day = data["t_day"]
+                    self.t_cost = data["t_cost"]
+                    self.t_insurance = data["t_insurance"]
+                    self.t_patient = data["t_patient"]
+                    self.t_diagnosis = data["t_diagnosis"]
+                    # Checkpoints written before the switch to cents hold floats
+                    for name in MONEY_ARRAYS:
+                        values = getattr(self, name)
+                        if values.dtype.kind == "f":
+                            setattr(self, name, _to_cents(values))
+                    origin = int(data["origin"]) if "origin" in data.files else LEGACY_ORIGIN_ORDINAL
+                    self._rebase(origin)
+            logger.info(f"Analytics restored from {self.checkpoint_path}")
+            return True
+        except Exception as e:
+            logger.error(f"Error loading analytics checkpoint: {e}")
+            self.reset()
+            return False
+
+    # Backfill
+
+    def backfill(self, batch_size: int = 50000) -> int:
+        """Rebuild the aggregates from the treatments table"""
+        from ..models.treatment import treatments_table as t
+
+        self.reset()
+        total = 0
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                select(
+                    t.c.treatment_id,
+                    t.c.treatment_date,
+                    t.c.cost,
+                    t.c.insurance_coverage,
+                    t.c.patient_responsibility,
+                    t.c.diagnosis
+                ).execution_options(yield_per=batch_size)
+            )
+            for rows in result.partitions():
+                ids, dates, costs, insurance, patient, diagnoses = zip(*rows)
+                self.apply_batch(
+                    ids,
+                    dates,
+                    [float(c) for c in costs],
+                    [float(v) if v is not None else np.nan for v in insurance],
+                    [float(v) if v is not None else np.nan for v in patient],
+                    diagnoses
+                )
+                total += len(rows)
+                logger.info(f"Backfilled {total} treatments")
+        finally:
+            db.close()
+        self.save_checkpoint()
+        return total
+
+    # Consumer lifecycle
+
+    async def start(self):
+        """Start following treatment-events"""
+        if self.task:
+            return
+        self.task = asyncio.create_task(
+            self.consumer_service.start_ordered_consuming(
+                "treatment-events",
+                self.group_id,
+                self.handle_event,
+                workers=self.consumer_workers
+            )
+        )
+
+    def stop(self):
+        """Stop following treatment-events and checkpoint"""
+        self.consumer_service.stop_consuming("treatment-events")
+        self.task = None
+        self.save_checkpoint()
+
+
+if __name__ == "__main__":
+    from . import treatment_analytics
+
+    parser = argparse.ArgumentParser(description="Treatment analytics maintenance")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--batch-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    count = treatment_analytics.backfill(batch_size=args.batch_size)
+    logger.info(f"Backfill complete: {count} treatments")
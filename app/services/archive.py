@@ -0,0 +1,347 @@
+# app/services/archive.py
+import argparse
+import io
+import json
+import logging
+import os
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from pyarrow import fs
+from sqlalchemy import Text, bindparam, select, text, type_coerce
+from sqlalchemy.dialects.postgresql import ARRAY, INTEGER
+
+from .database import SessionLocal
+from .encryption import get_field_encryptor
+from .kafka_producer import KafkaProducerService
+from .s3_service import S3Service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DECIMAL = pa.decimal128(10, 2)
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+
+# provider_notes stays encrypted in the archive, exactly as stored
+TREATMENT_SCHEMA = pa.schema([
+    ("treatment_id", pa.int32()),
+    ("patient_id", pa.int32()),
+    ("treatment_date", pa.date32()),
+    ("diagnosis", pa.string()),
+    ("treatment_description", pa.string()),
+    ("provider_notes", pa.string()),
+    ("cost", DECIMAL),
+    ("insurance_coverage", DECIMAL),
+    ("patient_responsibility", DECIMAL),
+    ("follow_up_date", pa.date32()),
+    ("created_at", TIMESTAMP),
+    ("updated_at", TIMESTAMP),
+    ("archived_at", TIMESTAMP),
+])
+IMAGE_SCHEMA = pa.schema([
+    ("image_id", pa.int32()),
+    ("treatment_id", pa.int32()),
+    ("patient_id", pa.int32()),
+    ("treatment_date", pa.date32()),
+    ("image_type", pa.string()),
+    ("s3_key", pa.string()),
+    ("uploaded_at", TIMESTAMP),
+    ("archived_at", TIMESTAMP),
+])
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8())]), flavor="hive")
+
+DELETE_SQL = [
+    text(f"DELETE FROM {table} WHERE treatment_id = ANY(:treatment_ids)").bindparams(
+        bindparam("treatment_ids", type_=ARRAY(INTEGER))
+    )
+    # Children first; reminders carry no foreign key but would be orphaned
+    for table in ("patient_images", "follow_up_notifications", "treatments")
+]
+
+
+def _month_after(day: date) -> date:
+    return date(day.year + (day.month == 12), day.month % 12 + 1, 1)
+
+
+def _fragment_order(fragment: ds.Fragment):
+    # Listing order is lexical (month=10 before month=2); file names carry the zero-padded first id
+    partition = ds.get_partition_keys(fragment.partition_expression)
+    return partition["year"], partition["month"], fragment.path.rsplit("/", 1)[-1]
+
+
+class TreatmentArchive:
+    """Move treatments past the retention horizon to Parquet in S3 and query them back"""
+
+    def __init__(self, s3_service: Optional[S3Service] = None, kafka_producer: Optional[KafkaProducerService] = None):
+        self.s3_service = s3_service or S3Service()
+        self.prefix = self.s3_service.paths['archive']
+        self.retention_days = int(os.getenv("ARCHIVE_RETENTION_DAYS", str(7 * 365)))
+        self.batch_size = int(os.getenv("ARCHIVE_BATCH_SIZE", "50000"))
+        # Small enough that a patient's rows fall in few row groups of a file
+        self.row_group_size = int(os.getenv("ARCHIVE_ROW_GROUP_SIZE", "5000"))
+        self._kafka_producer = kafka_producer
+        self._filesystem = None
+
+    @property
+    def kafka_producer(self) -> KafkaProducerService:
+        if self._kafka_producer is None:
+            self._kafka_producer = KafkaProducerService()
+        return self._kafka_producer
+
+    def cutoff(self, today: Optional[date] = None) -> date:
+        """First day kept hot. Rounded down to a year start so no plan year
+        is split between the hot tables and the archive (billing reads whole years)."""
+        horizon = date.fromordinal((today or date.today()).toordinal() - self.retention_days)
+        return date(horizon.year, 1, 1)
+
+    # Writing
+
+    def _put_parquet(self, key: str, table: pa.Table):
+        # Sorted by patient, each row group covers a narrow patient_id range and
+        # its statistics let a patient lookup skip the rest of the file
+        table = table.sort_by([("patient_id", "ascending"), (table.column_names[0], "ascending")])
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression="zstd", row_group_size=self.row_group_size)
+        self.s3_service.s3_client.put_object(
+            Bucket=self.s3_service.bucket_name,
+            Key=key,
+            Body=buffer.getvalue(),
+            ServerSideEncryption='AES256',
+            ContentType='application/vnd.apache.parquet'
+        )
+
+    def _partition_key(self, dataset: str, month: date, first_id: int, last_id: int) -> str:
+        # Named by id range, so re-running a batch overwrites rather than duplicates it
+        return (
+            f"{self.prefix}/{dataset}/year={month.year}/month={month.month}/"
+            f"part-{first_id:010d}-{last_id:010d}.parquet"
+        )
+
+    def archive_batch(self, month: date, end: date, after_id: int, dry_run: bool = False) -> List[int]:
+        """Archive and delete one batch of a month's treatments; returns their ids"""
+        from ..models.treatment import treatments_table as t, patient_images_table as i
+
+        archived_at = datetime.now(timezone.utc)
+        db = SessionLocal()
+        try:
+            columns = [
+                type_coerce(column, Text).label(column.name) if column.name == "provider_notes" else column
+                for column in t.columns
+            ]
+            treatments = db.execute(
+                select(*columns)
+                .where(t.c.treatment_date >= month, t.c.treatment_date < end, t.c.treatment_id > after_id)
+                .order_by(t.c.treatment_id)
+                .limit(self.batch_size)
+                .with_for_update()
+            ).mappings().all()
+            ids = [row["treatment_id"] for row in treatments]
+            if not treatments or dry_run:
+                return ids
+
+            images = db.execute(
+                select(i, t.c.patient_id, t.c.treatment_date)
+                .join(t, t.c.treatment_id == i.c.treatment_id)
+                .where(i.c.treatment_id.in_(ids))
+                .order_by(i.c.image_id)
+            ).mappings().all()
+
+            first_id, last_id = ids[0], ids[-1]
+            self._put_parquet(
+                self._partition_key("treatments", month, first_id, last_id),
+                pa.Table.from_pylist(
+                    [{**row, "archived_at": archived_at} for row in treatments], schema=TREATMENT_SCHEMA
+                )
+            )
+            if images:
+                self._put_parquet(
+                    self._partition_key("patient_images", month, first_id, last_id),
+                    pa.Table.from_pylist(
+                        [{**row, "archived_at": archived_at} for row in images], schema=IMAGE_SCHEMA
+                    )
+                )
+
+            # The files are in S3 before the rows go; a failure here leaves the
+            # batch in both places and the next run rewrites the same keys
+            for statement in DELETE_SQL:
+                db.execute(statement, {"treatment_ids": ids})
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        # Consumers holding per-treatment state (analytics, follow-up
+        # reminders) drop archived rows as they would deleted ones
+        self.kafka_producer.publish_many("treatment-events", [
+            {
+                "type": "treatment_deleted",
+                "treatment_id": row["treatment_id"],
+                "patient_id": row["patient_id"],
+                "archived": True,
+                "event_type": "treatment"
+            }
+            for row in treatments
+        ])
+        return ids
+
+    def run(self, today: Optional[date] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """Archive everything before the cutoff, month by month"""
+        from ..models.treatment import treatments_table as t
+
+        cutoff = self.cutoff(today)
+        db = SessionLocal()
+        try:
+            oldest = db.execute(
+                select(t.c.treatment_date).where(t.c.treatment_date < cutoff)
+                .order_by(t.c.treatment_date).limit(1)
+            ).scalar()
+        finally:
+            db.close()
+
+        archived = 0
+        month = date(oldest.year, oldest.month, 1) if oldest else cutoff
+        while month < cutoff:
+            end = min(_month_after(month), cutoff)
+            after_id = 0
+            while True:
+                ids = self.archive_batch(month, end, after_id, dry_run=dry_run)
+                if not ids:
+                    break
+                archived += len(ids)
+                after_id = ids[-1]
+                logger.info(f"Archived {len(ids)} treatments from {month:%Y-%m} (through id {after_id})")
+            month = end
+
+        summary = {"cutoff": cutoff.isoformat(), "treatments": archived, "dry_run": dry_run}
+        logger.info(f"Archive run complete: {summary}")
+        return summary
+
+    # Reading
+
+    def filesystem(self) -> fs.S3FileSystem:
+        if self._filesystem is None:
+            options = {
+                "access_key": self.s3_service.aws_access_key_id,
+                "secret_key": self.s3_service.aws_secret_access_key,
+                "region": self.s3_service.region_name,
+            }
+            if self.s3_service.endpoint_url:
+                endpoint = urlparse(self.s3_service.endpoint_url)
+                options["endpoint_override"] = endpoint.netloc
+                options["scheme"] = endpoint.scheme
+            self._filesystem = fs.S3FileSystem(**options)
+        return self._filesystem
+
+    def _dataset(self, name: str, schema: pa.Schema) -> ds.Dataset:
+        return ds.dataset(
+            f"{self.s3_service.bucket_name}/{self.prefix}/{name}",
+            schema=schema.append(pa.field("year", pa.int16())).append(pa.field("month", pa.int8())),
+            format="parquet",
+            partitioning=PARTITIONING,
+            filesystem=self.filesystem()
+        )
+
+    @staticmethod
+    def _date_filter(start: Optional[date], end: Optional[date]) -> Optional[ds.Expression]:
+        # year bounds prune whole partitions; treatment_date is checked against row group statistics
+        expression = None
+        if start:
+            expression = (ds.field("year") >= start.year) & (ds.field("treatment_date") >= start)
+        if end:
+            upper = (ds.field("year") <= end.year) & (ds.field("treatment_date") <= end)
+            expression = upper if expression is None else expression & upper
+        return expression
+
+    def query(
+            self,
+            patient_id: Optional[int] = None,
+            start: Optional[date] = None,
+            end: Optional[date] = None,
+            columns: Optional[List[str]] = None,
+            include_images: bool = False,
+            limit: int = 1000
+    ) -> List[Dict[str, Any]]:
+        """Archived treatments matching the filters, oldest month first and by id within a month.
+
+        Files are read one at a time in that order, batch by batch, and
+        reading stops at the first file that fills the limit. Files are
+        sorted by patient, so a patient filter skips most row groups.
+        """
+        expression = self._date_filter(start, end)
+        if patient_id is not None:
+            by_patient = ds.field("patient_id") == patient_id
+            expression = by_patient if expression is None else expression & by_patient
+
+        columns = list(dict.fromkeys(["treatment_id"] + (columns or TREATMENT_SCHEMA.names)))
+        dataset = self._dataset("treatments", TREATMENT_SCHEMA)
+        rows: List[Dict[str, Any]] = []
+        for fragment in sorted(dataset.get_fragments(filter=expression), key=_fragment_order):
+            scanner = fragment.scanner(schema=dataset.schema, columns=columns, filter=expression)
+            # A file holds one id range of one month, but is stored in patient order
+            matched = pa.Table.from_batches(scanner.to_batches(), schema=scanner.projected_schema)
+            if matched.num_rows:
+                rows.extend(matched.sort_by("treatment_id").slice(0, limit - len(rows)).to_pylist())
+            if len(rows) >= limit:
+                break
+        if not rows:
+            return []
+
+        if "provider_notes" in columns:
+            notes = get_field_encryptor().decrypt_many([row["provider_notes"] for row in rows], "provider_notes")
+            for row, note in zip(rows, notes):
+                row["provider_notes"] = note
+
+        if include_images:
+            ids = [row["treatment_id"] for row in rows]
+            images_expression = ds.field("treatment_id").isin(ids)
+            date_expression = self._date_filter(start, end)
+            if date_expression is not None:
+                images_expression = images_expression & date_expression
+            images = self._dataset("patient_images", IMAGE_SCHEMA).to_table(
+                columns=["image_id", "treatment_id", "image_type", "s3_key", "uploaded_at"],
+                filter=images_expression
+            ).sort_by("image_id").to_pylist()
+            by_treatment: Dict[int, List[Dict[str, Any]]] = {treatment_id: [] for treatment_id in ids}
+            for image in images:
+                by_treatment[image["treatment_id"]].append(image)
+            for row in rows:
+                row["images"] = by_treatment[row["treatment_id"]]
+        return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-tier treatment archive")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Archive treatments past the retention horizon")
+    run_parser.add_argument("--retention-days", type=int)
+    run_parser.add_argument("--batch-size", type=int)
+    run_parser.add_argument("--dry-run", action="store_true", help="Count what would be archived")
+
+    query_parser = subparsers.add_parser("query", help="Read archived treatments")
+    query_parser.add_argument("--patient-id", type=int)
+    query_parser.add_argument("--start", type=date.fromisoformat)
+    query_parser.add_argument("--end", type=date.fromisoformat)
+    query_parser.add_argument("--limit", type=int, default=100)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    archive = TreatmentArchive()
+    if args.command == "run":
+        if args.retention_days:
+            archive.retention_days = args.retention_days
+        if args.batch_size:
+            archive.batch_size = args.batch_size
+        print(json.dumps(archive.run(dry_run=args.dry_run)))
+    else:
+        for row in archive.query(args.patient_id, args.start, args.end, limit=args.limit):
+            print(json.dumps(row, default=str))
@@ -0,0 +1,584 @@
+# app/services/audit.py
+import argparse
+import gzip
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import orjson
+from dotenv import load_dotenv
+
+from .s3_service import S3Service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Routes that read or write PHI
+AUDITED_PREFIXES = tuple(
+    prefix.strip() for prefix in os.getenv(
+        "AUDIT_PATH_PREFIXES",
+        "/api/v1/patients,/api/v1/treatments,/api/v1/insurance,/api/v1/archive,/api/v1/events"
+    ).split(",") if prefix.strip()
+)
+ACTIONS = {"GET": "read", "HEAD": "read", "POST": "create", "PUT": "update", "PATCH": "update", "DELETE": "delete"}
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+OPEN_SUFFIX = ".part"
+TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+RECOVERY_CHUNK = 64 * 1024
+
+
+def audit_patient(request, patient_id: Optional[int]):
+    """Attribute the current request to a patient the URL does not name"""
+    request.state.audit_patient_id = patient_id
+
+
+def audit_patients(request, patient_ids: Iterable[int]):
+    """Attribute a batch or list request to every patient it returned"""
+    request.state.audit_patient_ids = sorted(set(patient_ids))
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.strptime(value, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def _segment_range(name: str) -> Tuple[datetime, datetime]:
+    """First and last record times encoded in a closed segment's name"""
+    first, last = name.split("-")[:2]
+    return _parse_time(first), _parse_time(last)
+
+
+def _writer_alive(name: str, own_nonce: str) -> bool:
+    """Whether an open segment belongs to a running writer on this host.
+
+    A container restart reuses the pid (often 1) on the same hostname, so a
+    segment with our pid but another start's nonce is a crashed writer's.
+    """
+    try:
+        host, pid, nonce, _ = name[:-len(SEGMENT_SUFFIX + OPEN_SUFFIX)].rsplit("-", 3)
+    except ValueError:
+        return False  # not named by this version's writers
+    if nonce == own_nonce:
+        return True
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AuditRingBuffer:
+    """Bounded hand-off between request handlers and the writer thread.
+
+    Appending does not wait for the writer. If the writer falls a whole
+    buffer behind, the request that fills it hands the backlog to spill,
+    which writes it straight to the spool directory instead of evicting
+    anything; only records spill fails to write are counted as dropped.
+    """
+
+    def __init__(self, capacity: int, spill: Callable[[List[Dict[str, Any]]], None]):
+        self.capacity = capacity
+        self.spill = spill
+        self.records: deque = deque()
+        self.lock = threading.Lock()
+        self.spilled = 0
+        self.dropped = 0
+
+    def append(self, record: Dict[str, Any]):
+        with self.lock:
+            self.records.append(record)
+            if len(self.records) < self.capacity:
+                return
+            backlog = list(self.records)
+            self.records.clear()
+        try:
+            self.spill(backlog)
+        except Exception as e:
+            logger.error(f"Error spilling {len(backlog)} audit records, dropping them: {e}")
+            with self.lock:
+                self.dropped += len(backlog)
+        else:
+            with self.lock:
+                self.spilled += len(backlog)
+
+    def drain(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            records = list(self.records)
+            self.records.clear()
+        return records
+
+    def restore(self, records: List[Dict[str, Any]]):
+        """Put drained records back ahead of anything appended since"""
+        with self.lock:
+            self.records.extendleft(reversed(records))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+class AuditSegment:
+    """A gzip JSONL file being written in the spool directory.
+
+    Each flush ends with a zlib sync point, so after a crash everything up
+    to the last flush can still be decompressed from the .part file.
+    """
+
+    def __init__(self, spool_dir: str, hour: datetime, nonce: str, sequence: int):
+        self.spool_dir = spool_dir
+        self.hour = hour
+        # The nonce tells this start's files apart from a crashed one with the same pid
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{nonce}-{sequence:06d}"
+        self.path = os.path.join(spool_dir, self.name + SEGMENT_SUFFIX + OPEN_SUFFIX)
+        # Exclusive: never truncate a file some other writer left behind
+        self.raw = open(self.path, "xb")
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6)
+        self.opened = time.monotonic()
+        self.first: Optional[str] = None
+        self.last: Optional[str] = None
+        self.records = 0
+
+    def write(self, records: List[Dict[str, Any]]):
+        self.gzip.write(b"".join(orjson.dumps(record) + b"\n" for record in records))
+        self.first = self.first or records[0]["ts"]
+        self.last = records[-1]["ts"]
+        self.records += len(records)
+
+    def flush(self):
+        self.gzip.flush(zlib.Z_SYNC_FLUSH)
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+    def size(self) -> int:
+        """Compressed bytes on disk so far"""
+        return self.raw.tell()
+
+    def close(self) -> Optional[str]:
+        """Finish the file and give it its final name; returns that path"""
+        self.gzip.close()
+        self.raw.close()
+        if not self.records:
+            os.remove(self.path)
+            return None
+        final = os.path.join(
+            self.spool_dir,
+            f"{_compact(self.first)}-{_compact(self.last)}-{self.name}{SEGMENT_SUFFIX}"
+        )
+        os.replace(self.path, final)
+        return final
+
+
+def _compact(timestamp: str) -> str:
+    return datetime.fromisoformat(timestamp).strftime(TIME_FORMAT)
+
+
+def _split_by_hour(records: List[Dict[str, Any]]) -> Iterator[Tuple[datetime, List[Dict[str, Any]]]]:
+    """Runs of consecutive records within one clock hour; records arrive in time order"""
+    start = 0
+    while start < len(records):
+        hour = datetime.fromisoformat(records[start]["ts"]).replace(minute=0, second=0, microsecond=0)
+        end = start
+        next_hour = (hour + timedelta(hours=1)).isoformat(timespec="microseconds")
+        while end < len(records) and records[end]["ts"] < next_hour:
+            end += 1
+        yield hour, records[start:end]
+        start = end
+
+
+class AuditLog:
+    """Buffer PHI access records in memory, roll them into compressed segments
+    on local disk and ship closed segments to the audit_logs prefix in S3.
+
+    Segments are bounded by size, age and the clock hour, and land under
+    date=YYYY-MM-DD/hour=HH/ so queries only list the hours they need. The
+    spool directory absorbs S3 outages: closed segments stay on disk until
+    an upload succeeds, and segments left open by a crash are recovered on
+    the next start.
+    """
+
+    def __init__(self, s3_service: Optional[S3Service] = None):
+        self.s3_service = s3_service or S3Service()
+        self.prefix = self.s3_service.paths['audit_logs']
+        self.enabled = os.getenv("AUDIT_ENABLED", "true").lower() == "true"
+        self.spool_dir = os.getenv("AUDIT_SPOOL_DIR", "data/audit_spool")
+        self.flush_seconds = float(os.getenv("AUDIT_FLUSH_SECONDS", "1"))
+        self.segment_max_bytes = int(float(os.getenv("AUDIT_SEGMENT_MAX_MB", "16")) * MB)
+        self.segment_max_seconds = float(os.getenv("AUDIT_SEGMENT_MAX_SECONDS", "300"))
+        self.upload_seconds = float(os.getenv("AUDIT_UPLOAD_SECONDS", "10"))
+        self.actor_header = os.getenv("AUDIT_ACTOR_HEADER", "x-user-id").lower().encode("latin-1")
+        self.buffer = AuditRingBuffer(int(os.getenv("AUDIT_BUFFER_SIZE", "100000")), self._spill)
+        self.segment: Optional[AuditSegment] = None
+        self.nonce = uuid.uuid4().hex[:8]
+        # Segments are opened by the writer, recovery and spilling requests
+        self.sequence = 0
+        self.sequence_lock = threading.Lock()
+        self.written = 0
+        self.uploaded = 0
+        self.upload_failures = 0
+        self.stopping = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def audits(self, path: str) -> bool:
+        return self.enabled and path.startswith(AUDITED_PREFIXES)
+
+    def record(self, record: Dict[str, Any]):
+        """Queue one access record; cheap enough to call on every request"""
+        self.buffer.append(record)
+
+    def build_record(self, scope: Dict[str, Any], status: int, duration: float) -> Dict[str, Any]:
+        """Access record for a finished request, read from its ASGI scope"""
+        headers = dict(scope.get("headers") or ())
+        path_params = scope.get("path_params") or {}
+        route = scope.get("route")
+        # Query values can hold PHI (email and phone searches); only names are kept
+        query = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        state = scope.get("state") or {}
+        patient_id = state.get("audit_patient_id")
+        if patient_id is None:
+            patient_id = path_params.get("patient_id", query.get("patient_id"))
+        client = scope.get("client")
+        # WebSocket scopes carry no method; the handshake is a GET
+        method = scope.get("method", "GET")
+        record = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="microseconds"),
+            "request_id": headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex,
+            "actor": headers.get(self.actor_header, b"").decode("latin-1") or None,
+            "client": client[0] if client else None,
+            "action": ACTIONS.get(method, method.lower()),
+            "method": method,
+            "route": getattr(route, "path", None),
+            "path": scope["path"],
+            "resource": {name: value for name, value in path_params.items() if name != "patient_id"},
+            "query": sorted(name for name in query if name != "patient_id"),
+            "patient_id": int(patient_id) if str(patient_id).isdigit() else None,
+            "status": status,
+            "duration_ms": round(duration * 1000, 2)
+        }
+        if state.get("audit_patient_ids"):
+            record["patient_ids"] = state["audit_patient_ids"]
+        return record
+
+    # Writing
+
+    def _next_sequence(self) -> int:
+        with self.sequence_lock:
+            self.sequence += 1
+            return self.sequence
+
+    def _rotate(self, hour: datetime):
+        if self.segment is not None:
+            final = self.segment.close()
+            if final:
+                logger.info(f"Closed audit segment {os.path.basename(final)} ({self.segment.records} records)")
+        self.segment = AuditSegment(self.spool_dir, hour, self.nonce, self._next_sequence())
+
+    def _spill(self, records: List[Dict[str, Any]]):
+        """Write a full buffer's backlog straight to closed segments, one per hour"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for hour, run in _split_by_hour(records):
+            segment = AuditSegment(self.spool_dir, hour, self.nonce, self._next_sequence())
+            segment.write(run)
+            segment.flush()
+            segment.close()
+        logger.warning(f"Audit buffer full, spilled {len(records)} records to {self.spool_dir}")
+
+    def _due_for_rotation(self) -> bool:
+        segment = self.segment
+        return segment is not None and segment.records > 0 and (
+            segment.size() >= self.segment_max_bytes
+            or time.monotonic() - segment.opened >= self.segment_max_seconds
+        )
+
+    def write_pending(self) -> int:
+        """Append buffered records to the open segment; returns how many"""
+        records = self.buffer.drain()
+        try:
+            for hour, run in _split_by_hour(records):
+                if self.segment is None or self.segment.hour != hour:
+                    self._rotate(hour)
+                self.segment.write(run)
+            if records:
+                self.segment.flush()
+        except Exception:
+            # Keep the records for the next attempt and give up on the segment,
+            # whose state is unknown; what it did hold may then appear twice
+            self.buffer.restore(records)
+            self._abandon_segment()
+            raise
+        self.written += len(records)
+        if self._due_for_rotation():
+            self._rotate(self.segment.hour)
+        return len(records)
+
+    def _abandon_segment(self):
+        segment, self.segment = self.segment, None
+        if segment is None:
+            return
+        try:
+            segment.close()
+        except Exception as e:
+            logger.error(f"Error closing audit segment {segment.name} after a failed write: {e}")
+
+    def _run_writer(self):
+        while not self.stopping.wait(self.flush_seconds):
+            try:
+                self.write_pending()
+            except Exception as e:
+                logger.error(f"Error writing audit segment: {e}")
+        self.write_pending()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    # Shipping
+
+    def segment_key(self, name: str) -> str:
+        first, _ = _segment_range(name)
+        return f"{self.prefix}/date={first:%Y-%m-%d}/hour={first:%H}/{name}"
+
+    def closed_segments(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(SEGMENT_SUFFIX))
+
+    def upload_pending(self) -> int:
+        """Ship closed segments oldest first; stops at the first failure"""
+        uploaded = 0
+        for name in self.closed_segments():
+            path = os.path.join(self.spool_dir, name)
+            try:
+                self.s3_service.s3_client.upload_file(
+                    path,
+                    self.s3_service.bucket_name,
+                    self.segment_key(name),
+                    ExtraArgs={
+                        'ServerSideEncryption': 'AES256',
+                        'ContentType': 'application/x-ndjson',
+                        'ContentEncoding': 'gzip'
+                    }
+                )
+            except FileNotFoundError:
+                continue  # another worker sharing the spool shipped it first
+            except Exception as e:
+                self.upload_failures += 1
+                logger.error(f"Error uploading audit segment {name}, keeping it spooled: {e}")
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            uploaded += 1
+        self.uploaded += uploaded
+        return uploaded
+
+    def _run_uploader(self):
+        delay = self.upload_seconds
+        while not self.stopping.wait(delay):
+            before = self.upload_failures
+            self.upload_pending()
+            # Back off while S3 is failing; the spool keeps growing meanwhile
+            delay = min(delay * 2, 300) if self.upload_failures > before else self.upload_seconds
+        self.threads[0].join()
+        self.upload_pending()
+
+    def recover(self) -> int:
+        """Close segments a crashed process left open; returns records saved"""
+        recovered = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith(OPEN_SUFFIX) or _writer_alive(name, self.nonce):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            decompressor = zlib.decompressobj(wbits=31)
+            chunks = []
+            damaged = False
+            for offset in range(0, len(data), RECOVERY_CHUNK):
+                chunk = data[offset:offset + RECOVERY_CHUNK]
+                checkpoint = decompressor.copy()
+                try:
+                    chunks.append(decompressor.decompress(chunk))
+                except zlib.error:
+                    damaged = True
+                    # Replay the failing chunk a byte at a time to keep what precedes the damage
+                    for byte in range(len(chunk)):
+                        try:
+                            chunks.append(checkpoint.decompress(chunk[byte:byte + 1]))
+                        except zlib.error:
+                            break
+                    break
+            content = b"".join(chunks)
+            records = []
+            # The tail after the last sync point may be cut off mid-line
+            for line in content.split(b"\n"):
+                try:
+                    records.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    continue
+            if damaged:
+                # Kept for inspection; it no longer matches either suffix
+                os.replace(path, path + ".damaged")
+                logger.error(f"Audit segment {name} is damaged; kept as {name}.damaged")
+            else:
+                os.remove(path)
+            if records:
+                hour = datetime.fromisoformat(records[0]["ts"]).replace(minute=0, second=0, microsecond=0)
+                segment = AuditSegment(self.spool_dir, hour, self.nonce, self._next_sequence())
+                segment.write(records)
+                segment.close()
+                recovered += len(records)
+        if recovered:
+            logger.warning(f"Recovered {recovered} audit records from unfinished segments")
+        return recovered
+
+    def start(self):
+        """Start the writer and uploader threads"""
+        if not self.enabled or self.threads:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.recover()
+        self.stopping.clear()
+        self.threads = [
+            threading.Thread(target=self._run_writer, name="audit-writer", daemon=True),
+            threading.Thread(target=self._run_uploader, name="audit-uploader", daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Audit log spooling to {self.spool_dir}, shipping to {self.prefix}")
+
+    def stop(self):
+        """Write out everything buffered and make one last upload attempt"""
+        if not self.threads:
+            return
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self.buffer),
+            "spilled": self.buffer.spilled,
+            "dropped": self.buffer.dropped,
+            "written": self.written,
+            "segments_spooled": len(self.closed_segments()) if os.path.isdir(self.spool_dir) else 0,
+            "segments_uploaded": self.uploaded,
+            "upload_failures": self.upload_failures
+        }
+
+    # Reading
+
+    def segments(self, start: datetime, end: datetime) -> List[str]:
+        """Keys of segments that may hold records between start and end"""
+        paginator = self.s3_service.s3_client.get_paginator('list_objects_v2')
+        keys = []
+        hour = start.replace(minute=0, second=0, microsecond=0)
+        while hour <= end:
+            prefix = f"{self.prefix}/date={hour:%Y-%m-%d}/hour={hour:%H}/"
+            for page in paginator.paginate(Bucket=self.s3_service.bucket_name, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    first, last = _segment_range(item['Key'].rsplit("/", 1)[-1])
+                    # Names carry whole seconds, so the range is widened by one
+                    if first <= end and last + timedelta(seconds=1) >= start:
+                        keys.append(item['Key'])
+            hour += timedelta(hours=1)
+        return keys
+
+    def _scan(
+            self,
+            key: str,
+            patient_id: Optional[int],
+            actor: Optional[str],
+            start: str,
+            end: str
+    ) -> List[Dict[str, Any]]:
+        body = self.s3_service.s3_client.get_object(Bucket=self.s3_service.bucket_name, Key=key)['Body'].read()
+        # Cheap byte test before parsing; orjson writes compact JSON, so the match is exact
+        needle = orjson.dumps({"patient_id": patient_id})[1:-1] if patient_id is not None else None
+        matches = []
+        for line in gzip.decompress(body).splitlines():
+            if needle is not None and needle + b"," not in line and b'"patient_ids"' not in line:
+                continue
+            record = orjson.loads(line)
+            if not start <= record["ts"] <= end:
+                continue
+            if patient_id is not None and record["patient_id"] != patient_id \
+                    and patient_id not in record.get("patient_ids", ()):
+                continue
+            if actor is not None and record["actor"] != actor:
+                continue
+            matches.append(record)
+        return matches
+
+    def query(
+            self,
+            start: datetime,
+            end: datetime,
+            patient_id: Optional[int] = None,
+            actor: Optional[str] = None,
+            limit: Optional[int] = None,
+            workers: int = 8
+    ) -> Iterator[Dict[str, Any]]:
+        """Access records between start and end (UTC), oldest segment first"""
+        start, end = start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+        keys = self.segments(start, end)
+        found = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scans = pool.map(
+                lambda key: self._scan(
+                    key, patient_id, actor,
+                    start.isoformat(timespec="microseconds"), end.isoformat(timespec="microseconds")
+                ),
+                keys
+            )
+            for records in scans:
+                for record in records:
+                    yield record
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return
+
+
+def _utc(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value)
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PHI access audit log")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = subparsers.add_parser("query", help="Scan audit segments by patient and time range")
+    query_parser.add_argument("--start", type=_utc, required=True, help="ISO timestamp, UTC unless offset given")
+    query_parser.add_argument("--end", type=_utc, help="Defaults to now")
+    query_parser.add_argument("--patient-id", type=int)
+    query_parser.add_argument("--actor")
+    query_parser.add_argument("--limit", type=int)
+
+    subparsers.add_parser("upload", help="Recover and ship segments left in the spool directory")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    audit_log = AuditLog()
+    if args.command == "query":
+        end = args.end or datetime.now(timezone.utc)
+        for record in audit_log.query(args.start, end, args.patient_id, args.actor, args.limit):
+            print(orjson.dumps(record).decode())
+    else:
+        os.makedirs(audit_log.spool_dir, exist_ok=True)
+        audit_log.recover()
+        print(audit_log.upload_pending())
@@ -0,0 +1,430 @@
+# app/services/backup.py
+import argparse
+import gzip
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+from . import database
+from .s3_service import S3Service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class MultipartUploadWriter:
+    """File-like sink that streams bytes into an S3 multipart upload"""
+
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, 5 * MB)  # S3 minimum for all but the last part
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        response = s3_client.create_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            ServerSideEncryption='AES256',
+            ContentType='application/gzip'
+        )
+        self.upload_id = response['UploadId']
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload_part(part)
+
+    def _upload_part(self, data: bytes):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        """Upload the remaining bytes and complete the upload"""
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        """Abandon the upload so no partial object or orphaned parts remain"""
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id
+            )
+        except Exception as e:
+            logger.error(f"Error aborting multipart upload {self.key}: {e}")
+
+
+class ParallelGzipWriter:
+    """Compress fixed-size chunks on a thread pool and emit them in order.
+
+    Each chunk becomes its own gzip member; concatenated members form a
+    valid gzip stream. At most max_in_flight chunks are held in memory.
+    """
+
+    def __init__(self, sink, workers: int, chunk_size: int, level: int = 6):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_in_flight = workers * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            self._submit(chunk)
+
+    def _submit(self, chunk: bytes):
+        # zlib releases the GIL, so chunks compress concurrently
+        self.pending.append(self.executor.submit(gzip.compress, chunk, self.level))
+        while len(self.pending) >= self.max_in_flight:
+            self.sink.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.sink.write(self.pending.popleft().result())
+        self.executor.shutdown(wait=True)
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+def gunzip_stream(chunks: Iterable[bytes]) -> Iterable[bytes]:
+    """Decompress a stream that may contain several concatenated gzip members"""
+    decompressor = zlib.decompressobj(wbits=31)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+            else:
+                chunk = b""
+    yield decompressor.flush()
+
+
+class DatabaseBackupService:
+    """Stream pg_dump output through parallel gzip into S3, and back into psql"""
+
+    def __init__(self, s3_service: Optional[S3Service] = None):
+        self.s3_service = s3_service or S3Service()
+        self.prefix = self.s3_service.paths['backups']
+        self.compress_workers = int(os.getenv("BACKUP_COMPRESS_WORKERS", str(os.cpu_count() or 2)))
+        self.chunk_size = int(os.getenv("BACKUP_CHUNK_SIZE_MB", "4")) * MB
+        self.part_size = int(os.getenv("BACKUP_PART_SIZE_MB", "32")) * MB
+        self.read_size = 1 * MB
+
+    def _pg_env(self):
+        env = dict(os.environ)
+        env['PGPASSWORD'] = database.DB_PASSWORD
+        return env
+
+    def _pg_args(self) -> List[str]:
+        return [
+            '--host', database.DB_HOST,
+            '--port', str(database.DB_PORT),
+            '--username', database.DB_USER
+        ]
+
+    @staticmethod
+    def _list_tables(conn) -> List[str]:
+        rows = conn.execute(text(
+            "SELECT tablename FROM pg_tables WHERE schemaname = 'public' "
+            "ORDER BY pg_total_relation_size(quote_ident(tablename)) DESC"
+        )).all()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _row_counts(conn, tables: List[str]) -> dict:
+        return {
+            table: conn.execute(text(f'SELECT count(*) FROM public."{table}"')).scalar()
+            for table in tables
+        }
+
+    def list_tables(self) -> List[str]:
+        """Tables in the public schema, largest first so they start early"""
+        with database.engine.connect() as conn:
+            return self._list_tables(conn)
+
+    @contextmanager
+    def exported_snapshot(self):
+        """Hold a repeatable-read transaction open and yield (connection, snapshot id).
+
+        Every pg_dump started with --snapshot=<id> while this is open sees
+        exactly the same database state, so per-table dumps are consistent
+        with each other.
+        """
+        with database.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="REPEATABLE READ")
+            with conn.begin():
+                snapshot = conn.execute(text("SELECT pg_export_snapshot()")).scalar()
+                logger.info(f"Exported snapshot {snapshot}")
+                yield conn, snapshot
+
+    @staticmethod
+    def _stderr_text(stderr, limit: int = 4096) -> str:
+        """The tail of a captured stderr file, where the fatal error is"""
+        size = stderr.seek(0, os.SEEK_END)
+        stderr.seek(max(size - limit, 0))
+        return stderr.read().decode('utf-8', 'replace').strip()
+
+    def dump_to_s3(self, key: str, dump_args: List[str]) -> int:
+        """Run pg_dump with the given arguments and stream it to one S3 object"""
+        command = ['pg_dump', *self._pg_args(), '--format=plain', *dump_args, database.DB_NAME]
+        uploader = MultipartUploadWriter(
+            self.s3_service.s3_client,
+            self.s3_service.bucket_name,
+            key,
+            self.part_size
+        )
+        compressor = ParallelGzipWriter(uploader, self.compress_workers, self.chunk_size)
+        # stderr goes to a file so a chatty pg_dump cannot block on a full pipe
+        # while we are only reading stdout
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                env=self._pg_env()
+            )
+            try:
+                while True:
+                    data = process.stdout.read(self.read_size)
+                    if not data:
+                        break
+                    compressor.write(data)
+                process.wait()
+                if process.returncode != 0:
+                    raise RuntimeError(f"pg_dump failed: {self._stderr_text(stderr)}")
+                compressor.close()
+                uploader.close()
+            except BaseException:
+                process.kill()
+                process.wait()
+                compressor.abort()
+                uploader.abort()
+                raise
+        logger.info(f"Backup uploaded: {key} ({uploader.bytes_written} compressed bytes)")
+        return uploader.bytes_written
+
+    def _write_manifest(self, backup_prefix: str, manifest: dict):
+        self.s3_service.s3_client.put_object(
+            Bucket=self.s3_service.bucket_name,
+            Key=f"{backup_prefix}/manifest.json",
+            Body=json.dumps(manifest).encode('utf-8'),
+            ServerSideEncryption='AES256',
+            ContentType='application/json'
+        )
+
+    def backup(self, per_table: bool = False, tables: Optional[List[str]] = None, parallel: int = 4) -> str:
+        """Create a backup and return its S3 prefix.
+
+        tables limits a per-table backup to those tables; a full dump always
+        covers the whole database, so combining the two is rejected.
+        """
+        if tables and not per_table:
+            raise ValueError("tables can only be given for a per-table backup")
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        backup_prefix = f"{self.prefix}/{timestamp}"
+        manifest = {"created_at": timestamp, "database": database.DB_NAME, "per_table": per_table}
+
+        with self.exported_snapshot() as (conn, snapshot):
+            snapshot_args = [f'--snapshot={snapshot}']
+            tables = tables or self._list_tables(conn)
+            # Counted inside the same snapshot the dumps read, for verify()
+            manifest["row_counts"] = self._row_counts(conn, tables)
+
+            if not per_table:
+                self.dump_to_s3(f"{backup_prefix}/full.sql.gz", snapshot_args)
+                manifest["files"] = ["full.sql.gz"]
+            else:
+                # Tables are created before, and constraints/indexes after, the data
+                # so that per-table data files can be loaded in any order
+                self.dump_to_s3(f"{backup_prefix}/pre-data.sql.gz", [*snapshot_args, '--section=pre-data'])
+                with ThreadPoolExecutor(max_workers=parallel) as pool:
+                    futures = [
+                        pool.submit(
+                            self.dump_to_s3,
+                            f"{backup_prefix}/data/{table}.sql.gz",
+                            [*snapshot_args, '--section=data', f'--table=public.{table}']
+                        )
+                        for table in tables
+                    ]
+                    for future in futures:
+                        future.result()
+                self.dump_to_s3(f"{backup_prefix}/post-data.sql.gz", [*snapshot_args, '--section=post-data'])
+                manifest["tables"] = tables
+                manifest["files"] = ["pre-data.sql.gz"] + [f"data/{t}.sql.gz" for t in tables] + ["post-data.sql.gz"]
+
+        self._write_manifest(backup_prefix, manifest)
+        logger.info(f"Database backup complete: {backup_prefix}")
+        return backup_prefix
+
+    def restore_object(self, key: str, target_db: Optional[str] = None):
+        """Stream one backup object from S3 through gunzip into psql"""
+        response = self.s3_service.s3_client.get_object(
+            Bucket=self.s3_service.bucket_name,
+            Key=key
+        )
+        command = [
+            'psql', *self._pg_args(),
+            '--quiet', '--set', 'ON_ERROR_STOP=1',
+            '--dbname', target_db or database.DB_NAME
+        ]
+        # psql reports every failing statement on stderr; a file never fills up
+        # and stalls it while we are blocked writing to its stdin
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+                env=self._pg_env()
+            )
+            try:
+                for data in gunzip_stream(response['Body'].iter_chunks(self.read_size)):
+                    if data:
+                        process.stdin.write(data)
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                response['Body'].close()
+            process.wait()
+            if process.returncode != 0:
+                raise RuntimeError(f"psql failed restoring {key}: {self._stderr_text(stderr)}")
+        logger.info(f"Restored {key}")
+
+    def restore(self, backup_prefix: str, target_db: Optional[str] = None, parallel: int = 4):
+        """Restore a backup created by backup()"""
+        response = self.s3_service.s3_client.get_object(
+            Bucket=self.s3_service.bucket_name,
+            Key=f"{backup_prefix}/manifest.json"
+        )
+        manifest = json.loads(response['Body'].read())
+
+        if not manifest.get("per_table"):
+            self.restore_object(f"{backup_prefix}/full.sql.gz", target_db)
+            return
+
+        self.restore_object(f"{backup_prefix}/pre-data.sql.gz", target_db)
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = [
+                pool.submit(self.restore_object, f"{backup_prefix}/data/{table}.sql.gz", target_db)
+                for table in manifest["tables"]
+            ]
+            for future in futures:
+                future.result()
+        self.restore_object(f"{backup_prefix}/post-data.sql.gz", target_db)
+
+    def verify(self, backup_prefix: str, target_db: str) -> dict:
+        """Compare row counts in a restored database against the backup manifest.
+
+        Returns {table: (expected, restored)} for every table that differs.
+        """
+        response = self.s3_service.s3_client.get_object(
+            Bucket=self.s3_service.bucket_name,
+            Key=f"{backup_prefix}/manifest.json"
+        )
+        expected = json.loads(response['Body'].read()).get("row_counts", {})
+        target_engine = create_engine(
+            database.DATABASE_URL.rsplit("/", 1)[0] + f"/{target_db}"
+        )
+        try:
+            with target_engine.connect() as conn:
+                restored = self._row_counts(conn, list(expected))
+        finally:
+            target_engine.dispose()
+        mismatches = {
+            table: (count, restored[table])
+            for table, count in expected.items()
+            if restored[table] != count
+        }
+        for table, (count, actual) in mismatches.items():
+            logger.error(f"Row count mismatch in {table}: backup {count}, restored {actual}")
+        logger.info(f"Verified {len(expected)} tables against {target_db}: {len(mismatches)} mismatches")
+        return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming database backup to S3")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backup_parser = subparsers.add_parser("backup")
+    backup_parser.add_argument("--per-table", action="store_true")
+    backup_parser.add_argument("--tables", nargs="*")
+    backup_parser.add_argument("--parallel", type=int, default=4)
+
+    restore_parser = subparsers.add_parser("restore")
+    restore_parser.add_argument("prefix", help="Backup prefix, e.g. healthcare/backups/database/20240101_000000")
+    restore_parser.add_argument("--target-db")
+    restore_parser.add_argument("--parallel", type=int, default=4)
+
+    # Round trip: back up, restore into a scratch database, compare row counts
+    verify_parser = subparsers.add_parser("verify")
+    verify_parser.add_argument("target_db", help="Existing empty database to restore into")
+    verify_parser.add_argument("--prefix", help="Verify an existing backup instead of taking a new one")
+    verify_parser.add_argument("--per-table", action="store_true")
+    verify_parser.add_argument("--parallel", type=int, default=4)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "backup" and args.tables and not args.per_table:
+        parser.error("--tables requires --per-table")
+
+    service = DatabaseBackupService()
+    if args.command == "backup":
+        print(service.backup(per_table=args.per_table, tables=args.tables, parallel=args.parallel))
+    elif args.command == "restore":
+        service.restore(args.prefix, target_db=args.target_db, parallel=args.parallel)
+    else:
+        prefix = args.prefix or service.backup(per_table=args.per_table, parallel=args.parallel)
+        service.restore(prefix, target_db=args.target_db, parallel=args.parallel)
+        raise SystemExit(1 if service.verify(prefix, args.target_db) else 0)
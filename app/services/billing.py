@@ -0,0 +1,254 @@
+# app/services/billing.py
+import argparse
+import logging
+import os
+import time
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY, INTEGER, NUMERIC
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Serialises recomputes of the same patient: two transactions that each load
+# the old amounts and write their own result would otherwise race, the later
+# commit winning with a view that misses the other's change. Taken in id
+# order so batch jobs and API calls cannot deadlock; released at commit.
+LOCK_NAMESPACE = 0x62696c6c  # "bill", keeps these keys apart from other advisory locks
+LOCK_SQL = text("""
+    SELECT pg_advisory_xact_lock(:namespace, patient_id)
+    FROM unnest(:patient_ids) AS patient_id
+    ORDER BY patient_id
+""").bindparams(bindparam("patient_ids", type_=ARRAY(INTEGER)))
+
+# Each treatment with the policy in force on its date (the most recently
+# started one when several overlap), or NULLs when it was not covered
+LOAD_SQL = text("""
+    SELECT DISTINCT ON (t.treatment_id)
+           t.treatment_id, t.patient_id, t.treatment_date, t.cost,
+           i.insurance_id, i.deductible, i.copay, i.coinsurance_rate,
+           i.out_of_pocket_max, i.annual_benefit_max
+    FROM treatments t
+    LEFT JOIN insurance i
+      ON i.patient_id = t.patient_id
+     AND i.coverage_period @> t.treatment_date
+    WHERE t.patient_id = ANY(:patient_ids)
+      AND t.treatment_date >= :start
+      AND t.treatment_date <= :end
+    ORDER BY t.treatment_id, i.coverage_start_date DESC NULLS LAST, i.insurance_id
+""").bindparams(bindparam("patient_ids", type_=ARRAY(INTEGER)))
+
+# Only rows whose amounts change are touched, so ETags and updated_at stay put otherwise
+WRITE_SQL = text("""
+    UPDATE treatments t
+    SET insurance_coverage = v.coverage,
+        patient_responsibility = v.responsibility,
+        updated_at = now()
+    FROM unnest(:treatment_ids, :coverage, :responsibility) AS v(treatment_id, coverage, responsibility)
+    WHERE t.treatment_id = v.treatment_id
+      AND (t.insurance_coverage IS DISTINCT FROM v.coverage
+           OR t.patient_responsibility IS DISTINCT FROM v.responsibility)
+    RETURNING t.treatment_id
+""").bindparams(
+    bindparam("treatment_ids", type_=ARRAY(INTEGER)),
+    bindparam("coverage", type_=ARRAY(NUMERIC(10, 2))),
+    bindparam("responsibility", type_=ARRAY(NUMERIC(10, 2)))
+)
+
+PATIENTS_SQL = text("""
+    SELECT DISTINCT patient_id FROM treatments
+    WHERE treatment_date >= :start AND treatment_date <= :end AND patient_id > :after
+    ORDER BY patient_id
+    LIMIT :limit
+""")
+
+
+def _cents(values: Iterable[Optional[Decimal]], missing: int) -> np.ndarray:
+    return np.array(
+        [missing if value is None else int(round(value * 100)) for value in values],
+        dtype=np.int64
+    )
+
+
+def _group_cumsum(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Running total restarting at every group start (rows sorted by group)"""
+    totals = np.cumsum(values)
+    offsets = np.repeat(totals[starts] - values[starts], np.diff(np.append(starts, len(values))))
+    return totals - offsets
+
+
+def _capped_increments(values: np.ndarray, starts: np.ndarray, cap: np.ndarray) -> np.ndarray:
+    """Per-row amounts after limiting each group's running total to its cap"""
+    running = _group_cumsum(values, starts)
+    capped = np.minimum(running, cap)
+    return capped - np.minimum(running - values, cap)
+
+
+def compute_responsibility(
+        group: np.ndarray,
+        cost: np.ndarray,
+        deductible: np.ndarray,
+        copay: np.ndarray,
+        coinsurance_bp: np.ndarray,
+        out_of_pocket_max: np.ndarray,
+        benefit_max: np.ndarray
+) -> np.ndarray:
+    """Patient share in cents for treatments sorted by (group, date, id).
+
+    A group is one policy's plan year. Per visit the patient pays the copay,
+    then the rest of the annual deductible, then coinsurance on what is left;
+    the patient's yearly total stops at the out-of-pocket maximum and the
+    insurer's at the annual benefit maximum, beyond which the patient pays.
+    Rule arrays are per row; uncovered rows use a deductible of at least
+    the cost so the patient pays in full.
+    """
+    if len(cost) == 0:
+        return cost.copy()
+    starts = np.flatnonzero(np.append(True, group[1:] != group[:-1]))
+
+    copay_part = np.minimum(copay, cost)
+    remaining = cost - copay_part
+    deductible_left = np.maximum(deductible - (_group_cumsum(remaining, starts) - remaining), 0)
+    deductible_part = np.minimum(remaining, deductible_left)
+    coinsurance_part = np.rint((remaining - deductible_part) * coinsurance_bp / 10000).astype(np.int64)
+
+    patient = _capped_increments(copay_part + deductible_part + coinsurance_part, starts, out_of_pocket_max)
+    insurer = _capped_increments(cost - patient, starts, benefit_max)
+    return cost - insurer
+
+
+class BillingEngine:
+    """Derive insurance_coverage and patient_responsibility from policy rules"""
+
+    def __init__(self):
+        self.enabled = os.getenv("BILLING_ENABLED", "true").lower() == "true"
+        self.batch_size = int(os.getenv("BILLING_BATCH_SIZE", "5000"))
+
+    def compute(self, rows: List) -> Dict[str, np.ndarray]:
+        """Columnar billing for loaded rows; returns ids with coverage and responsibility in cents"""
+        if not rows:
+            empty = np.array([], dtype=np.int64)
+            return {"treatment_ids": empty, "coverage": empty, "responsibility": empty}
+
+        patient_ids = np.array([row.patient_id for row in rows], dtype=np.int64)
+        insurance_ids = np.array([row.insurance_id or 0 for row in rows], dtype=np.int64)
+        years = np.array([row.treatment_date.year for row in rows], dtype=np.int64)
+        ordinals = np.array([row.treatment_date.toordinal() for row in rows], dtype=np.int64)
+        treatment_ids = np.array([row.treatment_id for row in rows], dtype=np.int64)
+        order = np.lexsort((treatment_ids, ordinals, years, insurance_ids, patient_ids))
+
+        cost = _cents((row.cost for row in rows), 0)[order]
+        covered = (insurance_ids != 0)[order]
+        unlimited = np.iinfo(np.int64).max // 4
+        deductible = np.where(covered, _cents((row.deductible for row in rows), 0)[order], unlimited)
+        copay = _cents((row.copay for row in rows), 0)[order]
+        coinsurance_bp = np.array(
+            [int(round((row.coinsurance_rate or 0) * 10000)) for row in rows], dtype=np.int64
+        )[order]
+        out_of_pocket_max = _cents((row.out_of_pocket_max for row in rows), unlimited)[order]
+        benefit_max = _cents((row.annual_benefit_max for row in rows), unlimited)[order]
+
+        # One dense code per (patient, policy, year); uncovered rows share policy 0
+        keys = np.stack([patient_ids[order], insurance_ids[order], years[order]], axis=1)
+        change = np.append(True, np.any(keys[1:] != keys[:-1], axis=1))
+        group = np.cumsum(change)
+
+        responsibility = compute_responsibility(
+            group, cost, deductible, copay, coinsurance_bp, out_of_pocket_max, benefit_max
+        )
+        return {
+            "treatment_ids": treatment_ids[order],
+            "coverage": cost - responsibility,
+            "responsibility": responsibility
+        }
+
+    def write(self, db: Session, result: Dict[str, np.ndarray]) -> List[int]:
+        """Bulk update changed amounts; returns the ids that changed"""
+        if len(result["treatment_ids"]) == 0:
+            return []
+        rows = db.execute(WRITE_SQL, {
+            "treatment_ids": result["treatment_ids"].tolist(),
+            "coverage": [Decimal(int(c)).scaleb(-2) for c in result["coverage"]],
+            "responsibility": [Decimal(int(r)).scaleb(-2) for r in result["responsibility"]]
+        }).all()
+        return [row.treatment_id for row in rows]
+
+    def recompute(self, db: Session, patient_ids: List[int], start: date, end: date) -> List[int]:
+        """Recompute whole plan years for these patients inside the caller's transaction.
+
+        start and end are widened to calendar years, since a deductible
+        carries across every visit of the year. A per-patient advisory lock
+        is held until the caller commits, so concurrent recomputes of a
+        patient run one after another. Returns the changed ids.
+        """
+        if not self.enabled or not patient_ids:
+            return []
+        db.execute(LOCK_SQL, {"namespace": LOCK_NAMESPACE, "patient_ids": list(patient_ids)})
+        rows = db.execute(LOAD_SQL, {
+            "patient_ids": list(patient_ids),
+            "start": date(start.year, 1, 1),
+            "end": date(end.year, 12, 31)
+        }).all()
+        return self.write(db, self.compute(rows))
+
+    def recompute_patient_years(self, db: Session, patient_id: int, dates: Iterable[Optional[date]]) -> List[int]:
+        """Recompute the plan years spanning the given dates for one patient"""
+        dates = [d for d in dates if d is not None]
+        if not dates:
+            return []
+        return self.recompute(db, [patient_id], min(dates), max(dates))
+
+    def recompute_range(self, start: date, end: date) -> int:
+        """Bulk job: recompute every patient with treatments in the range, batch by batch"""
+        started = time.monotonic()
+        after, changed, batches = 0, 0, 0
+        while True:
+            db = SessionLocal()
+            try:
+                patient_ids = db.execute(PATIENTS_SQL, {
+                    "start": date(start.year, 1, 1),
+                    "end": date(end.year, 12, 31),
+                    "after": after,
+                    "limit": self.batch_size
+                }).scalars().all()
+                if not patient_ids:
+                    break
+                changed += len(self.recompute(db, patient_ids, start, end))
+                db.commit()
+            finally:
+                db.close()
+            after = patient_ids[-1]
+            batches += 1
+            logger.info(f"Billing batch {batches}: patients through {after}, {changed} treatments changed")
+        logger.info(f"Billing recompute {start}..{end} done in {time.monotonic() - started:.1f}s: {changed} changed")
+        return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute treatment billing from insurance rules")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    recompute_parser = subparsers.add_parser("recompute", help="Recompute all treatments in a date range")
+    recompute_parser.add_argument("--start", type=date.fromisoformat, required=True)
+    recompute_parser.add_argument("--end", type=date.fromisoformat, required=True)
+    recompute_parser.add_argument("--batch-size", type=int, help="Patients per transaction")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    billing = BillingEngine()
+    billing.enabled = True
+    if args.batch_size:
+        billing.batch_size = args.batch_size
+    print(billing.recompute_range(args.start, args.end))
+    # No events are sent for bulk changes; rebuild the aggregates afterwards
+    print("Run `python -m app.services.analytics backfill` to refresh analytics")
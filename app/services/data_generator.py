@@ -0,0 +1,487 @@
+# app/services/data_generator.py
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from dotenv import load_dotenv
+from kafka import KafkaProducer
+
+from . import database
+from .encryption import get_field_encryptor
+from .kafka_producer import patient_key
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FIRST_NAMES = np.array([
+    "James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David", "Elizabeth",
+    "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah", "Carlos", "Maria",
+    "Wei", "Mei", "Ahmed", "Fatima", "Hiroshi", "Yuki", "Somchai", "Malee", "Ivan", "Olga",
+    "Kwame", "Ama", "Raj", "Priya", "Liam", "Emma", "Noah", "Olivia", "Lucas", "Sofia"
+])
+LAST_NAMES = np.array([
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Lee",
+    "Nguyen", "Chen", "Wang", "Kim", "Patel", "Singh", "Sato", "Suzuki", "Sriwongsanguan", "Ivanov",
+    "Mensah", "Okafor", "Cohen", "Muller", "Rossi", "Dubois", "Silva", "Santos", "Walker", "Young"
+])
+GENDERS = np.array(["MALE", "FEMALE", "OTHER"])  # enum names, as SQLAlchemy stores them
+GENDER_WEIGHTS = [0.49, 0.49, 0.02]
+MARITAL_STATUSES = np.array(["SINGLE", "MARRIED", "DIVORCED", "WIDOWED"])
+MARITAL_WEIGHTS = [0.35, 0.45, 0.12, 0.08]
+RACES = np.array(["White", "Black", "Asian", "Hispanic", "Native American", "Pacific Islander", "Other"])
+RACE_WEIGHTS = [0.58, 0.13, 0.07, 0.17, 0.01, 0.01, 0.03]
+OCCUPATIONS = np.array([
+    "Teacher", "Engineer", "Nurse", "Accountant", "Chef", "Driver", "Retail Associate", "Student",
+    "Retired", "Software Developer", "Electrician", "Sales Manager", "Farmer", "Artist", "Lawyer"
+])
+STREETS = np.array([
+    "Main St", "Oak Ave", "Pine Rd", "Maple Dr", "Cedar Ln", "Elm St", "Lakeview Blvd", "Hillside Ave",
+    "Park Pl", "River Rd", "Sunset Blvd", "Washington St"
+])
+CITIES = np.array([
+    "Springfield, IL", "Portland, OR", "Austin, TX", "Columbus, OH", "Denver, CO", "Madison, WI",
+    "Raleigh, NC", "Tucson, AZ", "Boise, ID", "Albany, NY"
+])
+
+# (diagnosis, treatment description, median cost)
+DIAGNOSES = [
+    ("Hypertension", "Blood pressure check and medication review", 180.0),
+    ("Type 2 diabetes", "HbA1c test and dietary counseling", 240.0),
+    ("Acute bronchitis", "Physical exam and prescribed inhaler", 150.0),
+    ("Lower back pain", "Physical therapy session", 120.0),
+    ("Migraine", "Neurological assessment and medication", 220.0),
+    ("Sprained ankle", "X-ray and compression bandaging", 310.0),
+    ("Seasonal allergies", "Allergy consultation and antihistamines", 95.0),
+    ("Dental caries", "Composite filling", 260.0),
+    ("Skin laceration", "Wound cleaning and sutures", 340.0),
+    ("Annual physical", "Routine examination and blood panel", 200.0),
+    ("Fractured wrist", "Cast application and follow-up imaging", 950.0),
+    ("Appendicitis", "Laparoscopic appendectomy", 12500.0),
+]
+DIAGNOSIS_WEIGHTS = np.array([14, 10, 9, 9, 6, 6, 8, 7, 5, 20, 4, 2], dtype=float)
+DIAGNOSIS_WEIGHTS /= DIAGNOSIS_WEIGHTS.sum()
+PROVIDER_NOTES = np.array([
+    "Patient responded well; continue current plan.",
+    "Discussed lifestyle changes; recheck in a few weeks.",
+    "Symptoms improving. No adverse reactions reported.",
+    "Referred to specialist for further evaluation.",
+    "Patient reports mild discomfort; prescribed pain relief.",
+])
+INSURERS = np.array([
+    "Blue Cross Blue Shield", "Aetna", "Cigna", "UnitedHealthcare", "Humana", "Kaiser Permanente", "Medicare"
+])
+SUBSCRIBER_RELATIONSHIPS = np.array(["self", "spouse", "parent", "child"])
+
+PATIENT_COLUMNS = [
+    "patient_id", "first_name", "last_name", "date_of_birth", "gender", "marital_status", "race",
+    "occupation", "email", "phone", "address", "email_bidx", "phone_bidx"
+]
+INSURANCE_COLUMNS = [
+    "insurance_id", "patient_id", "provider_name", "policy_number", "group_number", "subscriber_name",
+    "subscriber_relationship", "coverage_start_date", "coverage_end_date"
+]
+TREATMENT_COLUMNS = [
+    "treatment_id", "patient_id", "treatment_date", "diagnosis", "treatment_description", "provider_notes",
+    "cost", "insurance_coverage", "patient_responsibility", "follow_up_date"
+]
+IMAGE_COLUMNS = ["image_id", "treatment_id", "image_type", "s3_key"]
+
+# Primary key columns, in load order so foreign keys always resolve
+ID_COLUMNS = [
+    ("patients", "patient_id"),
+    ("insurance", "insurance_id"),
+    ("treatments", "treatment_id"),
+    ("patient_images", "image_id"),
+]
+
+
+@dataclass
+class GeneratorConfig:
+    seed: int
+    treatments_per_patient: float
+    insurance_per_patient: float
+    images_per_treatment: float
+    start_date: date
+    end_date: date
+    replay: bool
+
+
+@dataclass
+class ChunkPlan:
+    """One unit of work: a patient range and the first id of every child table"""
+    index: int
+    patients: int
+    first_ids: Dict[str, int]
+
+
+def _chunk_rng(config: GeneratorConfig, index: int, stream: int) -> np.random.Generator:
+    # Independent streams per chunk keep output identical whatever the worker count
+    return np.random.default_rng([config.seed, index, stream])
+
+
+def chunk_counts(config: GeneratorConfig, index: int, patients: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Per-patient treatment and insurance counts and per-treatment image counts"""
+    rng = _chunk_rng(config, index, 0)
+    treatments = rng.poisson(config.treatments_per_patient, patients)
+    insurance = rng.poisson(config.insurance_per_patient, patients)
+    images = rng.poisson(config.images_per_treatment, int(treatments.sum()))
+    return treatments, insurance, images
+
+
+def _random_dates(rng: np.random.Generator, start: date, end: date, size: int) -> np.ndarray:
+    span = (end - start).days + 1
+    return np.datetime64(start, "D") + rng.integers(0, span, size)
+
+
+def _text(values) -> pa.Array:
+    if isinstance(values, str):
+        return values
+    return pc.cast(pa.array(values), pa.string())
+
+
+def _concat(*parts) -> pa.Array:
+    """Element-wise string concatenation of columns and literals, in Arrow"""
+    return pc.binary_join_element_wise(*[_text(part) for part in parts], "")
+
+
+def _nullable(values, present: np.ndarray) -> pa.Array:
+    """Column holding values where present and NULL elsewhere"""
+    return pa.array(values, mask=~present)
+
+
+def _group_offsets(lengths: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Running sum of lengths within each run of equal group values, excluding the current row"""
+    before = np.cumsum(lengths) - lengths
+    new_run = np.append(True, groups[1:] != groups[:-1])
+    return before - before[np.flatnonzero(new_run)][np.cumsum(new_run) - 1]
+
+
+def generate_chunk(config: GeneratorConfig, plan: ChunkPlan) -> Dict[str, pa.Table]:
+    """Build one chunk as columnar Arrow tables, children after parents.
+
+    Every column is computed whole with NumPy or Arrow kernels; the only
+    per-value Python left is encryption, where each value needs its own
+    nonce.
+    """
+    encryptor = get_field_encryptor()
+    treatment_counts, insurance_counts, image_counts = chunk_counts(config, plan.index, plan.patients)
+    rng = _chunk_rng(config, plan.index, 1)
+
+    # Patients
+    n = plan.patients
+    patient_ids = np.arange(plan.first_ids["patients"], plan.first_ids["patients"] + n)
+    first = FIRST_NAMES[rng.integers(0, len(FIRST_NAMES), n)]
+    last = LAST_NAMES[rng.integers(0, len(LAST_NAMES), n)]
+    birth = _random_dates(rng, date(1930, 1, 1), date(2020, 12, 31), n)
+    gender = rng.choice(GENDERS, n, p=GENDER_WEIGHTS)
+    marital = rng.choice(MARITAL_STATUSES, n, p=MARITAL_WEIGHTS)
+    race = rng.choice(RACES, n, p=RACE_WEIGHTS)
+    occupation = OCCUPATIONS[rng.integers(0, len(OCCUPATIONS), n)]
+    phone_numbers = rng.integers(2_000_000_000, 9_999_999_999, n)
+    house_numbers = rng.integers(1, 9999, n)
+    street = STREETS[rng.integers(0, len(STREETS), n)]
+    city = CITIES[rng.integers(0, len(CITIES), n)]
+
+    # The id keeps emails unique, as the email blind index requires
+    email = _concat(
+        pc.utf8_lower(pa.array(first)), ".", pc.utf8_lower(pa.array(last)), ".", patient_ids, "@example.com"
+    )
+    phone = _concat(
+        "(", phone_numbers // 10 ** 7, ") ",
+        pc.utf8_lpad(_text(phone_numbers // 10 ** 4 % 1000), width=3, padding="0"), "-",
+        pc.utf8_lpad(_text(phone_numbers % 10 ** 4), width=4, padding="0")
+    )
+    address = _concat(house_numbers, " ", street, ", ", city)
+    email_list, phone_list = email.to_pylist(), phone.to_pylist()
+    patients = pa.table([
+        patient_ids, first, last, birth, gender, marital, race, occupation,
+        encryptor.encrypt_many(email_list, "email"),
+        encryptor.encrypt_many(phone_list, "phone"),
+        encryptor.encrypt_many(address.to_pylist(), "address"),
+        encryptor.blind_index_many(email_list, "email"),
+        encryptor.blind_index_many(phone_list, "phone")
+    ], names=PATIENT_COLUMNS)
+
+    # Insurance: consecutive policies per patient, each starting the day after
+    # the previous one ends, the last one possibly open-ended
+    m = int(insurance_counts.sum())
+    insurance_patients = np.repeat(patient_ids, insurance_counts)
+    insurance_names = _concat(np.repeat(first, insurance_counts), " ", np.repeat(last, insurance_counts))
+    first_start = _random_dates(rng, config.start_date - timedelta(days=5 * 365), config.start_date, n)
+    coverage_days = rng.integers(180, 3 * 365, m)
+    coverage_start = np.repeat(first_start, insurance_counts) + _group_offsets(coverage_days + 1, insurance_patients)
+    coverage_end = coverage_start + coverage_days
+    is_last = np.ones(m, dtype=bool)
+    is_last[:-1] = insurance_patients[1:] != insurance_patients[:-1]
+    ends_open = is_last & (rng.random(m) < 0.7)
+    insurer = INSURERS[rng.integers(0, len(INSURERS), m)]
+    policy_numbers = rng.integers(10 ** 8, 10 ** 9, m)
+    group_numbers = rng.integers(1000, 99999, m)
+    relationship = rng.choice(SUBSCRIBER_RELATIONSHIPS, m, p=[0.7, 0.15, 0.1, 0.05])
+    insurance = pa.table([
+        np.arange(plan.first_ids["insurance"], plan.first_ids["insurance"] + m), insurance_patients, insurer,
+        _concat("POL", policy_numbers), _concat("GRP", group_numbers), insurance_names, relationship,
+        coverage_start, _nullable(coverage_end, ~ends_open)
+    ], names=INSURANCE_COLUMNS)
+
+    # Treatments: lognormal costs around each diagnosis' median
+    t = int(treatment_counts.sum())
+    treatment_ids = np.arange(plan.first_ids["treatments"], plan.first_ids["treatments"] + t)
+    treatment_patients = np.repeat(patient_ids, treatment_counts)
+    treatment_dates = _random_dates(rng, config.start_date, config.end_date, t)
+    diagnosis_index = rng.choice(len(DIAGNOSES), t, p=DIAGNOSIS_WEIGHTS)
+    medians = np.array([median for _, _, median in DIAGNOSES])[diagnosis_index]
+    cost = np.round(medians * rng.lognormal(0.0, 0.35, t), 2)
+    covered = rng.random(t) < 0.8
+    coverage = np.where(covered, np.round(cost * rng.uniform(0.5, 0.95, t), 2), 0.0)
+    responsibility = np.round(cost - coverage, 2)
+    follow_up = treatment_dates + rng.integers(7, 90, t)
+    has_follow_up = rng.random(t) < 0.4
+    has_notes = rng.random(t) < 0.3
+    notes = PROVIDER_NOTES[rng.integers(0, len(PROVIDER_NOTES), t)]
+    encrypted_notes = np.full(t, None, dtype=object)
+    encrypted_notes[has_notes] = encryptor.encrypt_many(notes[has_notes].tolist(), "provider_notes")
+    treatments = pa.table([
+        treatment_ids, treatment_patients, treatment_dates,
+        np.array([name for name, _, _ in DIAGNOSES])[diagnosis_index],
+        np.array([description for _, description, _ in DIAGNOSES])[diagnosis_index],
+        pa.array(encrypted_notes, type=pa.string()),
+        cost, _nullable(coverage, covered), responsibility,
+        _nullable(follow_up, has_follow_up)
+    ], names=TREATMENT_COLUMNS)
+
+    # Images: alternate before/after per treatment
+    k = int(image_counts.sum())
+    image_treatments = np.repeat(treatment_ids, image_counts)
+    image_patients = np.repeat(treatment_patients, image_counts)
+    first_of_treatment = np.repeat(np.cumsum(image_counts) - image_counts, image_counts)
+    position = np.arange(k) - first_of_treatment
+    images = pa.table([
+        np.arange(plan.first_ids["patient_images"], plan.first_ids["patient_images"] + k), image_treatments,
+        np.where(position % 2 == 0, "before", "after"),
+        _concat(
+            "healthcare/patient_images/", image_patients, "/synthetic_", image_treatments, "_", position, ".jpg"
+        )
+    ], names=IMAGE_COLUMNS)
+
+    return {"patients": patients, "insurance": insurance, "treatments": treatments, "patient_images": images}
+
+
+def _copy(cursor, table: str, rows: pa.Table):
+    if not rows.num_rows:
+        return
+    buffer = io.BytesIO()
+    # Written by Arrow in C++; nulls become unquoted empty fields, i.e. NULL
+    pa_csv.write_csv(rows, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(rows.column_names)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+_producer: Optional[KafkaProducer] = None
+
+
+def _replay_producer() -> KafkaProducer:
+    global _producer
+    if _producer is None:
+        _producer = KafkaProducer(
+            bootstrap_servers=os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092"),
+            value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+            key_serializer=lambda k: k.encode('utf-8') if k else None,
+            linger_ms=20,
+            batch_size=256 * 1024,
+            acks=1
+        )
+    return _producer
+
+
+def replay_events(rows: Dict[str, pa.Table]):
+    """Publish the events the API would have sent for these rows"""
+    producer = _replay_producer()
+    for row in rows["insurance"].select(["insurance_id", "patient_id"]).to_pylist():
+        event = {"type": "new_insurance", **row, "event_type": "insurance"}
+        producer.send("insurance-updates", event, key=patient_key(event))
+    treatments = rows["treatments"].select([
+        "treatment_id", "patient_id", "treatment_date", "diagnosis", "cost",
+        "insurance_coverage", "patient_responsibility", "follow_up_date"
+    ])
+    for row in treatments.to_pylist():
+        event = {
+            "type": "new_treatment",
+            **row,
+            "treatment_date": row["treatment_date"].isoformat(),
+            "follow_up_date": row["follow_up_date"].isoformat() if row["follow_up_date"] else None,
+            "event_type": "treatment"
+        }
+        producer.send("treatment-events", event, key=patient_key(event))
+    producer.flush()
+
+
+def load_chunk(config: GeneratorConfig, plan: ChunkPlan) -> Dict[str, int]:
+    """Generate one chunk and COPY it in a single transaction; runs in a worker process"""
+    rows = generate_chunk(config, plan)
+    connection = psycopg2.connect(
+        host=database.DB_HOST,
+        port=database.DB_PORT,
+        user=database.DB_USER,
+        password=database.DB_PASSWORD,
+        dbname=database.DB_NAME
+    )
+    try:
+        with connection, connection.cursor() as cursor:
+            for table, _ in ID_COLUMNS:
+                _copy(cursor, table, rows[table])
+    finally:
+        connection.close()
+    if config.replay:
+        replay_events(rows)
+    return {table: table_rows.num_rows for table, table_rows in rows.items()}
+
+
+class ClinicDataGenerator:
+    """Seeded, chunked synthetic data loaded with COPY from parallel workers"""
+
+    def __init__(
+            self,
+            seed: int = 42,
+            chunk_size: int = 20000,
+            workers: Optional[int] = None,
+            treatments_per_patient: float = 4.0,
+            insurance_per_patient: float = 1.3,
+            images_per_treatment: float = 0.5,
+            start_date: Optional[date] = None,
+            end_date: Optional[date] = None,
+            replay: bool = False
+    ):
+        end_date = end_date or date.today()
+        self.config = GeneratorConfig(
+            seed=seed,
+            treatments_per_patient=treatments_per_patient,
+            insurance_per_patient=insurance_per_patient,
+            images_per_treatment=images_per_treatment,
+            start_date=start_date or end_date - timedelta(days=3 * 365),
+            end_date=end_date,
+            replay=replay
+        )
+        self.chunk_size = chunk_size
+        self.workers = workers or os.cpu_count() or 2
+
+    def reserve_ids(self, totals: Dict[str, int]) -> Dict[str, int]:
+        """Advance each id sequence past the rows about to be loaded; returns the first id per table.
+
+        The API keeps inserting through the same sequences while the load runs,
+        so the generated ranges must be claimed before any row is written.
+        """
+        first_ids = {}
+        with database.engine.begin() as conn:
+            for table, column in ID_COLUMNS:
+                count = max(totals[table], 1)
+                sequence = conn.exec_driver_sql(
+                    f"SELECT pg_get_serial_sequence('{table}', '{column}')"
+                ).scalar()
+                conn.exec_driver_sql(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+                last = conn.exec_driver_sql(
+                    f"SELECT setval('{sequence}', GREATEST("
+                    f"(SELECT COALESCE(MAX({column}), 0) FROM {table}), "
+                    f"(SELECT last_value FROM {sequence})) + {count})"
+                ).scalar()
+                first_ids[table] = last - count + 1
+        return first_ids
+
+    def plan(self, patients: int) -> List[ChunkPlan]:
+        """Split the run into chunks with explicit, non-overlapping id ranges"""
+        sizes = [min(self.chunk_size, patients - start) for start in range(0, patients, self.chunk_size)]
+        counts = []
+        for index, size in enumerate(sizes):
+            treatments, insurance, images = chunk_counts(self.config, index, size)
+            counts.append({
+                "patients": size,
+                "insurance": int(insurance.sum()),
+                "treatments": int(treatments.sum()),
+                "patient_images": int(images.sum())
+            })
+        totals = {table: sum(c[table] for c in counts) for table, _ in ID_COLUMNS}
+        next_ids = self.reserve_ids(totals)
+
+        plans = []
+        for index, size in enumerate(sizes):
+            plans.append(ChunkPlan(index=index, patients=size, first_ids=dict(next_ids)))
+            for table, _ in ID_COLUMNS:
+                next_ids[table] += counts[index][table]
+        return plans
+
+    def run(self, patients: int) -> Dict[str, int]:
+        """Generate and load the given number of patients with their dependent rows"""
+        # Fail before reserving ids if the encryption keys are not initialised
+        get_field_encryptor()
+        plans = self.plan(patients)
+        started = time.monotonic()
+        loaded = {table: 0 for table, _ in ID_COLUMNS}
+
+        # Importing this module has already run the services package, which
+        # starts the Kafka producer's threads; a forked child would inherit
+        # them (and any lock they hold) mid-flight. Spawned workers start from
+        # a clean interpreter, import what they need and open their own
+        # connection and producer.
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(min(self.workers, len(plans))) as pool:
+            tasks = [(self.config, plan) for plan in plans]
+            for done, counts in enumerate(pool.imap_unordered(_load_chunk_args, tasks), start=1):
+                for table, count in counts.items():
+                    loaded[table] += count
+                logger.info(f"Loaded {done}/{len(plans)} chunks: {loaded}")
+
+        elapsed = time.monotonic() - started
+        rows = sum(loaded.values())
+        logger.info(f"Loaded {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s): {loaded}")
+        return loaded
+
+
+def _load_chunk_args(args: Tuple[GeneratorConfig, ChunkPlan]) -> Dict[str, int]:
+    return load_chunk(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load synthetic clinic data for load and scale testing")
+    parser.add_argument("--patients", type=int, required=True)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=20000, help="Patients per COPY transaction")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--treatments-per-patient", type=float, default=4.0)
+    parser.add_argument("--insurance-per-patient", type=float, default=1.3)
+    parser.add_argument("--images-per-treatment", type=float, default=0.5)
+    parser.add_argument("--start-date", type=date.fromisoformat)
+    parser.add_argument("--end-date", type=date.fromisoformat)
+    parser.add_argument("--replay", action="store_true",
+                        help="Also publish matching treatment-events and insurance-updates")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # The shared engine echoes every statement; keep the progress log readable
+    database.engine.echo = False
+
+    generator = ClinicDataGenerator(
+        seed=args.seed,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        treatments_per_patient=args.treatments_per_patient,
+        insurance_per_patient=args.insurance_per_patient,
+        images_per_treatment=args.images_per_treatment,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        replay=args.replay
+    )
+    print(json.dumps(generator.run(args.patients)))
@@ -1,8 +1,17 @@
 # app/services/database.py
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from fastapi import Request
+from typing import Dict, List, Optional
+import argparse
+import itertools
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import logging
 
@@ -16,6 +25,20 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "healthcare_db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Comma-separated read replica DSNs; reads fall back to the primary without them
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
+]
+# Seconds after a client's own write during which its reads go to the primary
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "0"))
+# Cookie carrying a client's read-your-writes deadline, so any worker process
+# routes its reads to the primary, not just the one that took the write
+READ_YOUR_WRITES_COOKIE = os.getenv("READ_YOUR_WRITES_COOKIE", "rw_until")
+# Seconds an unreachable replica is skipped before it is tried again
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
 
 # First connect to default 'postgres' database to create our db if needed
 default_engine = create_engine(
@@ -51,8 +74,8 @@ DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NA
 # Create SQLAlchemy engine
 engine = create_engine(
     DATABASE_URL,
-    pool_size=5,
-    max_overflow=10,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     pool_timeout=30,
     pool_recycle=1800,
     echo=True  # Set to False in production
@@ -65,15 +88,171 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+class ReplicaRouter:
+    """Round-robin selection over healthy read replicas"""
+
+    def __init__(self, urls: List[str]):
+        self.engines = [
+            create_engine(
+                url,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=30,
+                pool_recycle=1800,
+                pool_pre_ping=True
+            )
+            for url in urls
+        ]
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False)
+        self.down_until = [0.0] * len(self.engines)
+        self.counter = itertools.count()
+        self.recent_writers: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def note_write(self, client_key: Optional[str]):
+        """Remember that a client just wrote, for read-your-writes routing"""
+        if not client_key or READ_YOUR_WRITES_SECONDS <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.recent_writers[client_key] = now + READ_YOUR_WRITES_SECONDS
+            if len(self.recent_writers) > 10000:
+                self.recent_writers = {
+                    key: until for key, until in self.recent_writers.items() if until > now
+                }
+
+    def wrote_recently(self, client_key: Optional[str]) -> bool:
+        if not client_key:
+            return False
+        with self.lock:
+            return self.recent_writers.get(client_key, 0.0) > time.monotonic()
+
+    def session(self) -> Optional[Session]:
+        """Open a session on the next healthy replica, or None if none is usable"""
+        if not self.engines:
+            return None
+        start = next(self.counter)
+        now = time.monotonic()
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self.down_until[index] > now:
+                continue
+            db = self.session_factory(bind=self.engines[index])
+            try:
+                # Check out a connection now so a dead replica falls through to the next
+                db.connection()
+            except OperationalError as e:
+                db.close()
+                self.down_until[index] = now + REPLICA_RETRY_SECONDS
+                logger.warning(f"Read replica {index} unavailable, skipping for {REPLICA_RETRY_SECONDS}s: {e}")
+                continue
+            db.info["role"] = "replica"
+            return db
+        return None
+
+
+replica_router = ReplicaRouter(DATABASE_REPLICA_URLS)
+
+
+# Data-modifying keywords in textual SQL; a stray match (e.g. FOR UPDATE)
+# only sends a client's reads to the primary for a while
+_WRITE_SQL = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|COPY)\b", re.IGNORECASE)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _mark_session_wrote(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _mark_execute_wrote(orm_execute_state):
+    # Core statements and text() run through Session.execute never flush
+    statement = orm_execute_state.statement
+    if (
+            orm_execute_state.is_insert
+            or orm_execute_state.is_update
+            or orm_execute_state.is_delete
+            or (hasattr(statement, "text") and _WRITE_SQL.search(statement.text))
+    ):
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _record_client_write(session):
+    if session.info.pop("wrote", False):
+        replica_router.note_write(session.info.get("client_key"))
+        request_state = session.info.get("request_state")
+        if request_state is not None and READ_YOUR_WRITES_SECONDS > 0:
+            # Picked up by ReadYourWritesMiddleware and sent back as a cookie
+            request_state.read_your_writes_until = time.time() + READ_YOUR_WRITES_SECONDS
+
+
+def _client_key(request: Request) -> Optional[str]:
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else None
+
+
+def _cookie_says_wrote(request: Request) -> bool:
+    """Whether the client carries an unexpired read-your-writes cookie"""
+    try:
+        until = float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        return False
+    now = time.time()
+    # Capped so a forged cookie cannot pin a client to the primary for long
+    return now < until <= now + READ_YOUR_WRITES_SECONDS
+
+
+def wrote_recently(request: Request) -> bool:
+    """Whether this client's reads must see its own recent writes"""
+    if READ_YOUR_WRITES_SECONDS <= 0:
+        return False
+    return _cookie_says_wrote(request) or replica_router.wrote_recently(_client_key(request))
+
+
 # Dependency for FastAPI
-def get_db():
+def get_db(request: Request):
     db = SessionLocal()
+    db.info["role"] = "primary"
+    db.info["client_key"] = _client_key(request)
+    db.info["request_state"] = request.state
     try:
         yield db
     finally:
         db.close()
 
 
+# Read-only dependency for FastAPI; routes to a replica when one is available
+def get_read_db(request: Request):
+    db = None
+    if not wrote_recently(request):
+        db = replica_router.session()
+    if db is None:
+        db = SessionLocal()
+        db.info["role"] = "primary"
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def sibling_session(db: Session):
+    """A new session on the same database (primary or replica) as db.
+
+    For shared loads: they run on a worker thread and may outlive the
+    request that started them, whose session is closed when it ends.
+    """
+    sibling = SessionLocal(bind=db.get_bind())
+    sibling.info["role"] = db.info.get("role")
+    try:
+        yield sibling
+    finally:
+        sibling.close()
+
+
 # Initialize database
 def init_db():
     """Initialize the database"""
@@ -82,6 +261,10 @@ def init_db():
         # Ensure database exists
         ensure_database_exists()
 
+        # GiST indexes over (integer, range) pairs need btree_gist
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+
         # Create all tables
         Base.metadata.create_all(bind=engine)
         logger.info("Database initialized successfully")
@@ -93,4 +276,56 @@ def init_db():
 # Drop database
 def drop_db():
     """Drop all tables"""
-    Base.metadata.drop_all(bind=engine)
\ No newline at end of file
+    Base.metadata.drop_all(bind=engine)
+
+
+def _server(db: Session) -> str:
+    row = db.execute(text(
+        "SELECT coalesce(host(inet_server_addr()), 'local'), inet_server_port(), pg_is_in_recovery()"
+    )).one()
+    return f"{row[0]}:{row[1]}{' (standby)' if row[2] else ''}"
+
+
+def check_routing() -> bool:
+    """Exercise replica routing against the configured primary and replicas.
+
+    Meant for a primary plus at least one replica (two local Postgres
+    instances are enough): reads must land on a replica until a text() write
+    marks the client, then on the primary.
+    """
+    client_key = "routing-check"
+    primary = SessionLocal()
+    primary.info["client_key"] = client_key
+    try:
+        primary_server = _server(primary)
+        replica = replica_router.session()
+        if replica is None:
+            logger.error("No read replica reachable; set DATABASE_REPLICA_URLS")
+            return False
+        try:
+            replica_server = _server(replica)
+        finally:
+            replica.close()
+        logger.info(f"Primary {primary_server}, replica {replica_server}")
+        ok = replica_server != primary_server
+
+        # A Core write, which never flushes, must still mark the client
+        primary.execute(text("CREATE TEMP TABLE routing_check (n int)"))
+        primary.execute(text("INSERT INTO routing_check VALUES (1)"))
+        primary.commit()
+        marked = replica_router.wrote_recently(client_key)
+        logger.info(f"Client marked after text() write: {marked}")
+        return ok and marked
+    finally:
+        primary.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database maintenance")
+    parser.add_argument("command", choices=["check-routing"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if READ_YOUR_WRITES_SECONDS <= 0:
+        logger.warning("READ_YOUR_WRITES_SECONDS is 0; read-your-writes routing is disabled")
+    raise SystemExit(0 if check_routing() else 1)
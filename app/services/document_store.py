@@ -0,0 +1,375 @@
+# app/services/document_store.py
+import argparse
+import json
+import logging
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, TEXT
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+from .s3_service import HashedFile, S3Service
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# The no-op update takes the row lock, so a concurrent reclaim (which skips
+# locked rows) cannot delete the object once we hold it. xmax = 0 only on a
+# freshly inserted row. A new row may follow a reclaim that deleted the
+# object after stage() checked it, and an orphaned row may outlive its
+# object (a reclaim whose row delete failed after the S3 delete), so the
+# object is checked again for both once the reference is committed.
+UPSERT_BLOB_SQL = text("""
+    INSERT INTO document_blobs (sha256, s3_key, size_bytes, content_type, ref_count)
+    VALUES (:sha256, :s3_key, :size_bytes, :content_type, 0)
+    ON CONFLICT (sha256) DO UPDATE SET ref_count = document_blobs.ref_count
+    RETURNING s3_key, size_bytes, content_type, ref_count, orphaned_at, (xmax = 0) AS created
+""")
+
+ADD_REFERENCE_SQL = text("""
+    INSERT INTO patient_documents (patient_id, category, document_type, sha256, filename)
+    VALUES (:patient_id, :category, :document_type, :sha256, :filename)
+    ON CONFLICT ON CONSTRAINT uq_patient_documents_content DO NOTHING
+    RETURNING document_id, uploaded_at
+""")
+
+INCREMENT_SQL = text("""
+    UPDATE document_blobs SET ref_count = ref_count + 1, orphaned_at = NULL
+    WHERE sha256 = :sha256
+""")
+
+# Drop references and decrement their blobs in one statement; SET sees the
+# old ref_count, so a blob reaching zero is stamped as orphaned
+RELEASE_SQL = """
+    WITH removed AS (
+        DELETE FROM patient_documents WHERE {criteria} RETURNING sha256
+    ), counts AS (
+        SELECT sha256, count(*) AS n FROM removed GROUP BY sha256
+    )
+    UPDATE document_blobs b
+    SET ref_count = b.ref_count - c.n,
+        orphaned_at = CASE WHEN b.ref_count - c.n <= 0 THEN now() ELSE b.orphaned_at END
+    FROM counts c
+    WHERE b.sha256 = c.sha256
+    RETURNING b.sha256
+"""
+RELEASE_DOCUMENT_SQL = text(RELEASE_SQL.format(criteria="document_id = :document_id AND patient_id = :patient_id"))
+RELEASE_PATIENT_SQL = text(RELEASE_SQL.format(criteria="patient_id = :patient_id"))
+
+RECLAIM_CANDIDATES_SQL = text("""
+    SELECT sha256, s3_key, size_bytes FROM document_blobs
+    WHERE ref_count = 0 AND orphaned_at < :cutoff
+    ORDER BY orphaned_at
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+""")
+
+RECLAIMABLE_SQL = text("""
+    SELECT count(*) AS blobs, coalesce(sum(size_bytes), 0) AS size_bytes FROM document_blobs
+    WHERE ref_count = 0 AND orphaned_at < :cutoff
+""")
+
+DELETE_BLOBS_SQL = text("DELETE FROM document_blobs WHERE sha256 = ANY(:hashes)").bindparams(
+    bindparam("hashes", type_=ARRAY(TEXT))
+)
+
+SAVINGS_SQL = text("""
+    SELECT
+        (SELECT count(*) FROM patient_documents) AS documents,
+        (SELECT coalesce(sum(b.size_bytes), 0)
+           FROM patient_documents d JOIN document_blobs b ON b.sha256 = d.sha256) AS logical_bytes,
+        (SELECT count(*) FROM document_blobs) AS blobs,
+        (SELECT coalesce(sum(size_bytes), 0) FROM document_blobs) AS stored_bytes,
+        (SELECT coalesce(sum(size_bytes), 0) FROM document_blobs WHERE ref_count = 0) AS orphaned_bytes
+""")
+
+
+@dataclass
+class StagedBlob:
+    """An upload hashed and put in S3, waiting for its reference to be recorded"""
+    hashed: HashedFile
+    content_type: Optional[str]
+    uploaded: bool
+    recheck: bool = False
+
+
+class DocumentStore:
+    """Patient documents and images on top of content-addressed S3 blobs.
+
+    Each distinct content is stored once, under its SHA-256. Patients hold
+    references (patient_documents) and document_blobs counts them; a blob
+    whose count reaches zero is only deleted by reclaim() after a grace
+    period, so a concurrent re-upload of the same content stays safe.
+    """
+
+    def __init__(self, s3_service: Optional[S3Service] = None):
+        self.s3_service = s3_service or S3Service()
+        self.grace_hours = float(os.getenv("DOCUMENT_RECLAIM_GRACE_HOURS", "24"))
+        self.batch_size = int(os.getenv("DOCUMENT_RECLAIM_BATCH_SIZE", "1000"))
+
+    def stage(self, file_obj: BinaryIO, content_type: Optional[str] = None) -> StagedBlob:
+        """Hash an upload and make sure its blob is in S3.
+
+        Needs no database session, so it can run on a worker thread before
+        the transaction starts; the upload never happens under a row lock.
+        Pass the result to add_reference, then to settle after the commit.
+        """
+        hashed = self.s3_service.hash_file(file_obj)
+        try:
+            _, uploaded = self.s3_service.put_blob(hashed, content_type)
+        except Exception:
+            hashed.file.close()
+            raise
+        return StagedBlob(hashed, content_type, uploaded)
+
+    def add_reference(
+            self,
+            db: Session,
+            patient_id: int,
+            staged: StagedBlob,
+            category: str,
+            document_type: str,
+            filename: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Record a staged blob and the patient's reference to it, inside the caller's transaction.
+
+        Storing the same content in the same slot again returns the existing row.
+        """
+        hashed = staged.hashed
+        blob = db.execute(UPSERT_BLOB_SQL, {
+            "sha256": hashed.sha256,
+            "s3_key": self.s3_service.blob_key(hashed.sha256),
+            "size_bytes": hashed.size,
+            "content_type": staged.content_type
+        }).one()
+        staged.recheck = blob.created or blob.ref_count == 0 or blob.orphaned_at is not None
+
+        reference = db.execute(ADD_REFERENCE_SQL, {
+            "patient_id": patient_id,
+            "category": category,
+            "document_type": document_type,
+            "sha256": hashed.sha256,
+            "filename": filename
+        }).first()
+        if reference is not None:
+            db.execute(INCREMENT_SQL, {"sha256": hashed.sha256})
+        else:
+            from ..models.document import patient_documents_table as d
+            reference = db.execute(
+                select(d.c.document_id, d.c.uploaded_at).where(
+                    d.c.patient_id == patient_id,
+                    d.c.category == category,
+                    d.c.document_type == document_type,
+                    d.c.sha256 == hashed.sha256
+                )
+            ).one()
+
+        return {
+            "document_id": reference.document_id,
+            "patient_id": patient_id,
+            "category": category,
+            "document_type": document_type,
+            "sha256": hashed.sha256,
+            "s3_key": blob.s3_key,
+            "size_bytes": blob.size_bytes,
+            "content_type": blob.content_type,
+            "filename": filename,
+            "uploaded_at": reference.uploaded_at,
+            "deduplicated": not staged.uploaded
+        }
+
+    def settle(self, staged: StagedBlob):
+        """After the commit: restore the object if a reclaim raced the reference, and drop the local copy.
+
+        The committed reference keeps reclaim away from the blob from now on.
+        """
+        try:
+            if staged.recheck:
+                self.s3_service.put_blob(staged.hashed, staged.content_type)
+        finally:
+            staged.hashed.file.close()
+
+    def discard(self, staged: StagedBlob):
+        """Drop the local copy of a blob whose reference was not committed.
+
+        An object uploaded for it stays unreferenced; a later store of the
+        same content reuses it.
+        """
+        staged.hashed.file.close()
+
+    def store(
+            self,
+            patient_id: int,
+            file_obj: BinaryIO,
+            category: str,
+            document_type: str,
+            content_type: Optional[str] = None,
+            filename: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Store a file and reference it from the patient in a transaction of its own"""
+        staged = self.stage(file_obj, content_type)
+        db = SessionLocal()
+        try:
+            document = self.add_reference(db, patient_id, staged, category, document_type, filename)
+            db.commit()
+        except Exception:
+            db.rollback()
+            self.discard(staged)
+            raise
+        finally:
+            db.close()
+        self.settle(staged)
+        return document
+
+    def list_documents(self, db: Session, patient_id: int, category: Optional[str] = None) -> List[Dict[str, Any]]:
+        """A patient's documents with their blob details, oldest first"""
+        from ..models.document import document_blobs_table as b, patient_documents_table as d
+
+        query = select(
+            d.c.document_id, d.c.patient_id, d.c.category, d.c.document_type, d.c.sha256,
+            d.c.filename, d.c.uploaded_at, b.c.s3_key, b.c.size_bytes, b.c.content_type
+        ).join(b, b.c.sha256 == d.c.sha256).where(d.c.patient_id == patient_id)
+        if category:
+            query = query.where(d.c.category == category)
+        return [dict(row) for row in db.execute(query.order_by(d.c.document_id)).mappings()]
+
+    def release(self, db: Session, patient_id: int, document_id: int) -> bool:
+        """Drop one reference; returns False when the patient has no such document"""
+        return bool(db.execute(
+            RELEASE_DOCUMENT_SQL, {"document_id": document_id, "patient_id": patient_id}
+        ).first())
+
+    def release_patient(self, db: Session, patient_id: int) -> int:
+        """Drop every reference a patient holds, e.g. before deleting the patient;
+        returns how many blobs lost references"""
+        return len(db.execute(RELEASE_PATIENT_SQL, {"patient_id": patient_id}).all())
+
+    def reclaim(self, now: Optional[datetime] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """Delete blobs that have had no references for longer than the grace period"""
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(hours=self.grace_hours)
+        if dry_run:
+            db = SessionLocal()
+            try:
+                reclaimable = db.execute(RECLAIMABLE_SQL, {"cutoff": cutoff}).one()
+            finally:
+                db.close()
+            return {
+                "cutoff": cutoff.isoformat(),
+                "blobs_deleted": reclaimable.blobs,
+                "bytes_reclaimed": reclaimable.size_bytes,
+                "dry_run": True,
+                **self.savings()
+            }
+
+        deleted, reclaimed_bytes = 0, 0
+        while True:
+            db = SessionLocal()
+            try:
+                candidates = db.execute(
+                    RECLAIM_CANDIDATES_SQL, {"cutoff": cutoff, "limit": self.batch_size}
+                ).all()
+                if not candidates:
+                    break
+                # Rows stay locked until the objects are gone, so an upload of the
+                # same content waits and then finds no row, and uploads again
+                by_key = {row.s3_key: row for row in candidates}
+                response = self.s3_service.s3_client.delete_objects(
+                    Bucket=self.s3_service.bucket_name,
+                    Delete={"Objects": [{"Key": key} for key in by_key], "Quiet": False}
+                )
+                for error in response.get("Errors", []):
+                    logger.error(f"Error deleting blob {error['Key']}: {error.get('Message')}")
+                removed = [by_key[item["Key"]] for item in response.get("Deleted", []) if item["Key"] in by_key]
+                if not removed:
+                    break
+                db.execute(DELETE_BLOBS_SQL, {"hashes": [row.sha256 for row in removed]})
+                db.commit()
+                deleted += len(removed)
+                reclaimed_bytes += sum(row.size_bytes for row in removed)
+                logger.info(f"Reclaimed {len(removed)} blobs ({deleted} so far)")
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+        return {
+            "cutoff": cutoff.isoformat(),
+            "blobs_deleted": deleted,
+            "bytes_reclaimed": reclaimed_bytes,
+            "dry_run": False,
+            **self.savings()
+        }
+
+    def savings(self) -> Dict[str, int]:
+        """Bytes the references would take as separate copies versus what is stored"""
+        db = SessionLocal()
+        try:
+            row = db.execute(SAVINGS_SQL).one()
+        finally:
+            db.close()
+        live_bytes = row.stored_bytes - row.orphaned_bytes
+        return {
+            "documents": row.documents,
+            "blobs": row.blobs,
+            "logical_bytes": row.logical_bytes,
+            "stored_bytes": row.stored_bytes,
+            "orphaned_bytes": row.orphaned_bytes,
+            "dedup_saved_bytes": row.logical_bytes - live_bytes
+        }
+
+    def estimate_legacy(self, folders: Iterable[str] = ("patient_images", "documents")) -> Dict[str, int]:
+        """Duplicate bytes among objects stored before content addressing.
+
+        Single-part uploads have the MD5 of their content as ETag, so equal
+        (ETag, size) pairs are treated as copies of the same file.
+        """
+        paginator = self.s3_service.s3_client.get_paginator('list_objects_v2')
+        copies: Dict[tuple, int] = defaultdict(int)
+        objects, total_bytes = 0, 0
+        for folder in folders:
+            prefix = self.s3_service.paths[folder] + "/"
+            for page in paginator.paginate(Bucket=self.s3_service.bucket_name, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    copies[(item['ETag'], item['Size'])] += 1
+                    objects += 1
+                    total_bytes += item['Size']
+        duplicate_bytes = sum(size * (count - 1) for (_, size), count in copies.items())
+        return {
+            "objects": objects,
+            "distinct": len(copies),
+            "total_bytes": total_bytes,
+            "duplicate_bytes": duplicate_bytes
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content-addressed document storage maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    reclaim_parser = subparsers.add_parser("reclaim", help="Delete blobs unreferenced past the grace period")
+    reclaim_parser.add_argument("--grace-hours", type=float)
+    reclaim_parser.add_argument("--batch-size", type=int)
+    reclaim_parser.add_argument("--dry-run", action="store_true", help="Report what would be deleted")
+
+    subparsers.add_parser("estimate", help="Storage saved by deduplication, including legacy uploads")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    document_store = DocumentStore()
+    if args.command == "reclaim":
+        if args.grace_hours is not None:
+            document_store.grace_hours = args.grace_hours
+        if args.batch_size:
+            document_store.batch_size = args.batch_size
+        print(json.dumps(document_store.reclaim(dry_run=args.dry_run)))
+    else:
+        print(json.dumps({"content_addressed": document_store.savings(), "legacy": document_store.estimate_legacy()}))
@@ -0,0 +1,200 @@
+# app/services/eligibility.py
+import asyncio
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, DATE, INTEGER
+from sqlalchemy.orm import Session
+
+from .kafka_consumer import KafkaConsumerService
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+POLICY_COLUMNS = (
+    "insurance_id", "provider_name", "policy_number", "group_number",
+    "coverage_start_date", "coverage_end_date"
+)
+
+# One row per covering policy for each (patient_id, date) pair, answered by
+# the GiST index on (patient_id, coverage_period)
+BATCH_SQL = text(f"""
+    SELECT c.patient_id, c.day, {', '.join('i.' + column for column in POLICY_COLUMNS)}
+    FROM unnest(:patient_ids, :days) AS c(patient_id, day)
+    JOIN insurance i
+      ON i.patient_id = c.patient_id
+     AND i.coverage_period @> c.day
+    ORDER BY i.coverage_start_date DESC, i.insurance_id
+""").bindparams(
+    bindparam("patient_ids", type_=ARRAY(INTEGER)),
+    bindparam("days", type_=ARRAY(DATE))
+)
+
+MAX_ORDINAL = date.max.toordinal()
+
+
+class PatientCoverage:
+    """A patient's policies as inclusive ordinal intervals, sorted by start"""
+
+    def __init__(self, policies: List[Dict[str, Any]]):
+        self.policies = sorted(policies, key=lambda p: p["coverage_start_date"])
+        self.starts = [p["coverage_start_date"].toordinal() for p in self.policies]
+        self.ends = [
+            p["coverage_end_date"].toordinal() if p["coverage_end_date"] else MAX_ORDINAL
+            for p in self.policies
+        ]
+        self.loaded_at = time.monotonic()
+
+    def covering(self, day: date) -> List[Dict[str, Any]]:
+        """Policies in force on a day, most recently started first"""
+        ordinal = day.toordinal()
+        # Only policies starting on or before the day can cover it
+        candidates = bisect.bisect_right(self.starts, ordinal)
+        return [
+            self.policies[i] for i in range(candidates - 1, -1, -1)
+            if self.ends[i] >= ordinal
+        ]
+
+
+class EligibilityService:
+    """Batch "which policy covers this patient on this date" with an LRU of coverage intervals"""
+
+    def __init__(self):
+        self.cache_size = int(os.getenv("ELIGIBILITY_CACHE_SIZE", "100000"))
+        # Safety net for missed insurance-updates events
+        self.ttl_seconds = float(os.getenv("ELIGIBILITY_CACHE_TTL_SECONDS", "300"))
+        self.group_id = os.getenv(
+            "ELIGIBILITY_GROUP_ID",
+            f"eligibility-{socket.gethostname()}-{os.getpid()}"
+        )
+        self.cache: "OrderedDict[int, PatientCoverage]" = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped on every invalidation; loads that raced one are not cached
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.consumer_service = KafkaConsumerService()
+        self.task = None
+
+    def _get(self, patient_id: int) -> Optional[PatientCoverage]:
+        with self.lock:
+            coverage = self.cache.get(patient_id)
+            if coverage is None:
+                return None
+            if time.monotonic() - coverage.loaded_at > self.ttl_seconds:
+                del self.cache[patient_id]
+                return None
+            self.cache.move_to_end(patient_id)
+            return coverage
+
+    def _put_all(self, loaded: Dict[int, PatientCoverage], epoch: int):
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            for patient_id, coverage in loaded.items():
+                self.cache[patient_id] = coverage
+                self.cache.move_to_end(patient_id)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, patient_id: Optional[int] = None):
+        """Forget one patient's coverage, or everything"""
+        with self.lock:
+            self.epoch += 1
+            if patient_id is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(patient_id, None)
+
+    def load(self, db: Session, patient_ids: List[int]) -> Dict[int, PatientCoverage]:
+        """Fetch the complete policy list of each patient in one query"""
+        from ..models.insurance import insurance_table as i
+
+        rows = db.execute(
+            select(i.c.patient_id, *(i.c[column] for column in POLICY_COLUMNS))
+            .where(i.c.patient_id.in_(patient_ids))
+        ).mappings().all()
+        policies: Dict[int, List[Dict[str, Any]]] = {patient_id: [] for patient_id in patient_ids}
+        for row in rows:
+            policies[row["patient_id"]].append({column: row[column] for column in POLICY_COLUMNS})
+        return {patient_id: PatientCoverage(found) for patient_id, found in policies.items()}
+
+    def query(self, db: Session, checks: List[Tuple[int, date]]) -> Dict[Tuple[int, date], List[Dict[str, Any]]]:
+        """Answer the checks straight from the database"""
+        covering: Dict[Tuple[int, date], List[Dict[str, Any]]] = {check: [] for check in checks}
+        rows = db.execute(BATCH_SQL, {
+            "patient_ids": [patient_id for patient_id, _ in checks],
+            "days": [day for _, day in checks]
+        }).mappings()
+        for row in rows:
+            covering[(row["patient_id"], row["day"])].append({column: row[column] for column in POLICY_COLUMNS})
+        return covering
+
+    def check(self, db: Session, checks: List[Tuple[int, date]]) -> List[Dict[str, Any]]:
+        """Covering policies for each (patient_id, date), in request order"""
+        if self.cache_size <= 0:
+            covering = self.query(db, list(dict.fromkeys(checks)))
+            return [self._result(patient_id, day, covering[(patient_id, day)]) for patient_id, day in checks]
+
+        coverage: Dict[int, PatientCoverage] = {}
+        missing = []
+        for patient_id in dict.fromkeys(patient_id for patient_id, _ in checks):
+            cached = self._get(patient_id)
+            if cached is None:
+                missing.append(patient_id)
+            else:
+                coverage[patient_id] = cached
+        self.hits += len(coverage)
+        self.misses += len(missing)
+
+        if missing:
+            epoch = self.epoch
+            loaded = self.load(db, missing)
+            self._put_all(loaded, epoch)
+            coverage.update(loaded)
+
+        return [
+            self._result(patient_id, day, coverage[patient_id].covering(day))
+            for patient_id, day in checks
+        ]
+
+    @staticmethod
+    def _result(patient_id: int, day: date, policies: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"patient_id": patient_id, "date": day, "eligible": bool(policies), "policies": policies}
+
+    def handle_event(self, event: Dict[str, Any]):
+        """Drop cached coverage when a patient's insurance changes"""
+        self.invalidate(event.get("patient_id"))
+
+    async def start(self):
+        """Subscribe this process to insurance-updates"""
+        if self.task or self.cache_size <= 0:
+            return
+        # Every process caches independently, so each needs its own group
+        self.task = asyncio.create_task(
+            self.consumer_service.start_consuming(
+                "insurance-updates",
+                self.group_id,
+                self.handle_event,
+                auto_offset_reset='latest'
+            )
+        )
+        logger.info(f"Eligibility cache subscribed to insurance-updates as {self.group_id}")
+
+    def stop(self):
+        """Stop the subscription"""
+        self.consumer_service.stop_consuming("insurance-updates")
+        self.task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"cached_patients": len(self.cache), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,395 @@
+# app/services/encryption.py
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from dotenv import load_dotenv
+from sqlalchemy import Text
+from sqlalchemy.types import TypeDecorator
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "enc:v1:"
+NONCE_SIZE = 12
+
+INIT_HINT = "run 'python -m app.services.encryption init-keys' once per deployment"
+
+
+@contextmanager
+def _process_lock(lock_file):
+    """Hold an exclusive lock on an open file against other processes.
+
+    fcntl is POSIX-only and msvcrt Windows-only, so both are imported here;
+    elsewhere only the in-process lock applies.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+
+    try:
+        import msvcrt
+    except ImportError:
+        logger.warning("No file locking on this platform; key writes are only serialized per process")
+        yield
+        return
+    # Locks one byte at the current position; LK_LOCK gives up after ~10s
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            break
+        except OSError:
+            continue
+    try:
+        yield
+    finally:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class KeysNotInitializedError(RuntimeError):
+    """The master key or the active data key does not exist yet"""
+
+
+class LocalKeyManager:
+    """Key-file stand-in for a KMS: wraps data keys under a local master key.
+
+    Keys are never created implicitly: a missing key file means the wrong
+    path or a lost volume, and silently generating a new key would make
+    every existing ciphertext unreadable. init-keys creates them.
+    """
+
+    def __init__(
+            self,
+            master_key_file: Optional[str] = None,
+            data_keys_file: Optional[str] = None,
+            create: bool = False
+    ):
+        self.master_key_file = master_key_file or os.getenv(
+            "FIELD_ENCRYPTION_KEY_FILE",
+            "data/keys/master.key"
+        )
+        self.data_keys_file = data_keys_file or os.getenv(
+            "FIELD_ENCRYPTION_DATA_KEYS_FILE",
+            "data/keys/data_keys.json"
+        )
+        self.lock = threading.Lock()
+        if create:
+            self._create_master_key()
+        self.master = AESGCM(self._load_master_key())
+
+    @contextmanager
+    def _file_lock(self):
+        """Serialize key writes across threads and worker processes"""
+        directory = os.path.dirname(self.data_keys_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            with open(f"{self.data_keys_file}.lock", "a") as lock_file:
+                with _process_lock(lock_file):
+                    yield
+
+    def _create_master_key(self):
+        directory = os.path.dirname(self.master_key_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            fd = os.open(self.master_key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, "wb") as f:
+            f.write(AESGCM.generate_key(bit_length=256))
+            f.flush()
+            os.fsync(f.fileno())
+        logger.warning(f"Generated new master key at {self.master_key_file}")
+
+    def _load_master_key(self) -> bytes:
+        if not os.path.exists(self.master_key_file):
+            raise KeysNotInitializedError(f"Master key {self.master_key_file} not found; {INIT_HINT}")
+        with open(self.master_key_file, "rb") as f:
+            return f.read()
+
+    def _read_store(self) -> dict:
+        if not os.path.exists(self.data_keys_file):
+            return {"active": None, "keys": {}}
+        with open(self.data_keys_file) as f:
+            return json.load(f)
+
+    def _write_store(self, store: dict):
+        """Atomically replace the key store (file lock held)"""
+        tmp_path = f"{self.data_keys_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(store, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.data_keys_file)
+
+    def generate_data_key(self) -> Tuple[str, bytes]:
+        """Create, wrap and persist a new active data key"""
+        with self._file_lock():
+            # Re-read under the lock so keys added by other processes are kept
+            store = self._read_store()
+            key_id = secrets.token_hex(4)
+            data_key = AESGCM.generate_key(bit_length=256)
+            nonce = os.urandom(NONCE_SIZE)
+            wrapped = nonce + self.master.encrypt(nonce, data_key, key_id.encode())
+            store["keys"][key_id] = base64.b64encode(wrapped).decode()
+            store["active"] = key_id
+            self._write_store(store)
+        logger.info(f"Generated data key {key_id}")
+        return key_id, data_key
+
+    def init_keys(self) -> str:
+        """Create the first data key unless one is already active; returns its id"""
+        with self._file_lock():
+            active = self._read_store()["active"]
+        if active is not None:
+            logger.info(f"Data key {active} already active")
+            return active
+        # Another process may win between the check and the write; a second
+        # key is harmless, both stay readable and the later one is active
+        key_id, _ = self.generate_data_key()
+        return key_id
+
+    def active_key_id(self) -> Optional[str]:
+        with self.lock:
+            return self._read_store()["active"]
+
+    def decrypt_data_key(self, key_id: str) -> bytes:
+        """Unwrap a stored data key"""
+        with self.lock:
+            wrapped = self._read_store()["keys"].get(key_id)
+        if wrapped is None:
+            raise KeyError(f"Unknown data key {key_id}")
+        wrapped = base64.b64decode(wrapped)
+        return self.master.decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], key_id.encode())
+
+    def derive_key(self, purpose: str) -> bytes:
+        """Derive a purpose-specific secret (e.g. blind indexes) from the master key"""
+        with open(self.master_key_file, "rb") as f:
+            return hmac.new(f.read(), purpose.encode(), hashlib.sha256).digest()
+
+
+class FieldEncryptor:
+    """Envelope encryption of individual column values with cached data keys"""
+
+    def __init__(self, key_manager: LocalKeyManager):
+        self.key_manager = key_manager
+        self.ciphers: Dict[str, AESGCM] = {}
+        self.lock = threading.Lock()
+        key_id = key_manager.active_key_id()
+        if key_id is None:
+            raise KeysNotInitializedError(f"No active data key in {key_manager.data_keys_file}; {INIT_HINT}")
+        self.active_key_id = key_id
+        self.index_key = key_manager.derive_key("blind-index")
+
+    def _cipher(self, key_id: str) -> AESGCM:
+        cipher = self.ciphers.get(key_id)
+        if cipher is None:
+            with self.lock:
+                cipher = self.ciphers.get(key_id)
+                if cipher is None:
+                    cipher = AESGCM(self.key_manager.decrypt_data_key(key_id))
+                    self.ciphers[key_id] = cipher
+        return cipher
+
+    def rotate(self):
+        """Start encrypting new values under a fresh data key"""
+        key_id, data_key = self.key_manager.generate_data_key()
+        with self.lock:
+            self.ciphers[key_id] = AESGCM(data_key)
+            self.active_key_id = key_id
+
+    def encrypt(self, value: Optional[str], field: str) -> Optional[str]:
+        if value is None:
+            return None
+        key_id = self.active_key_id
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = self._cipher(key_id).encrypt(nonce, value.encode("utf-8"), field.encode())
+        return f"{PREFIX}{key_id}:{base64.b64encode(nonce + ciphertext).decode()}"
+
+    def encrypt_many(self, values: Iterable[Optional[str]], field: str) -> List[Optional[str]]:
+        """Encrypt a column of values under the active key, one cipher lookup per batch.
+
+        AES-GCM still runs once per value, since every value gets its own
+        nonce; the batch saves the per-call key lookup and draws all nonces
+        from a single urandom call.
+        """
+        values = list(values)
+        key_id = self.active_key_id
+        encrypt = self._cipher(key_id).encrypt
+        aad = field.encode()
+        prefix = f"{PREFIX}{key_id}:"
+        b64encode = base64.b64encode
+        nonces = os.urandom(NONCE_SIZE * len(values))
+        result = []
+        for i, value in enumerate(values):
+            if value is None:
+                result.append(None)
+                continue
+            nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+            result.append(prefix + b64encode(nonce + encrypt(nonce, value.encode("utf-8"), aad)).decode())
+        return result
+
+    def decrypt(self, value: Optional[str], field: str) -> Optional[str]:
+        if value is None or not value.startswith(PREFIX):
+            # Rows written before encryption was enabled
+            return value
+        key_id, _, payload = value[len(PREFIX):].partition(":")
+        raw = base64.b64decode(payload)
+        return self._cipher(key_id).decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], field.encode()).decode("utf-8")
+
+    def decrypt_many(self, values: Iterable[Optional[str]], field: str) -> List[Optional[str]]:
+        """Decrypt a column of values, resolving each data key once per batch"""
+        aad = field.encode()
+        ciphers: Dict[str, AESGCM] = {}
+        prefix_length = len(PREFIX)
+        b64decode = base64.b64decode
+        result = []
+        for value in values:
+            if value is None or not value.startswith(PREFIX):
+                result.append(value)
+                continue
+            key_id, _, payload = value[prefix_length:].partition(":")
+            cipher = ciphers.get(key_id)
+            if cipher is None:
+                cipher = ciphers[key_id] = self._cipher(key_id)
+            raw = b64decode(payload)
+            result.append(cipher.decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], aad).decode("utf-8"))
+        return result
+
+    def blind_index(self, value: Optional[str], field: str) -> Optional[str]:
+        """Deterministic keyed hash for equality lookups on an encrypted field"""
+        if value is None:
+            return None
+        normalized = normalize_for_index(value, field)
+        if not normalized:
+            return None
+        message = f"{field}:{normalized}".encode("utf-8")
+        return hmac.new(self.index_key, message, hashlib.sha256).hexdigest()[:32]
+
+    def blind_index_many(self, values: Iterable[Optional[str]], field: str) -> List[Optional[str]]:
+        """Blind indexes for a column of values"""
+        key = self.index_key
+        digest = hmac.new
+        sha256 = hashlib.sha256
+        result = []
+        for value in values:
+            normalized = normalize_for_index(value, field) if value is not None else None
+            if not normalized:
+                result.append(None)
+                continue
+            result.append(digest(key, f"{field}:{normalized}".encode("utf-8"), sha256).hexdigest()[:32])
+        return result
+
+
+def normalize_for_index(value: str, field: str) -> str:
+    if field == "phone":
+        return re.sub(r"\D", "", value)
+    return value.strip().lower()
+
+
+_encryptor: Optional[FieldEncryptor] = None
+_encryptor_lock = threading.Lock()
+
+
+def get_field_encryptor() -> FieldEncryptor:
+    """Process-wide encryptor, created on first use"""
+    global _encryptor
+    if _encryptor is None:
+        with _encryptor_lock:
+            if _encryptor is None:
+                _encryptor = FieldEncryptor(LocalKeyManager())
+    return _encryptor
+
+
+class EncryptedString(TypeDecorator):
+    """Text column stored encrypted; the field name is bound in as associated data"""
+    impl = Text
+    cache_ok = True
+
+    def __init__(self, field: str, *args, **kwargs):
+        self.field = field
+        super().__init__(*args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        return get_field_encryptor().encrypt(value, self.field)
+
+    def process_result_value(self, value, dialect):
+        return get_field_encryptor().decrypt(value, self.field)
+
+
+def benchmark(values: int, length: int) -> Dict[str, float]:
+    """Values per second for each encryptor operation, against throwaway keys"""
+    with tempfile.TemporaryDirectory() as directory:
+        key_manager = LocalKeyManager(
+            os.path.join(directory, "master.key"),
+            os.path.join(directory, "data_keys.json"),
+            create=True
+        )
+        key_manager.init_keys()
+        encryptor = FieldEncryptor(key_manager)
+        plain = [secrets.token_urlsafe(length)[:length] for _ in range(values)]
+
+        results = {}
+        started = time.perf_counter()
+        encrypted = [encryptor.encrypt(value, "email") for value in plain]
+        results["encrypt"] = values / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        decrypted = [encryptor.decrypt(value, "email") for value in encrypted]
+        results["decrypt"] = values / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        batch = encryptor.decrypt_many(encrypted, "email")
+        results["decrypt_many"] = values / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for value in plain:
+            encryptor.blind_index(value, "email")
+        results["blind_index"] = values / (time.perf_counter() - started)
+
+        assert decrypted == batch == plain
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Field encryption keys")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("init-keys", help="Create the master key and first data key if missing")
+    subparsers.add_parser("rotate", help="Make a fresh data key active; workers use it after restart")
+    benchmark_parser = subparsers.add_parser("benchmark", help="Encrypt/decrypt throughput")
+    benchmark_parser.add_argument("--values", type=int, default=100000)
+    benchmark_parser.add_argument("--length", type=int, default=24)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "init-keys":
+        print(LocalKeyManager(create=True).init_keys())
+    elif args.command == "rotate":
+        print(LocalKeyManager().generate_data_key()[0])
+    else:
+        for operation, rate in benchmark(args.values, args.length).items():
+            print(f"{operation:>12}: {rate:12,.0f} values/s")
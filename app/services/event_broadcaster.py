@@ -0,0 +1,265 @@
+# app/services/event_broadcaster.py
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+import numpy as np
+
+from dotenv import load_dotenv
+
+from .kafka_consumer import KafkaConsumerService
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REALTIME_TOPICS = ("treatment-events", "insurance-updates")
+
+
+@dataclass(eq=False)
+class Subscriber:
+    """A connected client and its bounded outbound queue.
+
+    A plain deque plus one waiter future: with thousands of clients,
+    asyncio.Queue and a task per wait cost more than the delivery itself.
+    """
+    subscriber_id: int
+    queue_size: int
+    patient_id: Optional[int] = None
+    queue: Deque[Dict[str, Any]] = field(default_factory=deque)
+    waiter: Optional[asyncio.Future] = None
+    dropped: bool = False
+    closed: bool = False
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class EventBroadcaster:
+    """Fan out Kafka events from one per-process subscription to many clients"""
+
+    def __init__(self, consumer_service: Optional[KafkaConsumerService] = None):
+        self.consumer_service = consumer_service or KafkaConsumerService()
+        self.queue_size = int(os.getenv("REALTIME_CLIENT_QUEUE_SIZE", "100"))
+        # Every process needs its own group so that each one sees every event
+        self.group_id = os.getenv(
+            "REALTIME_GROUP_ID",
+            f"realtime-{socket.gethostname()}-{os.getpid()}"
+        )
+        self.subscribers: Dict[int, Subscriber] = {}
+        # Subscribers by patient filter (None: every event), so publishing
+        # only visits the clients an event is for
+        self.by_patient: Dict[Optional[int], Dict[int, Subscriber]] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.tasks = []
+        self._ids = itertools.count(1)
+        self.delivered = 0
+        self.dropped_clients = 0
+
+    async def start(self):
+        """Start the shared Kafka subscriptions for this process"""
+        if self.tasks:
+            return
+        self.loop = asyncio.get_running_loop()
+        for topic in REALTIME_TOPICS:
+            task = asyncio.create_task(
+                self.consumer_service.start_consuming(
+                    topic,
+                    self.group_id,
+                    self.publish_threadsafe,
+                    auto_offset_reset='latest'
+                )
+            )
+            self.tasks.append(task)
+        logger.info(f"Realtime broadcaster subscribed to {REALTIME_TOPICS} as {self.group_id}")
+
+    def stop(self):
+        """Stop the Kafka subscriptions and disconnect all clients"""
+        for topic in REALTIME_TOPICS:
+            self.consumer_service.stop_consuming(topic)
+        self.tasks = []
+        for subscriber in list(self.subscribers.values()):
+            self._drop(subscriber)
+
+    def subscribe(self, patient_id: Optional[int] = None) -> Subscriber:
+        """Register a client; must be called from the event loop"""
+        subscriber = Subscriber(
+            subscriber_id=next(self._ids),
+            queue_size=self.queue_size,
+            patient_id=patient_id
+        )
+        self.subscribers[subscriber.subscriber_id] = subscriber
+        self.by_patient.setdefault(patient_id, {})[subscriber.subscriber_id] = subscriber
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Remove a client"""
+        self.subscribers.pop(subscriber.subscriber_id, None)
+        group = self.by_patient.get(subscriber.patient_id)
+        if group is not None:
+            group.pop(subscriber.subscriber_id, None)
+            if not group:
+                del self.by_patient[subscriber.patient_id]
+        subscriber.closed = True
+        subscriber.wake()
+
+    def publish_threadsafe(self, event: Dict[str, Any]):
+        """Hand an event from a consumer thread to the event loop"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.publish, event)
+
+    def publish(self, event: Dict[str, Any]):
+        """Deliver an event to every matching client without ever blocking"""
+        targets = list(self.by_patient.get(None, {}).values())
+        patient_id = event.get("patient_id")
+        if patient_id is not None:
+            targets.extend(self.by_patient.get(patient_id, {}).values())
+        for subscriber in targets:
+            if len(subscriber.queue) >= subscriber.queue_size:
+                # A slow client must not hold up the others or the consumer
+                logger.warning(f"Dropping slow realtime client {subscriber.subscriber_id}")
+                self._drop(subscriber)
+                continue
+            subscriber.queue.append(event)
+            subscriber.wake()
+            self.delivered += 1
+
+    def _drop(self, subscriber: Subscriber):
+        subscriber.dropped = True
+        self.dropped_clients += 1
+        self.unsubscribe(subscriber)
+
+    async def next_event(self, subscriber: Subscriber, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait for the next event; returns None on timeout or when dropped"""
+        if subscriber.dropped:
+            return None
+        if not subscriber.queue and not subscriber.closed:
+            loop = asyncio.get_running_loop()
+            subscriber.waiter = loop.create_future()
+            timer = loop.call_later(timeout, subscriber.wake)
+            try:
+                await subscriber.waiter
+            finally:
+                timer.cancel()
+                subscriber.waiter = None
+        if subscriber.dropped or not subscriber.queue:
+            return None
+        return subscriber.queue.popleft()
+
+    def stats(self) -> Dict[str, int]:
+        """Current fan-out counters"""
+        return {
+            "subscribers": len(self.subscribers),
+            "delivered": self.delivered,
+            "dropped_clients": self.dropped_clients
+        }
+
+
+async def run_load_test(
+        subscribers: int = 5000,
+        events: int = 2000,
+        patients: int = 100,
+        slow_fraction: float = 0.01,
+        firehose_fraction: float = 0.02,
+        queue_size: int = 100,
+        rate: float = 500
+) -> Dict[str, Any]:
+    """Fan events from a producer thread out to many simulated clients, no Kafka needed.
+
+    firehose_fraction of the clients (dashboards) follow every event and the
+    rest (tablets) follow a single patient; slow_fraction of them never
+    read, and must be dropped without holding up delivery to the rest.
+    """
+    broadcaster = EventBroadcaster()
+    broadcaster.queue_size = queue_size
+    broadcaster.loop = asyncio.get_running_loop()
+    latencies: List[float] = []
+    slow_clients = int(subscribers * slow_fraction)
+    firehose_clients = int(subscribers * firehose_fraction)
+
+    async def client(subscriber: Subscriber, slow: bool):
+        if slow:
+            return  # never reads
+        while True:
+            event = await broadcaster.next_event(subscriber, timeout=5)
+            if event is None:
+                return
+            latencies.append(time.perf_counter() - event["sent_at"])
+
+    tasks = []
+    for index in range(subscribers):
+        subscriber = broadcaster.subscribe(patient_id=None if index < firehose_clients else index % patients)
+        tasks.append(asyncio.create_task(client(subscriber, index < slow_clients)))
+
+    # Let every client reach its first wait before the clock starts
+    await asyncio.sleep(0.5)
+
+    def produce():
+        for n in range(events):
+            # Paced like a consumer thread receiving rate events per second
+            delay = started + n / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            broadcaster.publish_threadsafe({
+                "type": "treatment_updated",
+                "event_type": "treatment",
+                "patient_id": n % patients,
+                "sent_at": time.perf_counter()
+            })
+
+    started = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    await asyncio.to_thread(producer.join)
+    # Wait for every reading client to drain its queue
+    while any(
+            subscriber.queue for subscriber in broadcaster.subscribers.values()
+            if subscriber.subscriber_id > slow_clients
+    ):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    stats = broadcaster.stats()
+
+    broadcaster.stop()
+    await asyncio.gather(*tasks)
+    latency_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "subscribers": subscribers,
+        "events": events,
+        "deliveries": stats["delivered"],
+        "seconds": round(elapsed, 3),
+        "deliveries_per_second": int(stats["delivered"] / elapsed),
+        "latency_ms_p50": round(float(np.percentile(latency_ms, 50)), 2),
+        "latency_ms_p99": round(float(np.percentile(latency_ms, 99)), 2),
+        "slow_clients": slow_clients,
+        "clients_dropped": stats["dropped_clients"]
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Realtime fan-out load test with simulated subscribers")
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--slow-fraction", type=float, default=0.01)
+    parser.add_argument("--firehose-fraction", type=float, default=0.02, help="Clients following every event")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=500, help="Events per second from the producer thread")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print(json.dumps(asyncio.run(run_load_test(
+        args.subscribers, args.events, args.patients, args.slow_fraction, args.firehose_fraction,
+        args.queue_size, args.rate
+    ))))
@@ -1,13 +1,19 @@
 # app/services/kafka_consumer.py
 import json
-from kafka import KafkaConsumer
+from kafka import ConsumerRebalanceListener, KafkaConsumer
 import os
 from dotenv import load_dotenv
 import logging
-from typing import Callable, Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Set
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
+from .ordered_executor import CommitOnRevoke, KeyOrderedExecutor
+from .retry_topics import RetryRouter, RetryTierConsumer, replay_topic, start_retry_tiers
+from .transactional_consumer import (
+    PostgresOffsetStore, SeekToStoredOffsets, TransactionalBatchProcessor
+)
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -21,73 +27,274 @@ class KafkaConsumerService:
         self.consumers: Dict[str, KafkaConsumer] = {}
         self.executor = ThreadPoolExecutor(max_workers=5)
         self.running = False
+        self.retry_tiers: Dict[str, List[RetryTierConsumer]] = {}
+        # Topics whose processing loop commits and closes its own consumer
+        self.closed_by_loop: Set[str] = set()
+
+    def create_consumer(
+            self,
+            topic: str,
+            group_id: str,
+            auto_offset_reset: str = 'earliest',
+            enable_auto_commit: bool = True,
+            listener: Optional[ConsumerRebalanceListener] = None,
+            replay: bool = False
+    ) -> KafkaConsumer:
+        """Create a new Kafka consumer for a topic.
 
-    def create_consumer(self, topic: str, group_id: str) -> KafkaConsumer:
-        """Create a new Kafka consumer for a topic"""
+        With replay=True it also subscribes to the group's replay topic, where
+        retry_topics replay sends the group's dead letters.
+        """
         try:
             consumer = KafkaConsumer(
-                topic,
                 bootstrap_servers=self.bootstrap_servers,
                 group_id=group_id,
-                auto_offset_reset='earliest',
-                enable_auto_commit=True,
+                auto_offset_reset=auto_offset_reset,
+                enable_auto_commit=enable_auto_commit,
                 value_deserializer=lambda x: json.loads(x.decode('utf-8')),
                 key_deserializer=lambda x: x.decode('utf-8') if x else None
             )
+            if listener is not None:
+                listener.consumer = consumer
+            topics = [topic, replay_topic(topic, group_id)] if replay else [topic]
+            consumer.subscribe(topics=topics, listener=listener)
             return consumer
         except Exception as e:
             logger.error(f"Failed to create consumer for topic {topic}: {e}")
             raise
 
-    def process_messages(self, consumer: KafkaConsumer, handler: Callable):
+    def _active(self, consumer: KafkaConsumer) -> bool:
+        # Per consumer, so stopping one topic leaves the others running
+        return self.running and any(active is consumer for active in self.consumers.values())
+
+    def process_messages(
+            self,
+            consumer: KafkaConsumer,
+            handler: Callable,
+            retry_router: Optional[RetryRouter] = None
+    ):
         """Process messages from a Kafka topic"""
         try:
             for message in consumer:
-                if not self.running:
+                if not self._active(consumer):
                     break
                 try:
                     handler(message.value)
+                    if retry_router is not None:
+                        retry_router.applied(message)
                 except Exception as e:
+                    if retry_router is not None and retry_router.route_failure(message, e):
+                        continue
                     logger.error(f"Error processing message: {e}")
         except Exception as e:
             logger.error(f"Error in message processing loop: {e}")
 
-    async def start_consuming(self, topic: str, group_id: str, handler: Callable):
-        """Start consuming messages from a topic"""
+    async def start_consuming(
+            self,
+            topic: str,
+            group_id: str,
+            handler: Callable,
+            auto_offset_reset: str = 'earliest',
+            retry: bool = False
+    ):
+        """Start consuming messages from a topic.
+
+        With retry=True, messages whose handler raises are moved to delayed
+        retry topics and finally to a dead-letter topic instead of being
+        dropped, so the main partitions never wait on a failing message.
+        """
         if topic in self.consumers:
             logger.warning(f"Consumer for topic {topic} already exists")
             return
 
         try:
-            consumer = self.create_consumer(topic, group_id)
+            consumer = self.create_consumer(topic, group_id, auto_offset_reset, replay=retry)
             self.consumers[topic] = consumer
             self.running = True
 
+            retry_router = None
+            if retry:
+                retry_router = RetryRouter(topic, group_id)
+                self.retry_tiers[topic] = start_retry_tiers(retry_router, handler, self.bootstrap_servers)
+
             # Run the consumer in a separate thread
             loop = asyncio.get_event_loop()
             await loop.run_in_executor(
                 self.executor,
                 self.process_messages,
                 consumer,
-                handler
+                handler,
+                retry_router
             )
         except Exception as e:
             logger.error(f"Failed to start consuming from topic {topic}: {e}")
             raise
 
+    def process_ordered(self, consumer: KafkaConsumer, executor: KeyOrderedExecutor):
+        """Fan messages out to key-ordered lanes and commit what every lane has finished"""
+        try:
+            while self._active(consumer):
+                records = consumer.poll(timeout_ms=1000)
+                for messages in records.values():
+                    for message in messages:
+                        executor.submit(message)
+                offsets = executor.tracker.committable()
+                if offsets:
+                    consumer.commit(offsets)
+                    executor.tracker.mark_committed(offsets)
+        except Exception as e:
+            logger.error(f"Error in ordered processing loop: {e}")
+        finally:
+            # Commit what the lanes finished before the consumer goes away;
+            # stop_consuming leaves closing it to this loop
+            executor.shutdown()
+            try:
+                offsets = executor.tracker.committable()
+                if offsets:
+                    consumer.commit(offsets)
+                    executor.tracker.mark_committed(offsets)
+            except Exception as e:
+                logger.error(f"Error committing offsets on shutdown: {e}")
+            finally:
+                consumer.close()
+
+    async def start_ordered_consuming(
+            self,
+            topic: str,
+            group_id: str,
+            handler: Callable,
+            workers: int = 8,
+            auto_offset_reset: str = 'earliest',
+            retry: bool = False
+    ):
+        """Consume with a pool of workers while keeping each key's events in order.
+
+        Producers key events by patient_id, so one patient's history is
+        applied in order while different patients run concurrently. The
+        handler must be thread-safe. Offsets are committed only once every
+        earlier message of the partition has been handled. A failing message
+        holds back its key's later messages while it is retried in process;
+        with retry=True it then moves to the retry topics.
+        """
+        if topic in self.consumers:
+            logger.warning(f"Consumer for topic {topic} already exists")
+            return
+
+        try:
+            retry_router = None
+            if retry:
+                retry_router = RetryRouter(topic, group_id)
+                self.retry_tiers[topic] = start_retry_tiers(retry_router, handler, self.bootstrap_servers)
+
+            def on_error(message, error):
+                if retry_router is None or not retry_router.route_failure(message, error):
+                    logger.error(f"Error processing message: {error}")
+
+            executor = KeyOrderedExecutor(
+                handler,
+                workers=workers,
+                on_error=on_error,
+                on_success=retry_router.applied if retry_router is not None else None
+            )
+            consumer = self.create_consumer(
+                topic,
+                group_id,
+                auto_offset_reset,
+                enable_auto_commit=False,
+                listener=CommitOnRevoke(executor),
+                replay=retry
+            )
+            self.consumers[topic] = consumer
+            self.closed_by_loop.add(topic)
+            self.running = True
+
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                self.executor,
+                self.process_ordered,
+                consumer,
+                executor
+            )
+        except Exception as e:
+            logger.error(f"Failed to start ordered consuming from topic {topic}: {e}")
+            raise
+
+    def process_transactional(
+            self,
+            consumer: KafkaConsumer,
+            processor: TransactionalBatchProcessor,
+            batch_size: int
+    ):
+        """Poll batches and apply each one in a single database transaction"""
+        try:
+            while self._active(consumer):
+                records = consumer.poll(timeout_ms=1000, max_records=batch_size)
+                if records:
+                    processor.process(records)
+        except Exception as e:
+            logger.error(f"Error in transactional processing loop: {e}")
+
+    async def start_transactional_consuming(
+            self,
+            topic: str,
+            group_id: str,
+            handler: Callable,
+            batch_size: int = 500
+    ):
+        """Consume with exactly-once database effects.
+
+        handler(session, event) writes through the given session without
+        committing. Offsets are stored in Postgres in the same transaction
+        as those writes, and consumption resumes from them after a restart
+        or rebalance, so Kafka's own commits are never used. Messages that
+        keep failing go to the group's dead-letter topic, from where
+        retry_topics replay sends them back through the group's replay topic.
+        """
+        if topic in self.consumers:
+            logger.warning(f"Consumer for topic {topic} already exists")
+            return
+
+        try:
+            store = PostgresOffsetStore(group_id)
+            consumer = self.create_consumer(
+                topic,
+                group_id,
+                enable_auto_commit=False,
+                listener=SeekToStoredOffsets(store),
+                replay=True
+            )
+            self.consumers[topic] = consumer
+            self.running = True
+
+            processor = TransactionalBatchProcessor(consumer, store, handler, RetryRouter(topic, group_id))
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                self.executor,
+                self.process_transactional,
+                consumer,
+                processor,
+                batch_size
+            )
+        except Exception as e:
+            logger.error(f"Failed to start transactional consuming from topic {topic}: {e}")
+            raise
+
     def stop_consuming(self, topic: str):
         """Stop consuming messages from a topic"""
         if topic in self.consumers:
-            self.running = False
-            consumer = self.consumers[topic]
-            consumer.close()
-            del self.consumers[topic]
+            consumer = self.consumers.pop(topic)
+            if topic in self.closed_by_loop:
+                self.closed_by_loop.discard(topic)
+            else:
+                consumer.close()
+            for tier in self.retry_tiers.pop(topic, []):
+                tier.stop()
             logger.info(f"Stopped consuming from topic {topic}")
 
     def close_all(self):
         """Close all consumers"""
-        self.running = False
         for topic in list(self.consumers.keys()):
             self.stop_consuming(topic)
+        self.running = False
         self.executor.shutdown(wait=True)
         logger.info("All Kafka consumers closed")
\ No newline at end of file
@@ -2,7 +2,7 @@
 import json
 import os
 from dotenv import load_dotenv
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 import logging
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
@@ -13,6 +13,31 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+def _as_float(value: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+def treatment_event_payload(event_type: str, treatment: Any) -> Dict[str, Any]:
+    """Build a treatment event carrying the fields downstream consumers aggregate on"""
+    return {
+        "type": event_type,
+        "treatment_id": treatment.treatment_id,
+        "patient_id": treatment.patient_id,
+        "treatment_date": treatment.treatment_date.isoformat(),
+        "diagnosis": treatment.diagnosis,
+        "cost": _as_float(treatment.cost),
+        "insurance_coverage": _as_float(treatment.insurance_coverage),
+        "patient_responsibility": _as_float(treatment.patient_responsibility),
+        "follow_up_date": treatment.follow_up_date.isoformat() if treatment.follow_up_date else None
+    }
+
+
+def patient_key(event: Dict[str, Any]) -> Optional[str]:
+    """Message key that keeps one patient's events on one partition, in order"""
+    patient_id = event.get("patient_id")
+    return str(patient_id) if patient_id is not None else None
+
+
 class KafkaProducerService:
     def __init__(self):
         self.bootstrap_servers = 'localhost:9092'  # Use external port
@@ -30,6 +55,9 @@ class KafkaProducerService:
                     bootstrap_servers=self.bootstrap_servers,
                     value_serializer=lambda v: json.dumps(v).encode('utf-8'),
                     key_serializer=lambda k: k.encode('utf-8') if k else None,
+                    # The default partitioner hashes keys with murmur2, the same
+                    # mapping as the Java client, so a patient's events share a
+                    # partition across producers
                     api_version=(2, 5, 0),
                     acks='all',
                     retries=3,
@@ -48,14 +76,20 @@ class KafkaProducerService:
                     logger.error("Failed to initialize Kafka producer after all retries")
                     self.producer = None
 
-    async def send_event(self, topic: str, event: Dict[str, Any], key: Optional[str] = None) -> bool:
-        """Send an event to a Kafka topic"""
+    def publish(
+            self,
+            topic: str,
+            event: Dict[str, Any],
+            key: Optional[str] = None,
+            headers: Optional[List[Tuple[str, bytes]]] = None
+    ) -> bool:
+        """Send an event and wait for the broker; usable from consumer threads"""
         if not self.producer:
             logger.warning(f"Kafka producer not available, skipping event: {event}")
             return False
 
         try:
-            future = self.producer.send(topic, value=event, key=key)
+            future = self.producer.send(topic, value=event, key=key, headers=headers)
             record_metadata = future.get(timeout=10)
             logger.info(f"Event sent to topic {topic}: {event}")
             logger.debug(
@@ -65,20 +99,46 @@ class KafkaProducerService:
             logger.error(f"Failed to send event to topic {topic}: {e}")
             return False
 
+    def publish_many(self, topic: str, events: List[Dict[str, Any]]) -> int:
+        """Send a batch keyed by patient without waiting on each event; returns how many were delivered"""
+        if not self.producer:
+            logger.warning(f"Kafka producer not available, skipping {len(events)} events for {topic}")
+            return 0
+
+        try:
+            futures = [self.producer.send(topic, value=event, key=patient_key(event)) for event in events]
+            self.producer.flush(timeout=30)
+        except Exception as e:
+            logger.error(f"Failed to send events to topic {topic}: {e}")
+            return 0
+        delivered = sum(1 for future in futures if future.succeeded())
+        if delivered < len(events):
+            logger.error(f"Only {delivered}/{len(events)} events delivered to topic {topic}")
+        return delivered
+
+    async def send_event(self, topic: str, event: Dict[str, Any], key: Optional[str] = None) -> bool:
+        """Send an event to a Kafka topic"""
+        return self.publish(topic, event, key=key)
+
     async def send_patient_event(self, topic: str, event: Dict[str, Any]) -> bool:
         """Send a patient-related event"""
         event['event_type'] = 'patient'
-        return await self.send_event(topic, event)
+        return await self.send_event(topic, event, key=patient_key(event))
 
     async def send_treatment_event(self, topic: str, event: Dict[str, Any]) -> bool:
         """Send a treatment-related event"""
         event['event_type'] = 'treatment'
-        return await self.send_event(topic, event)
+        return await self.send_event(topic, event, key=patient_key(event))
+
+    async def send_follow_up_event(self, topic: str, event: Dict[str, Any]) -> bool:
+        """Send a follow-up reminder event"""
+        event['event_type'] = 'follow_up'
+        return await self.send_event(topic, event, key=patient_key(event))
 
     async def send_insurance_event(self, topic: str, event: Dict[str, Any]) -> bool:
         """Send an insurance-related event"""
         event['event_type'] = 'insurance'
-        return await self.send_event(topic, event)
+        return await self.send_event(topic, event, key=patient_key(event))
 
     def close(self) -> None:
         """Close the Kafka producer"""
@@ -0,0 +1,250 @@
+# app/services/ordered_executor.py
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+from kafka import ConsumerRebalanceListener, TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PartitionOffsetTracker:
+    """Track out-of-order completions and report what is safe to commit.
+
+    A partition's committable offset is its oldest message still in flight,
+    so a crash never skips a message that another lane has not finished.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight: Dict[TopicPartition, Deque[int]] = {}
+        self.done: Dict[TopicPartition, Set[int]] = {}
+        self.next_offset: Dict[TopicPartition, int] = {}
+        self.committed: Dict[TopicPartition, int] = {}
+
+    def started(self, tp: TopicPartition, offset: int):
+        with self.lock:
+            self.in_flight.setdefault(tp, deque()).append(offset)
+            self.done.setdefault(tp, set())
+            self.next_offset[tp] = offset + 1
+
+    def finished(self, tp: TopicPartition, offset: int):
+        with self.lock:
+            done = self.done.get(tp)
+            if done is None:
+                return  # partition was revoked meanwhile
+            done.add(offset)
+            pending = self.in_flight[tp]
+            while pending and pending[0] in done:
+                done.discard(pending.popleft())
+
+    def pending(self) -> int:
+        with self.lock:
+            return sum(len(offsets) for offsets in self.in_flight.values())
+
+    def committable(self) -> Dict[TopicPartition, OffsetAndMetadata]:
+        """Offsets that moved since the last commit"""
+        offsets = {}
+        with self.lock:
+            for tp, pending in self.in_flight.items():
+                offset = pending[0] if pending else self.next_offset[tp]
+                if self.committed.get(tp) != offset:
+                    offsets[tp] = OffsetAndMetadata(offset, None)
+        return offsets
+
+    def mark_committed(self, offsets: Dict[TopicPartition, OffsetAndMetadata]):
+        with self.lock:
+            for tp, offset in offsets.items():
+                self.committed[tp] = offset.offset
+
+    def forget(self, partitions: Iterable[TopicPartition]):
+        with self.lock:
+            for tp in partitions:
+                self.in_flight.pop(tp, None)
+                self.done.pop(tp, None)
+                self.next_offset.pop(tp, None)
+                self.committed.pop(tp, None)
+
+
+def ordered_retry_delays() -> List[float]:
+    """Seconds before each in-process retry of a failed message, from KAFKA_ORDERED_RETRY_DELAYS"""
+    value = os.getenv("KAFKA_ORDERED_RETRY_DELAYS", "1,5")
+    return [float(delay) for delay in value.split(",") if delay.strip()]
+
+
+class KeyOrderedExecutor:
+    """Process messages on a pool of lanes, one thread each, chosen by key hash.
+
+    Messages with the same key always land on the same lane and run in the
+    order they were submitted; different keys run concurrently. Messages
+    without a key are laned by partition, which keeps partition order.
+
+    A failed message is retried after each of retry_delays and only then
+    handed to on_error. Meanwhile its key is parked: later messages for the
+    key are held back, in order, and run once the failed one succeeds or
+    is handed off, while other keys on the lane carry on. Parked messages
+    count as in flight, so their offsets are not committed past.
+    """
+
+    def __init__(
+            self,
+            handler: Callable[[Any], None],
+            workers: int = 8,
+            queue_size: int = 1000,
+            on_error: Optional[Callable[[Any, Exception], None]] = None,
+            on_success: Optional[Callable[[Any], None]] = None,
+            retry_delays: Optional[List[float]] = None
+    ):
+        self.handler = handler
+        self.on_error = on_error
+        self.on_success = on_success
+        self.retry_delays = retry_delays if retry_delays is not None else ordered_retry_delays()
+        self.tracker = PartitionOffsetTracker()
+        self.lanes: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        # Per lane: key -> messages held behind that key's failed message.
+        # Only the lane's own thread touches its map.
+        self.parked: List[Dict[str, Deque[Any]]] = [{} for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._run_lane, args=(index,), name=f"ordered-lane-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        self.lock = threading.Lock()
+        # Pending retry timers; cancelled at shutdown, leaving their messages in flight
+        self.timers: Set[threading.Timer] = set()
+        self.stopping = False
+        self.processed = 0
+        self.failed = 0
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def _key(message: Any) -> str:
+        return str(message.key) if message.key is not None else f"{message.topic}:{message.partition}"
+
+    def _lane_index(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % len(self.lanes)
+
+    def submit(self, message: Any):
+        """Queue a message on its key's lane; blocks while that lane is full"""
+        self.tracker.started(TopicPartition(message.topic, message.partition), message.offset)
+        self.lanes[self._lane_index(self._key(message))].put((message, 0))
+
+    def _run_lane(self, index: int):
+        lane, parked = self.lanes[index], self.parked[index]
+        while True:
+            item = lane.get()
+            if item is _STOP:
+                return
+            message, attempt = item
+            key = self._key(message)
+            # Retries come back through the lane; first attempts wait behind a parked key
+            if attempt == 0 and key in parked:
+                parked[key].append(message)
+                continue
+            if self._handle(index, message, attempt):
+                self._release(index, key)
+
+    def _release(self, index: int, key: str):
+        """Run the messages held behind a key, in order, until one fails again"""
+        parked = self.parked[index]
+        held = parked.get(key)
+        while held:
+            if not self._handle(index, held.popleft(), 0):
+                return
+        parked.pop(key, None)
+
+    def _handle(self, index: int, message: Any, attempt: int) -> bool:
+        """Run one message; False if it failed and was parked for another attempt"""
+        try:
+            self.handler(message.value)
+        except Exception as e:
+            if attempt < len(self.retry_delays):
+                self.parked[index].setdefault(self._key(message), deque())
+                self._schedule_retry(index, message, attempt + 1)
+                return False
+            with self.lock:
+                self.failed += 1
+            if self.on_error is not None:
+                try:
+                    self.on_error(message, e)
+                except Exception as routing_error:
+                    logger.error(f"Error handling failed message: {routing_error}")
+            else:
+                logger.error(f"Error processing message: {e}")
+        else:
+            with self.lock:
+                self.processed += 1
+            if self.on_success is not None:
+                try:
+                    self.on_success(message)
+                except Exception as e:
+                    logger.error(f"Error recording processed message: {e}")
+        self.tracker.finished(TopicPartition(message.topic, message.partition), message.offset)
+        return True
+
+    def _schedule_retry(self, index: int, message: Any, attempt: int):
+        with self.lock:
+            if self.stopping:
+                return  # stays in flight and is redelivered after a restart
+            timer = threading.Timer(self.retry_delays[attempt - 1], self._retry, args=(index, message, attempt))
+            timer.daemon = True
+            self.timers.add(timer)
+            timer.start()
+
+    def _retry(self, index: int, message: Any, attempt: int):
+        with self.lock:
+            self.timers.discard(threading.current_thread())
+            if self.stopping:
+                return
+        self.lanes[index].put((message, attempt))
+
+    def drain(self):
+        """Wait until every submitted message has finished, parked retries included"""
+        while self.tracker.pending():
+            time.sleep(0.01)
+
+    def shutdown(self):
+        """Stop the lanes once they have worked through their queues.
+
+        Pending retries are cancelled rather than waited for: their messages
+        (and anything parked behind them) stay in flight, so the committable
+        offsets stop short of them and they are redelivered after a restart.
+        """
+        with self.lock:
+            self.stopping = True
+            timers, self.timers = self.timers, set()
+        for timer in timers:
+            timer.cancel()
+        for lane in self.lanes:
+            lane.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+
+class CommitOnRevoke(ConsumerRebalanceListener):
+    """Finish in-flight work and commit before partitions move to another member"""
+
+    def __init__(self, executor: KeyOrderedExecutor):
+        self.executor = executor
+        self.consumer = None
+
+    def on_partitions_revoked(self, revoked):
+        self.executor.drain()
+        offsets = self.executor.tracker.committable()
+        if offsets:
+            try:
+                self.consumer.commit(offsets)
+            except Exception as e:
+                logger.error(f"Error committing offsets on revoke: {e}")
+        self.executor.tracker.forget(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(f"Ordered consumer assigned {len(assigned)} partitions")
@@ -0,0 +1,72 @@
+# app/services/patient_activity.py
+import asyncio
+import logging
+import os
+from typing import Any, Dict
+
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from .kafka_consumer import KafkaConsumerService
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Event type -> counter it bumps
+COUNTERS = {
+    "new_treatment": "treatments_created",
+    "treatment_updated": "treatments_updated",
+    "treatment_deleted": "treatments_deleted"
+}
+
+
+class PatientActivityProjection:
+    """Count each patient's treatment events into patient_activity.
+
+    Counters are not idempotent: a redelivered event would count twice. The
+    projection therefore runs on the transactional consumer, which stores
+    its offsets in the same transaction as the increments. Workers share one
+    consumer group and split the partitions between them.
+    """
+
+    def __init__(self):
+        self.group_id = os.getenv("PATIENT_ACTIVITY_GROUP_ID", "patient-activity")
+        self.batch_size = int(os.getenv("PATIENT_ACTIVITY_BATCH_SIZE", "500"))
+        self.consumer_service = KafkaConsumerService()
+        self.task = None
+
+    def handle_event(self, db: Session, event: Dict[str, Any]):
+        """Apply one treatment-events message inside the batch transaction"""
+        from ..models.patient_activity import patient_activity_table as a
+
+        counter = COUNTERS.get(event.get("type"))
+        patient_id = event.get("patient_id")
+        # Archiving moves treatments to cold storage; the patient deleted nothing
+        if counter is None or patient_id is None or event.get("archived"):
+            return
+        statement = insert(a).values(patient_id=patient_id, **{counter: 1})
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[a.c.patient_id],
+            set_={counter: a.c[counter] + 1, "updated_at": func.now()}
+        ))
+
+    async def start(self):
+        """Start following treatment-events"""
+        if self.task:
+            return
+        self.task = asyncio.create_task(
+            self.consumer_service.start_transactional_consuming(
+                "treatment-events",
+                self.group_id,
+                self.handle_event,
+                batch_size=self.batch_size
+            )
+        )
+
+    def stop(self):
+        """Stop following treatment-events"""
+        self.consumer_service.stop_consuming("treatment-events")
+        self.task = None
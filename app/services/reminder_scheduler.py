@@ -0,0 +1,348 @@
+# app/services/reminder_scheduler.py
+import asyncio
+import heapq
+import logging
+import os
+import socket
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from dotenv import load_dotenv
+from sqlalchemy import and_, bindparam, select, text, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, DATE, INTEGER
+
+from .database import SessionLocal
+from .kafka_consumer import KafkaConsumerService
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_UP_TOPIC = "follow-up-due"
+
+# Claim due reminders that still match the treatments table. The primary key
+# on follow_up_notifications makes sure only one instance wins each reminder;
+# an unsent claim older than the timeout belongs to a crashed instance and
+# can be taken over.
+CLAIM_SQL = text("""
+    INSERT INTO follow_up_notifications (treatment_id, follow_up_date, patient_id, claimed_by)
+    SELECT t.treatment_id, t.follow_up_date, t.patient_id, :instance
+    FROM unnest(:treatment_ids, :follow_up_dates) AS due(treatment_id, follow_up_date)
+    JOIN treatments t
+      ON t.treatment_id = due.treatment_id
+     AND t.follow_up_date = due.follow_up_date
+    ON CONFLICT (treatment_id, follow_up_date) DO UPDATE
+       SET claimed_by = EXCLUDED.claimed_by,
+           claimed_at = now()
+     WHERE follow_up_notifications.sent_at IS NULL
+       AND follow_up_notifications.claimed_at < now() - make_interval(secs => :claim_timeout)
+    RETURNING treatment_id, follow_up_date, patient_id
+""").bindparams(
+    bindparam("treatment_ids", type_=ARRAY(INTEGER)),
+    bindparam("follow_up_dates", type_=ARRAY(DATE))
+)
+
+# Give back unsent claims left behind by an instance that died between claim
+# and release, for the reminders this instance owns
+SWEEP_SQL = text("""
+    DELETE FROM follow_up_notifications n
+    USING treatments t
+    WHERE n.sent_at IS NULL
+      AND n.claimed_at < now() - make_interval(secs => :claim_timeout)
+      AND n.treatment_id % :instance_count = :instance_index
+      AND t.treatment_id = n.treatment_id
+      AND t.follow_up_date = n.follow_up_date
+    RETURNING n.treatment_id, n.follow_up_date, n.patient_id
+""")
+
+
+class FollowUpScheduler:
+    """Emit follow-up-due events from an in-memory heap of upcoming follow-ups"""
+
+    def __init__(self):
+        self.instance_count = int(os.getenv("FOLLOW_UP_INSTANCE_COUNT", "1"))
+        self.instance_index = int(os.getenv("FOLLOW_UP_INSTANCE_INDEX", "0"))
+        self.instance_name = f"{socket.gethostname()}-{os.getpid()}"
+        self.lookahead_days = int(os.getenv("FOLLOW_UP_LOOKAHEAD_DAYS", "7"))
+        self.overdue_days = int(os.getenv("FOLLOW_UP_OVERDUE_DAYS", "3"))
+        self.batch_size = int(os.getenv("FOLLOW_UP_BATCH_SIZE", "10000"))
+        self.dispatch_batch_size = int(os.getenv("FOLLOW_UP_DISPATCH_BATCH_SIZE", "1000"))
+        self.tick_seconds = int(os.getenv("FOLLOW_UP_TICK_SECONDS", "60"))
+        # Longer than any publish can take, so only abandoned claims count as stale
+        self.claim_timeout = int(os.getenv("FOLLOW_UP_CLAIM_TIMEOUT_SECONDS", "600"))
+
+        # (due ordinal, treatment_id); stale entries are skipped lazily on pop
+        self.heap: List[Tuple[int, int]] = []
+        # treatment_id -> (due ordinal, patient_id), the authoritative schedule
+        self.scheduled: Dict[int, Tuple[int, int]] = {}
+        # (follow_up_date, treatment_id) up to which the table has been scanned
+        self.loaded_key: Optional[Tuple[date, int]] = None
+        # Event updates received while a range scan is running; they are newer
+        # than anything the scan read and win over its rows
+        self.scanning = False
+        self.overrides: Dict[int, Tuple[int, Optional[date]]] = {}
+        self.lock = threading.Lock()
+
+        self.consumer_service = KafkaConsumerService()
+        self.scheduler: Optional[AsyncIOScheduler] = None
+        self.task = None
+
+    def owns(self, treatment_id: int) -> bool:
+        """Whether this instance is responsible for a treatment"""
+        return treatment_id % self.instance_count == self.instance_index
+
+    def _place(self, treatment_id: int, patient_id: int, follow_up_date: Optional[date]):
+        """Put a reminder on the heap if the scan has reached it (lock held)"""
+        if follow_up_date is None:
+            self.scheduled.pop(treatment_id, None)
+            return
+        if self.loaded_key is None or (follow_up_date, treatment_id) > self.loaded_key:
+            # Not scanned yet; the range scan picks it up when the window reaches it
+            self.scheduled.pop(treatment_id, None)
+            return
+        due = follow_up_date.toordinal()
+        self.scheduled[treatment_id] = (due, patient_id)
+        heapq.heappush(self.heap, (due, treatment_id))
+
+    def schedule(self, treatment_id: int, patient_id: int, follow_up_date: Optional[date]):
+        """Add, move or remove a reminder"""
+        if not self.owns(treatment_id):
+            return
+        with self.lock:
+            if self.scanning:
+                self.overrides[treatment_id] = (patient_id, follow_up_date)
+            self._place(treatment_id, patient_id, follow_up_date)
+
+    def unschedule(self, treatment_id: int):
+        """Drop a reminder"""
+        self.schedule(treatment_id, None, None)
+
+    def pending(self) -> int:
+        """Number of reminders held in memory"""
+        return len(self.scheduled)
+
+    def extend_window(self, today: Optional[date] = None) -> int:
+        """Load follow-ups that entered the lookahead window since the last scan"""
+        from ..models.treatment import treatments_table as t
+
+        today = today or date.today()
+        horizon = today + timedelta(days=self.lookahead_days)
+        with self.lock:
+            last_key = self.loaded_key or (today - timedelta(days=self.overdue_days + 1), 0)
+        if horizon <= last_key[0]:
+            return 0
+
+        loaded = 0
+        with self.lock:
+            self.scanning = True
+            self.overrides.clear()
+        db = SessionLocal()
+        try:
+            while True:
+                rows = db.execute(
+                    select(t.c.follow_up_date, t.c.treatment_id, t.c.patient_id)
+                    .where(and_(
+                        tuple_(t.c.follow_up_date, t.c.treatment_id) > tuple_(*last_key),
+                        t.c.follow_up_date <= horizon
+                    ))
+                    .order_by(t.c.follow_up_date, t.c.treatment_id)
+                    .limit(self.batch_size)
+                ).all()
+                if not rows:
+                    break
+                last_key = (rows[-1].follow_up_date, rows[-1].treatment_id)
+                with self.lock:
+                    # Advance the key and place the batch in one step, so update
+                    # events for scanned rows are applied directly from here on
+                    self.loaded_key = last_key
+                    for row in rows:
+                        if self.owns(row.treatment_id) and row.treatment_id not in self.overrides:
+                            self._place(row.treatment_id, row.patient_id, row.follow_up_date)
+                    self._replay_overrides()
+                loaded += len(rows)
+                if len(rows) < self.batch_size:
+                    break
+        finally:
+            db.close()
+            with self.lock:
+                self.loaded_key = (horizon, 2 ** 31 - 1)
+                self._replay_overrides()
+                self.scanning = False
+                self.overrides.clear()
+        logger.info(f"Loaded {loaded} follow-ups through {horizon}; {self.pending()} pending")
+        return loaded
+
+    def _replay_overrides(self):
+        """Re-place event updates that arrived during the scan (lock held).
+
+        An event can land after the scan read a row but before the key moved
+        past it, in which case it was dropped as not scanned yet and the row
+        the scan read is stale.
+        """
+        for treatment_id, (patient_id, follow_up_date) in self.overrides.items():
+            self._place(treatment_id, patient_id, follow_up_date)
+
+    def pop_due(self, today: Optional[date] = None) -> List[Tuple[int, date]]:
+        """Remove and return up to one batch of due reminders"""
+        cutoff = (today or date.today()).toordinal()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= cutoff and len(due) < self.dispatch_batch_size:
+                ordinal, treatment_id = heapq.heappop(self.heap)
+                current = self.scheduled.get(treatment_id)
+                if current is None or current[0] != ordinal:
+                    continue
+                del self.scheduled[treatment_id]
+                due.append((treatment_id, date.fromordinal(ordinal)))
+        return due
+
+    def claim(self, due: List[Tuple[int, date]]) -> List[Any]:
+        """Claim reminders in the database; returns the rows this instance won"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(CLAIM_SQL, {
+                "instance": self.instance_name,
+                "claim_timeout": self.claim_timeout,
+                "treatment_ids": [treatment_id for treatment_id, _ in due],
+                "follow_up_dates": [follow_up_date for _, follow_up_date in due]
+            }).all()
+            db.commit()
+            return rows
+        finally:
+            db.close()
+
+    def release(self, rows: List[Any], sent: bool):
+        """Mark claimed reminders as sent, or give them back for a later retry"""
+        if not rows:
+            return
+        db = SessionLocal()
+        try:
+            params = {
+                "treatment_ids": [row.treatment_id for row in rows],
+                "follow_up_dates": [row.follow_up_date for row in rows]
+            }
+            statement = "UPDATE follow_up_notifications SET sent_at = now()" if sent \
+                else "DELETE FROM follow_up_notifications"
+            db.execute(
+                text(f"""
+                    {statement}
+                    WHERE (treatment_id, follow_up_date) IN (
+                        SELECT * FROM unnest(:treatment_ids, :follow_up_dates)
+                    )
+                """).bindparams(
+                    bindparam("treatment_ids", type_=ARRAY(INTEGER)),
+                    bindparam("follow_up_dates", type_=ARRAY(DATE))
+                ),
+                params
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def sweep_stale_claims(self) -> int:
+        """Release abandoned claims and put their reminders back on the heap"""
+        db = SessionLocal()
+        try:
+            rows = db.execute(SWEEP_SQL, {
+                "claim_timeout": self.claim_timeout,
+                "instance_count": self.instance_count,
+                "instance_index": self.instance_index
+            }).all()
+            db.commit()
+        finally:
+            db.close()
+        for row in rows:
+            self.schedule(row.treatment_id, row.patient_id, row.follow_up_date)
+        if rows:
+            logger.warning(f"Reclaimed {len(rows)} follow-ups from stale claims")
+        return len(rows)
+
+    async def dispatch_due(self):
+        """Claim and publish every reminder that has come due"""
+        from . import kafka_producer
+
+        loop = asyncio.get_running_loop()
+        while True:
+            due = self.pop_due()
+            if not due:
+                return
+            claimed = await loop.run_in_executor(None, self.claim, due)
+            sent, failed = [], []
+            for row in claimed:
+                ok = await kafka_producer.send_follow_up_event(FOLLOW_UP_TOPIC, {
+                    "type": "follow_up_due",
+                    "treatment_id": row.treatment_id,
+                    "patient_id": row.patient_id,
+                    "follow_up_date": row.follow_up_date.isoformat()
+                })
+                (sent if ok else failed).append(row)
+            await loop.run_in_executor(None, self.release, sent, True)
+            await loop.run_in_executor(None, self.release, failed, False)
+            for row in failed:
+                self.schedule(row.treatment_id, row.patient_id, row.follow_up_date)
+            logger.info(f"Follow-ups due: {len(due)}, sent: {len(sent)}, failed: {len(failed)}")
+            if failed:
+                return
+
+    async def tick(self):
+        """Periodic job: slide the window forward, recover stale claims, then dispatch"""
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.extend_window)
+            await loop.run_in_executor(None, self.sweep_stale_claims)
+            await self.dispatch_due()
+        except Exception as e:
+            logger.error(f"Error in follow-up scheduler tick: {e}")
+
+    def handle_event(self, event: Dict[str, Any]):
+        """Keep the schedule in step with treatment-events"""
+        treatment_id = event.get("treatment_id")
+        if treatment_id is None:
+            return
+        event_type = event.get("type")
+        if event_type == "treatment_deleted":
+            self.unschedule(treatment_id)
+        elif event_type in ("new_treatment", "treatment_updated") and "follow_up_date" in event:
+            follow_up_date = event["follow_up_date"]
+            self.schedule(
+                treatment_id,
+                event.get("patient_id"),
+                date.fromisoformat(follow_up_date) if follow_up_date else None
+            )
+
+    async def start(self):
+        """Start the periodic job and the treatment-events subscription"""
+        if self.scheduler:
+            return
+        self.scheduler = AsyncIOScheduler()
+        self.scheduler.add_job(
+            self.tick,
+            "interval",
+            seconds=self.tick_seconds,
+            next_run_time=datetime.now(),
+            max_instances=1,
+            coalesce=True
+        )
+        self.scheduler.start()
+        # The schedule is rebuilt from the table on start, so only new events matter
+        self.task = asyncio.create_task(
+            self.consumer_service.start_consuming(
+                "treatment-events",
+                f"follow-up-{self.instance_name}",
+                self.handle_event,
+                auto_offset_reset='latest'
+            )
+        )
+        logger.info(
+            f"Follow-up scheduler started as instance {self.instance_index + 1}/{self.instance_count}"
+        )
+
+    def stop(self):
+        """Stop the periodic job and the subscription"""
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+        self.consumer_service.stop_consuming("treatment-events")
+        self.task = None
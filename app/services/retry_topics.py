@@ -0,0 +1,356 @@
+# app/services/retry_topics.py
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from kafka import KafkaConsumer, TopicPartition
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ATTEMPT_HEADER = "retry-attempt"
+SOURCE_TOPIC_HEADER = "retry-source-topic"
+NOT_BEFORE_HEADER = "retry-not-before"
+# Producer timestamp of the original message, kept across tiers
+ORIGINAL_TIMESTAMP_HEADER = "original-timestamp"
+
+# Fields naming the entity an event describes, most specific first
+ENTITY_FIELDS = ("treatment_id", "insurance_id", "document_id", "patient_id")
+
+# Exception text often quotes the offending values; headers outlive retention
+# decisions for PHI, so they only carry a scrubbed, short form
+_QUOTED = re.compile(r"(['\"]).*?\1")
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+_NUMBER = re.compile(r"\d{3,}")
+ERROR_MESSAGE_LIMIT = 200
+
+
+# Retry and dead-letter topics belong to one consumer group, so a group's
+# tier consumers only ever see its own failures
+def retry_topic(source_topic: str, group_id: str, attempt: int) -> str:
+    return f"{source_topic}.{group_id}.retry.{attempt}"
+
+
+def dead_letter_topic(source_topic: str, group_id: str) -> str:
+    return f"{source_topic}.{group_id}.dlq"
+
+
+def replay_topic(source_topic: str, group_id: str) -> str:
+    """Where replayed dead letters go; the group consumes it next to the source topic"""
+    return f"{source_topic}.{group_id}.replay"
+
+
+def retry_delays() -> List[int]:
+    """Delay in seconds before each retry tier, from KAFKA_RETRY_DELAYS"""
+    value = os.getenv("KAFKA_RETRY_DELAYS", "30,300,1800")
+    return [int(delay) for delay in value.split(",") if delay.strip()]
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def scrub_error(error: Exception) -> str:
+    """Exception text with quoted values, emails and long numbers masked"""
+    text = _QUOTED.sub("'?'", str(error))
+    text = _EMAIL.sub("?@?", text)
+    text = _NUMBER.sub("?", text)
+    return text[:ERROR_MESSAGE_LIMIT]
+
+
+def event_entity(event: Any) -> Optional[str]:
+    """Identity of the entity an event is about, e.g. 'treatment_id=42'"""
+    if not isinstance(event, dict):
+        return None
+    for field in ENTITY_FIELDS:
+        if event.get(field) is not None:
+            return f"{field}={event[field]}"
+    return None
+
+
+def message_headers(message: Any) -> Dict[str, str]:
+    return {key: value.decode("utf-8") for key, value in (message.headers or [])}
+
+
+def _create_consumer(bootstrap_servers: str, topic: str, group_id: str) -> KafkaConsumer:
+    return KafkaConsumer(
+        topic,
+        bootstrap_servers=bootstrap_servers,
+        group_id=group_id,
+        auto_offset_reset='earliest',
+        enable_auto_commit=False,
+        value_deserializer=lambda x: json.loads(x.decode('utf-8')),
+        key_deserializer=lambda x: x.decode('utf-8') if x else None
+    )
+
+
+class RetryRouter:
+    """Move failed messages off the main topic into delayed retry tiers.
+
+    A message that fails on the source topic goes to retry tier 1; one that
+    fails in tier n goes to tier n + 1, and after the last tier to the
+    dead-letter topic. Each copy carries the attempt count, the time it
+    becomes due, the original producer timestamp and a scrubbed error.
+
+    Events carry the full state of their entity, so once a newer event for
+    the same entity has been applied a pending retry is stale: replaying it
+    would roll the entity back. The router remembers the newest applied
+    timestamp per entity and the tiers drop retries older than that. The
+    watermarks are per process, which covers groups that run in one process
+    (the per-worker analytics group) and, for shared groups, retries that
+    land on the worker that owns the entity's source partition.
+    """
+
+    def __init__(self, source_topic: str, group_id: str, delays: Optional[List[int]] = None):
+        self.source_topic = source_topic
+        self.group_id = group_id
+        self.delays = delays if delays is not None else retry_delays()
+        self.max_tracked = int(os.getenv("KAFKA_RETRY_TRACKED_ENTITIES", "100000"))
+        # entity -> newest applied producer timestamp (ms), least recent first
+        self.watermarks: "OrderedDict[str, int]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _timestamp(message: Any) -> int:
+        return int(message_headers(message).get(ORIGINAL_TIMESTAMP_HEADER, message.timestamp))
+
+    def applied(self, message: Any):
+        """Record that a message's entity state has been applied"""
+        entity = event_entity(message.value)
+        if entity is None:
+            return
+        timestamp = self._timestamp(message)
+        with self.lock:
+            if self.watermarks.get(entity, -1) < timestamp:
+                self.watermarks[entity] = timestamp
+            self.watermarks.move_to_end(entity)
+            while len(self.watermarks) > self.max_tracked:
+                self.watermarks.popitem(last=False)
+
+    def is_stale(self, message: Any) -> bool:
+        """Whether a newer event for the same entity has been applied since"""
+        entity = event_entity(message.value)
+        if entity is None:
+            return False
+        with self.lock:
+            return self.watermarks.get(entity, -1) > self._timestamp(message)
+
+    def route_failure(self, message: Any, error: Exception) -> bool:
+        """Publish a failed message to its next tier; False if that send failed"""
+        attempt = int(message_headers(message).get(ATTEMPT_HEADER, "0")) + 1
+        if attempt <= len(self.delays):
+            topic = retry_topic(self.source_topic, self.group_id, attempt)
+            not_before = _now_ms() + self.delays[attempt - 1] * 1000
+        else:
+            topic = dead_letter_topic(self.source_topic, self.group_id)
+            not_before = _now_ms()
+        return self._forward(message, error, topic, attempt, not_before)
+
+    def dead_letter(self, message: Any, error: Exception) -> bool:
+        """Publish a failed message straight to the dead-letter topic, skipping the retry tiers"""
+        attempt = int(message_headers(message).get(ATTEMPT_HEADER, "0")) + 1
+        return self._forward(message, error, dead_letter_topic(self.source_topic, self.group_id), attempt, _now_ms())
+
+    def _forward(self, message: Any, error: Exception, topic: str, attempt: int, not_before: int) -> bool:
+        from . import kafka_producer
+
+        headers = message_headers(message)
+        headers.update({
+            ATTEMPT_HEADER: str(attempt),
+            SOURCE_TOPIC_HEADER: self.source_topic,
+            NOT_BEFORE_HEADER: str(not_before),
+            ORIGINAL_TIMESTAMP_HEADER: str(self._timestamp(message)),
+            "error-type": type(error).__name__,
+            "error-message": scrub_error(error),
+            "original-partition": headers.get("original-partition", str(message.partition)),
+            "original-offset": headers.get("original-offset", str(message.offset)),
+            "failed-at": datetime.utcnow().isoformat()
+        })
+        sent = kafka_producer.publish(
+            topic,
+            message.value,
+            key=message.key,
+            headers=[(key, value.encode("utf-8")) for key, value in headers.items()]
+        )
+        if sent:
+            logger.warning(
+                f"Routed failed message from {message.topic} to {topic} "
+                f"(attempt {attempt}): {type(error).__name__}: {scrub_error(error)}"
+            )
+        return sent
+
+
+class RetryTierConsumer(threading.Thread):
+    """Consume one retry tier, holding each partition until its head message is due.
+
+    Every message in a tier waits the same delay, so due times only grow
+    along a partition; pausing at the first message that is not yet due
+    holds back nothing that could have run earlier.
+    """
+
+    def __init__(self, router: RetryRouter, attempt: int, handler: Callable, bootstrap_servers: str):
+        super().__init__(name=f"retry-{router.source_topic}-{attempt}", daemon=True)
+        self.router = router
+        self.attempt = attempt
+        self.handler = handler
+        self.bootstrap_servers = bootstrap_servers
+        self.topic = retry_topic(router.source_topic, router.group_id, attempt)
+        self.stopped = threading.Event()
+        # partition -> epoch ms at which to resume it
+        self.paused: Dict[TopicPartition, int] = {}
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            consumer = _create_consumer(self.bootstrap_servers, self.topic, self.topic)
+        except Exception as e:
+            logger.error(f"Failed to create consumer for retry topic {self.topic}: {e}")
+            return
+
+        try:
+            while not self.stopped.is_set():
+                self._resume_due(consumer)
+                records = consumer.poll(timeout_ms=self._poll_timeout())
+                for tp, messages in records.items():
+                    self._process_partition(consumer, tp, messages)
+                if records:
+                    consumer.commit()
+        except Exception as e:
+            logger.error(f"Error in retry loop for {self.topic}: {e}")
+        finally:
+            consumer.close()
+
+    def _poll_timeout(self) -> int:
+        if not self.paused:
+            return 1000
+        return max(0, min(1000, min(self.paused.values()) - _now_ms()))
+
+    def _resume_due(self, consumer: KafkaConsumer):
+        now = _now_ms()
+        assigned = consumer.assignment()
+        due = [tp for tp, resume_at in self.paused.items() if resume_at <= now]
+        for tp in due:
+            del self.paused[tp]
+        # Partitions lost in a rebalance come back unpaused to their new owner
+        due = [tp for tp in due if tp in assigned]
+        if due:
+            consumer.resume(*due)
+
+    def _hold(self, consumer: KafkaConsumer, tp: TopicPartition, offset: int, until: int):
+        consumer.seek(tp, offset)
+        consumer.pause(tp)
+        self.paused[tp] = until
+
+    def _process_partition(self, consumer: KafkaConsumer, tp: TopicPartition, messages: List[Any]):
+        for message in messages:
+            not_before = int(message_headers(message).get(NOT_BEFORE_HEADER, "0"))
+            if not_before > _now_ms():
+                self._hold(consumer, tp, message.offset, not_before)
+                return
+            if self.router.is_stale(message):
+                logger.info(f"Dropping stale retry {self.topic}[{tp.partition}]@{message.offset}")
+                continue
+            try:
+                self.handler(message.value)
+                self.router.applied(message)
+            except Exception as e:
+                if not self.router.route_failure(message, e):
+                    # Could not hand it on; try this message again after the tier delay
+                    delay = self.router.delays[self.attempt - 1] * 1000
+                    self._hold(consumer, tp, message.offset, _now_ms() + delay)
+                    return
+
+
+def start_retry_tiers(router: RetryRouter, handler: Callable, bootstrap_servers: str) -> List[RetryTierConsumer]:
+    """Start one consumer thread per retry tier"""
+    tiers = [
+        RetryTierConsumer(router, attempt, handler, bootstrap_servers)
+        for attempt in range(1, len(router.delays) + 1)
+    ]
+    for tier in tiers:
+        tier.start()
+    logger.info(f"Started {len(tiers)} retry tiers for {router.source_topic}: delays {router.delays}s")
+    return tiers
+
+
+def replay_dead_letters(
+        source_topic: str,
+        group_id: str,
+        limit: Optional[int] = None,
+        dry_run: bool = False
+) -> Tuple[int, int]:
+    """Republish a group's dead-lettered messages to the group's replay topic.
+
+    Only that group consumes the replay topic, so other groups on the source
+    topic (e.g. counters) do not apply the event a second time. Replayed
+    copies start again at attempt zero. Returns (replayed, failed).
+    """
+    from . import kafka_producer
+
+    bootstrap_servers = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092")
+    topic = dead_letter_topic(source_topic, group_id)
+    consumer = _create_consumer(bootstrap_servers, topic, f"{topic}-replay")
+    replayed = failed = 0
+    try:
+        while limit is None or replayed + failed < limit:
+            records = consumer.poll(timeout_ms=5000, max_records=100)
+            if not records:
+                break
+            for tp, messages in records.items():
+                for message in messages:
+                    if limit is not None and replayed + failed >= limit:
+                        consumer.seek(tp, message.offset)
+                        break
+                    headers = message_headers(message)
+                    if dry_run:
+                        print(json.dumps({"offset": message.offset, "key": message.key,
+                                          "headers": headers, "value": message.value}))
+                        replayed += 1
+                        continue
+                    replay_headers = [
+                        (key, value.encode("utf-8")) for key, value in headers.items()
+                        if key not in (ATTEMPT_HEADER, NOT_BEFORE_HEADER)
+                    ]
+                    target = replay_topic(headers.get(SOURCE_TOPIC_HEADER, source_topic), group_id)
+                    if kafka_producer.publish(target, message.value, key=message.key, headers=replay_headers):
+                        replayed += 1
+                    else:
+                        failed += 1
+                        consumer.seek(tp, message.offset)
+                        break
+            if failed:
+                break
+        if not dry_run:
+            consumer.commit()
+    finally:
+        consumer.close()
+    logger.info(f"Replayed {replayed} dead letters of {group_id} on {source_topic}, {failed} failed")
+    return replayed, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kafka retry topics and dead-letter queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = subparsers.add_parser("replay", help="Republish a topic's dead letters")
+    replay_parser.add_argument("topic", help="Source topic, e.g. treatment-events")
+    replay_parser.add_argument("group", help="Consumer group whose dead letters to replay")
+    replay_parser.add_argument("--limit", type=int)
+    replay_parser.add_argument("--dry-run", action="store_true", help="Print dead letters without replaying")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    replayed, failed = replay_dead_letters(args.topic, args.group, limit=args.limit, dry_run=args.dry_run)
+    print(f"replayed={replayed} failed={failed}")
@@ -1,16 +1,33 @@
 # app/services/s3_service.py
 import boto3
+import hashlib
 import os
+import tempfile
+from dataclasses import dataclass
 from dotenv import load_dotenv
 from datetime import datetime
 import logging
 from botocore.exceptions import ClientError
-from typing import Optional, BinaryIO
+from typing import Optional, BinaryIO, Tuple
+
+from .single_flight import run_blocking, single_flight
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+HASH_CHUNK_SIZE = 1024 * 1024
+# Uploads larger than this are spooled to disk while they are hashed
+SPOOL_MAX_MEMORY = int(os.getenv("S3_SPOOL_MAX_MEMORY_MB", "8")) * 1024 * 1024
+
+
+@dataclass
+class HashedFile:
+    """An upload read once: its SHA-256, size and a rewound local copy"""
+    sha256: str
+    size: int
+    file: BinaryIO
+
 
 class S3Service:
     def __init__(self):
@@ -18,12 +35,15 @@ class S3Service:
         self.aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
         self.region_name = os.getenv('AWS_REGION', 'us-east-1')
         self.bucket_name = os.getenv('AWS_BUCKET_NAME', 'mine-pos')
+        # Point at a local S3 stand-in (MinIO, moto server) for development
+        self.endpoint_url = os.getenv('AWS_S3_ENDPOINT_URL')
 
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=self.aws_access_key_id,
             aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region_name
+            region_name=self.region_name,
+            endpoint_url=self.endpoint_url
         )
 
         # Define standard paths
@@ -31,7 +51,9 @@ class S3Service:
             'patient_images': 'healthcare/patient_images',
             'documents': 'healthcare/documents',
             'backups': 'healthcare/backups/database',
-            'audit_logs': 'healthcare/audit_logs'
+            'audit_logs': 'healthcare/audit_logs',
+            'archive': 'healthcare/archive',
+            'blobs': 'healthcare/blobs/sha256'
         }
 
     async def upload_file(
@@ -65,14 +87,20 @@ class S3Service:
             logger.error(f"Error uploading file to S3: {e}")
             raise
 
+    def _get_object_bytes(self, key: str) -> bytes:
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=key
+        )
+        return response['Body'].read()
+
     async def download_file(self, key: str) -> bytes:
-        """Download a file from S3"""
+        """Download a file from S3; concurrent downloads of one key share a single fetch"""
         try:
-            response = self.s3_client.get_object(
-                Bucket=self.bucket_name,
-                Key=key
+            return await single_flight("s3.download").do(
+                (self.bucket_name, key),
+                lambda: run_blocking(self._get_object_bytes, key)
             )
-            return response['Body'].read()
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
                 logger.error(f"File not found in S3: {key}")
@@ -82,20 +110,68 @@ class S3Service:
             logger.error(f"Error downloading file from S3: {e}")
             raise
 
+    @staticmethod
+    def hash_file(file_obj: BinaryIO) -> HashedFile:
+        """Read an upload once, hashing it while copying it to a local spool"""
+        digest = hashlib.sha256()
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        size = 0
+        while True:
+            chunk = file_obj.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+        spool.seek(0)
+        return HashedFile(digest.hexdigest(), size, spool)
+
+    def blob_key(self, sha256: str) -> str:
+        # Two-character fan-out keeps listings of the prefix manageable
+        return f"{self.paths['blobs']}/{sha256[:2]}/{sha256}"
+
+    def blob_exists(self, key: str) -> bool:
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put_blob(self, hashed: HashedFile, content_type: Optional[str] = None) -> Tuple[str, bool]:
+        """Store content under its hash unless it is already there; returns (key, uploaded).
+
+        Called from DocumentStore.stage, ahead of recording the reference;
+        an object nothing references is invisible to reclaim and never deleted.
+        """
+        key = self.blob_key(hashed.sha256)
+        if self.blob_exists(key):
+            logger.info(f"Blob already stored, skipping upload: {key}")
+            return key, False
+        extra_args = {
+            'ServerSideEncryption': 'AES256'
+        }
+        if content_type:
+            extra_args['ContentType'] = content_type
+        hashed.file.seek(0)
+        self.s3_client.upload_fileobj(hashed.file, self.bucket_name, key, ExtraArgs=extra_args)
+        logger.info(f"Blob uploaded successfully: {key} ({hashed.size} bytes)")
+        return key, True
+
     async def store_patient_image(
             self,
             patient_id: int,
             image_file: BinaryIO,
             image_type: str
     ) -> str:
-        """Store a patient image"""
-        folder = f"{self.paths['patient_images']}/{patient_id}"
-        filename = f"{image_type}.jpg"
-        return await self.upload_file(
-            image_file,
-            folder,
-            filename,
-            'image/jpeg'
+        """Store a patient image; returns its content-addressed key.
+
+        A thin wrapper over DocumentStore.store, which records the patient's
+        reference so reclaim keeps the object.
+        """
+        return await self._store_referenced(
+            patient_id, image_file, "image", image_type, 'image/jpeg', f"{image_type}.jpg"
         )
 
     async def store_document(
@@ -105,15 +181,31 @@ class S3Service:
             document_type: str,
             file_extension: str
     ) -> str:
-        """Store a patient document"""
-        folder = f"{self.paths['documents']}/{patient_id}"
-        filename = f"{document_type}.{file_extension}"
-        return await self.upload_file(
-            document_file,
-            folder,
-            filename
+        """Store a patient document; returns its content-addressed key (see store_patient_image)"""
+        return await self._store_referenced(
+            patient_id, document_file, "document", document_type, None, f"{document_type}.{file_extension}"
         )
 
+    async def _store_referenced(
+            self,
+            patient_id: int,
+            file_obj: BinaryIO,
+            category: str,
+            document_type: str,
+            content_type: Optional[str],
+            filename: str
+    ) -> str:
+        from .document_store import DocumentStore
+
+        try:
+            document = await run_blocking(
+                DocumentStore(self).store, patient_id, file_obj, category, document_type, content_type, filename
+            )
+            return document["s3_key"]
+        except Exception as e:
+            logger.error(f"Error storing {category} in S3: {e}")
+            raise
+
     async def backup_database(self, backup_file: BinaryIO) -> str:
         """Store a database backup"""
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -0,0 +1,111 @@
+# app/services/single_flight.py
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT_SECONDS = float(os.getenv("SINGLE_FLIGHT_TIMEOUT_SECONDS", "10"))
+
+
+class SingleFlight:
+    """Let concurrent callers with the same key share one in-flight load.
+
+    The first caller (the leader) runs the load; callers arriving while it
+    is running wait for the same result instead of starting their own.
+    Nothing is cached: once the load finishes, the next caller starts a new
+    one. Results are shared between requests, so they must not be mutated.
+    """
+
+    def __init__(self, name: str, timeout: Optional[float] = None):
+        self.name = name
+        self.timeout = timeout if timeout is not None else DEFAULT_TIMEOUT_SECONDS
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.loads = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def do(self, key: Hashable, load: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """Return load()'s result, sharing it with concurrent callers of the same key.
+
+        If the leader is cancelled (its client went away), its load is
+        abandoned rather than failed: waiting followers start over and one
+        of them becomes the new leader.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout if timeout is not None else self.timeout)
+        future = self.in_flight.get(key)
+        while future is not None:
+            # asyncio.wait neither cancels the leader's future when this
+            # follower gives up nor raises the leader's cancellation here
+            await asyncio.wait({future}, timeout=max(deadline - loop.time(), 0))
+            if not future.done():
+                self.timeouts += 1
+                raise asyncio.TimeoutError()
+            if not future.cancelled():
+                self.coalesced += 1
+                return future.result()
+            future = self.in_flight.get(key)
+
+        future = loop.create_future()
+        # Mark the exception retrieved when nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.in_flight[key] = future
+        self.loads += 1
+        try:
+            result = await asyncio.wait_for(load(), max(deadline - loop.time(), 0))
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+            "timeouts": self.timeouts,
+            "errors": self.errors
+        }
+
+
+_flights: Dict[str, SingleFlight] = {}
+
+
+def single_flight(name: str, timeout: Optional[float] = None) -> SingleFlight:
+    """Named group of coalesced loads, created on first use"""
+    flight = _flights.get(name)
+    if flight is None:
+        flight = _flights[name] = SingleFlight(name, timeout)
+    return flight
+
+
+def single_flight_stats() -> Dict[str, Dict[str, Any]]:
+    """Counters for every group; coalesced is the number of duplicate loads avoided"""
+    return {name: flight.stats() for name, flight in _flights.items()}
+
+
+async def run_blocking(function: Callable[..., Any], *args) -> Any:
+    """Run a blocking call (database, boto3) on the default thread pool.
+
+    Loads must yield to the event loop, or concurrent requests could never
+    overlap and there would be nothing to coalesce.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
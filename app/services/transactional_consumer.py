@@ -0,0 +1,191 @@
+# app/services/transactional_consumer.py
+import logging
+from typing import Callable, Dict, List, Optional
+
+from kafka import ConsumerRebalanceListener, KafkaConsumer, TopicPartition
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+from .retry_topics import RetryRouter
+
+logger = logging.getLogger(__name__)
+
+
+class StaleOffsetError(Exception):
+    """Another consumer stored a newer offset for a partition in the batch"""
+
+
+class PostgresOffsetStore:
+    """Consumed offsets kept in kafka_consumer_offsets next to the data they produced"""
+
+    def __init__(self, group_id: str):
+        self.group_id = group_id
+
+    @property
+    def table(self):
+        from ..models.consumer_offset import ConsumerOffset
+        return ConsumerOffset.__table__
+
+    def load(self, partitions: List[TopicPartition]) -> Dict[TopicPartition, int]:
+        """Next offsets to consume for the given partitions, where stored"""
+        if not partitions:
+            return {}
+        t = self.table
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                select(t.c.topic, t.c.partition, t.c.next_offset).where(
+                    t.c.group_id == self.group_id,
+                    t.c.topic.in_({tp.topic for tp in partitions})
+                )
+            ).all()
+        finally:
+            db.close()
+        wanted = set(partitions)
+        offsets = {TopicPartition(row.topic, row.partition): row.next_offset for row in rows}
+        return {tp: offset for tp, offset in offsets.items() if tp in wanted}
+
+    def save(self, db: Session, next_offsets: Dict[TopicPartition, int], batch_starts: Dict[TopicPartition, int]):
+        """Advance offsets inside the caller's transaction.
+
+        A partition's stored offset may not be past the first offset of the
+        batch (offsets can have gaps, so it need not be equal). Otherwise
+        another consumer of the group, such as a zombie from before a
+        rebalance, has already moved it on: StaleOffsetError is raised and
+        the caller must roll back. The conditional UPDATE takes the row
+        lock, so of two racing consumers the second sees the first's offset.
+        """
+        t = self.table
+        for tp, offset in next_offsets.items():
+            row = (t.c.group_id == self.group_id, t.c.topic == tp.topic, t.c.partition == tp.partition)
+            advanced = db.execute(
+                update(t)
+                .where(*row, t.c.next_offset <= batch_starts[tp])
+                .values(next_offset=offset, updated_at=func.now())
+            ).rowcount
+            if advanced:
+                continue
+            inserted = db.execute(
+                insert(t).values(
+                    group_id=self.group_id,
+                    topic=tp.topic,
+                    partition=tp.partition,
+                    next_offset=offset
+                ).on_conflict_do_nothing(index_elements=["group_id", "topic", "partition"])
+            ).rowcount
+            if not inserted:
+                raise StaleOffsetError(
+                    f"Stored offset for {tp.topic}[{tp.partition}] is past {batch_starts[tp]}"
+                )
+
+
+class SeekToStoredOffsets(ConsumerRebalanceListener):
+    """On assignment, resume each partition from the offset stored in Postgres"""
+
+    def __init__(self, store: PostgresOffsetStore):
+        self.store = store
+        self.consumer = None
+
+    def on_partitions_revoked(self, revoked):
+        # Batches commit synchronously, so nothing is in flight to flush
+        pass
+
+    def on_partitions_assigned(self, assigned):
+        offsets = self.store.load(list(assigned))
+        for tp in assigned:
+            if tp in offsets:
+                self.consumer.seek(tp, offsets[tp])
+        logger.info(f"Assigned {len(assigned)} partitions, {len(offsets)} resumed from stored offsets")
+
+
+class PoisonMessageError(Exception):
+    """A message that fails on its own could not be set aside"""
+
+
+class TransactionalBatchProcessor:
+    """Apply a batch of messages and their offsets in one database transaction.
+
+    The handler receives the session and the message value and must only
+    write through that session; it must not commit. Effects outside the
+    database (HTTP calls, Kafka sends) are not covered.
+
+    A message that still fails on its own is published to the group's
+    dead-letter topic before its offset is stored; if that publish fails
+    the batch is rewound instead, so no message is skipped silently. A
+    crash between the publish and the commit can dead-letter a message twice.
+    A batch whose partitions another consumer has meanwhile moved past is
+    rolled back rather than stored over the newer offsets.
+    """
+
+    def __init__(
+            self,
+            consumer: KafkaConsumer,
+            store: PostgresOffsetStore,
+            handler: Callable[[Session, dict], None],
+            dead_letters: Optional[RetryRouter] = None
+    ):
+        self.consumer = consumer
+        self.store = store
+        self.handler = handler
+        self.dead_letters = dead_letters
+
+    def process(self, records: Dict[TopicPartition, list]):
+        db = SessionLocal()
+        try:
+            try:
+                next_offsets = self._apply(db, records, isolate=False)
+            except Exception as e:
+                # Fast path failed; redo the batch with a savepoint per message
+                # so only the failing messages are skipped
+                logger.warning(f"Batch failed ({e}); retrying message by message")
+                db.rollback()
+                next_offsets = self._apply(db, records, isolate=True)
+            batch_starts = {tp: messages[0].offset for tp, messages in records.items() if messages}
+            self.store.save(db, next_offsets, batch_starts)
+            db.commit()
+        except StaleOffsetError as e:
+            db.rollback()
+            logger.warning(f"{e}; discarding the batch and resuming from the stored offsets")
+            self._resume_from_store(records)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error committing consumer batch, rewinding: {e}")
+            self._rewind(records)
+        finally:
+            db.close()
+
+    def _apply(self, db: Session, records: Dict[TopicPartition, list], isolate: bool) -> Dict[TopicPartition, int]:
+        next_offsets = {}
+        for tp, messages in records.items():
+            for message in messages:
+                if not isolate:
+                    self.handler(db, message.value)
+                else:
+                    savepoint = db.begin_nested()
+                    try:
+                        self.handler(db, message.value)
+                        savepoint.commit()
+                    except Exception as e:
+                        savepoint.rollback()
+                        logger.error(
+                            f"Error processing message {tp.topic}[{tp.partition}]@{message.offset}: {e}"
+                        )
+                        if self.dead_letters is None or not self.dead_letters.dead_letter(message, e):
+                            raise PoisonMessageError(
+                                f"Could not dead-letter {tp.topic}[{tp.partition}]@{message.offset}"
+                            ) from e
+                next_offsets[tp] = message.offset + 1
+        return next_offsets
+
+    def _rewind(self, records: Dict[TopicPartition, list]):
+        """Seek back to the first message of the batch so it is redelivered"""
+        for tp, messages in records.items():
+            if messages:
+                self.consumer.seek(tp, messages[0].offset)
+
+    def _resume_from_store(self, records: Dict[TopicPartition, list]):
+        """Seek to the offsets another consumer stored; a zombie loses the partitions on its next poll"""
+        for tp, offset in self.store.load(list(records)).items():
+            self.consumer.seek(tp, offset)
@@ -2,6 +2,7 @@
 CREATE DATABASE healthcare_db;
 \c healthcare_db;
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+CREATE EXTENSION IF NOT EXISTS btree_gist;
 
 -- Add any initial schema or data here
 -- For example: